@@ -11,9 +11,16 @@ Commands/modes:
 - backward <input.log> <input-map.sqlite> <output.sqlite>
 - forward <input.seed_identifiers> <output.sqlite>
 - everything <input.log> <input.cdx> <input.seed_identifiers> <output.sqlite>
+- shards <output.sqlite> --shard <input.log> <input.seed_identifiers> [--shard ...]
+- merge <output.sqlite> <input.sqlite> [<input.sqlite> ...]
 - postprocess <sha1_status.tsv> <output.sqlite>
+- follow <input.log> <map.sqlite> <output.sqlite>
+- summarize <output.sqlite>
 - dump_json <output.sqlite>
 
+Input files can be compressed (.gz, .bz2, .xz, .zst), and most modes accept
+multiple files or globs (eg, shard logs).
+
 Design docs in DESIGN.md
 
 This script was written by Bryan Newbold <bnewbold@archive.org> and is Free
@@ -23,7 +30,6 @@ file).
 TODO:
 - pass SHA-1 and timestamp in forward mode (?)
 - include final_size (if possible from crawl log)
-- open map in read-only when appropriate
 - should referrer map be UNIQ?
 - forward outputs get generated multiple times?
 - try: https://pypi.org/project/urlcanon/
@@ -33,14 +39,37 @@ BUG:
 BAD LOG LINE: 2018-07-27T12:26:24.783Z   200         24 http://www.phywe-es.com/robots.txt 15+LREELLLLLRLELLRLLLRLLLLRLELRRLLLLLLLLLLLLLLLLLLLLP http://www.phywe-es.com/index.php/fuseaction/download/lrn_file/versuchsanleitungen/P2522015/tr/P2522015.pdf text/html #296 20180727122622741+438 sha1:YR6M6GSJYJGMLBBEGCVHLRZO6SISSJAS - unsatisfiableCharsetInHeader:ISO 8859-1 {"contentSize":254,"warcFilename":"UNPAYWALL-PDF-CRAWL-2018-07-20180727122113315-14533-11460~wbgrp-svc282.us.archive.org~8443.warc.gz","warcFileOffset":126308355}
 """
 
+import io
+import os
 import sys
+import csv
+import bz2
+import glob
+import gzip
 import json
+import lzma
+import mmap
 import time
+import array
+import struct
+import base64
+import hashlib
+import tempfile
+import atexit
+import resource
+import queue
+import functools
+import itertools
+import heapq
 import urllib
 import urllib3
 import sqlite3
 import argparse
+import re
+import threading
+import contextlib
 import collections
+import multiprocessing
 
 CrawlLine = collections.namedtuple('CrawlLine', [
     'log_time',
@@ -93,6 +122,7 @@ FULLTEXT_MIMETYPES = (
     "application/octet-stream",
 )
 
+@functools.lru_cache(maxsize=4096)
 def normalize_mimetype(raw):
     raw = raw.lower()
     raw = raw.replace('"', '').replace("'", '').replace(',', '')
@@ -109,7 +139,30 @@ def normalize_mimetype(raw):
         return 'application/octet-stream'
     return raw
 
+# URLs which normalize_url() would return unchanged: lower-case scheme and
+# host, no port/auth/fragment/whitespace, no dot segments, and only characters
+# (or upper-case %XX escapes) in the path and query that quoting leaves alone
+CANONICAL_URL_RE = re.compile(
+    r"^(?:https?|ftp)://[a-z0-9.\-]+"
+    r"/(?:[A-Za-z0-9_.~/+:();$!,\-]|%[0-9A-F]{2})*"
+    r"(?:\?(?:[A-Za-z0-9_.~/+:;$!,=&\-]|%[0-9A-F]{2})*)?$")
+DOT_SEGMENT_RE = re.compile(r"/\.\.?(?:/|\?|$)")
+
+# hosts which urllib3.util.parse_url() would return as-is
+SIMPLE_HOST_RE = re.compile(r"^(?:https?|ftp)://([a-z0-9.\-]+)(?:[/?#]|$)")
+
 def normalize_url(raw):
+    """
+    Fast path for URLs which are already canonical (most of them, in crawl
+    logs and seedlists), falling back to a memoized full parse and rebuild.
+    """
+    raw = raw.strip()
+    if CANONICAL_URL_RE.match(raw) and not DOT_SEGMENT_RE.search(raw):
+        return raw
+    return normalize_url_full(raw)
+
+@functools.lru_cache(maxsize=2**18)
+def normalize_url_full(raw):
     """
     This is a surprisingly complex function that cleans up URLs.
 
@@ -157,6 +210,20 @@ def normalize_url(raw):
     result = urllib3.util.Url(u.scheme, u.auth, u.host.lower(), port, path, u.query, None)
     return result.url.replace(' ', '%20')
 
+def url_host(url):
+    """
+    Host (domain) part of a URL, as returned by urllib3.util.parse_url(). Shared
+    by all the crawl_result insert paths; simple hosts are just sliced out.
+    """
+    m = SIMPLE_HOST_RE.match(url)
+    if m:
+        return m.group(1)
+    return url_host_full(url)
+
+@functools.lru_cache(maxsize=2**16)
+def url_host_full(url):
+    return urllib3.util.parse_url(url).host
+
 def test_normalize_url():
     
     assert (normalize_url('HTTP://ASDF.com/a/../b') == 'http://asdf.com/b')
@@ -171,6 +238,10 @@ def test_normalize_url():
     assert (normalize_url('HTTP://ASDF.com/first%20second') == 'http://asdf.com/first%20second')
     assert (normalize_url('Ftp://ASDF.com/a/../b') == 'ftp://asdf.com/b')
 
+    assert (normalize_url('  http://asdf.com/a.pdf\n') == 'http://asdf.com/a.pdf')
+    assert (normalize_url('http://asdf.com/./a.pdf') == 'http://asdf.com/a.pdf')
+    assert (normalize_url('http://asdf.com/a/..') == 'http://asdf.com/')
+
     #assert (normalize_url('http://goldhorde.ru/wp-content/uploads/2017/03/ЗО-1-2017-206-212.pdf') ==
     #    'http://goldhorde.ru/wp-content/uploads/2017/03/%EF%BF%BD%EF%BF%BD%EF%BF%BD%EF%BF%BD-1-2017-206-212.pdf')
     assert (normalize_url('http://goldhorde.ru/wp-content/uploads/2017/03/ЗО-1-2017-206-212.pdf') ==
@@ -197,6 +268,70 @@ def test_normalize_url():
     assert (normalize_url('http://pdfs.journals.lww.com/transplantjournal/2012/11271/Extra_Pulmonary_Nocardiosis_and_Perigraft_Abscess,.1668.pdf?token=method|ExpireAbsolute;source|Journals;ttl|1503135985283;payload|mY8D3u1TCCsNvP5E421JYK6N6XICDamxByyYpaNzk7FKjTaa1Yz22MivkHZqjGP4kdS2v0J76WGAnHACH69s21Csk0OpQi3YbjEMdSoz2UhVybFqQxA7lKwSUlA502zQZr96TQRwhVlocEp/sJ586aVbcBFlltKNKo+tbuMfL73hiPqJliudqs17cHeLcLbV/CqjlP3IO0jGHlHQtJWcICDdAyGJMnpi6RlbEJaRheGeh5z5uvqz3FLHgPKVXJzdGlb2qsojlvlytk14LkMXSI/t5I2LVgySZVyHeaTj/dJdRvauPu3j5lsX4K1l3siV;hash|9tFBJUOSJ1hYPXrgBby2Xg==') ==
         'http://pdfs.journals.lww.com/transplantjournal/2012/11271/Extra_Pulmonary_Nocardiosis_and_Perigraft_Abscess,.1668.pdf?token=method|ExpireAbsolute;source|Journals;ttl|1503135985283;payload|mY8D3u1TCCsNvP5E421JYK6N6XICDamxByyYpaNzk7FKjTaa1Yz22MivkHZqjGP4kdS2v0J76WGAnHACH69s21Csk0OpQi3YbjEMdSoz2UhVybFqQxA7lKwSUlA502zQZr96TQRwhVlocEp/sJ586aVbcBFlltKNKo+tbuMfL73hiPqJliudqs17cHeLcLbV/CqjlP3IO0jGHlHQtJWcICDdAyGJMnpi6RlbEJaRheGeh5z5uvqz3FLHgPKVXJzdGlb2qsojlvlytk14LkMXSI/t5I2LVgySZVyHeaTj/dJdRvauPu3j5lsX4K1l3siV;hash|9tFBJUOSJ1hYPXrgBby2Xg==')
 
+def test_normalize_url_fast_path():
+    urls = [
+        'http://asdf.com/a/b.pdf',
+        'http://asdf.com/a/b.pdf?x=1&y=%2F',
+        'http://asdf.com/a/b.pdf?x=1&y=%2f',
+        'https://asdf.com/a%20b/c.pdf',
+        'http://asdf.com/a/./b',
+        'http://asdf.com/a/../b',
+        'http://asdf.com/a/..',
+        'http://asdf.com/a/.well-known/b',
+        'http://asdf.com/?x',
+        'http://asdf.com',
+        'http://asdf.com:8080/a',
+        'http://user@asdf.com/a',
+        'http://ASDF.com/a',
+        'ftp://asdf.com/pub/a.ps',
+        'http://asdf.com/a=b&c',
+        'http://asdf.com/(SICI)1099-0518(199702)35:3;2-J/pdf',
+        'http://asdf.com/polopoly_fs/1.22367!/menu/main/pdf/547389a.pdf',
+    ]
+    for url in urls:
+        assert normalize_url(url) == normalize_url_full(url)
+        assert url_host(url) == urllib3.util.parse_url(url).host
+
+def bench_normalize(url_file, limit=None):
+    """
+    Micro-benchmark for normalize_url(): URLs/sec for the original full parse
+    (uncached) vs the fast path + cache, and a check that results match. The
+    input is a seedlist or any file with a URL in the first column.
+    """
+    urls = []
+    for raw_line in url_file:
+        urls.append(raw_line.strip().split('\t')[0])
+        if limit and len(urls) >= limit:
+            break
+    print("Benchmarking normalize_url() with {} URLs".format(len(urls)))
+
+    def run(name, func):
+        start = time.time()
+        results = [func(u) for u in urls]
+        elapsed = max(time.time() - start, 0.000001)
+        print("{:>24}: {:.0f} URLs/sec".format(name, len(urls) / elapsed))
+        return results
+
+    before = run('full (uncached)', normalize_url_full.__wrapped__)
+    normalize_url_full.cache_clear()
+    after = run('fast path + cache', normalize_url)
+    run('fast path + warm cache', normalize_url)
+    mismatch = sum(1 for a, b in zip(before, after) if a != b)
+    print("{} mismatches".format(mismatch))
+    print(normalize_url_full.cache_info())
+
+    # host extraction only ever sees normalized URLs
+    normalized = [u for u in after if u]
+    start = time.time()
+    before = [urllib3.util.parse_url(u).host for u in normalized]
+    print("{:>24}: {:.0f} URLs/sec".format('parse_url().host', len(normalized) / max(time.time() - start, 0.000001)))
+    start = time.time()
+    after = [url_host(u) for u in normalized]
+    print("{:>24}: {:.0f} URLs/sec".format('url_host()', len(normalized) / max(time.time() - start, 0.000001)))
+    host_mismatch = sum(1 for a, b in zip(before, after) if a != b)
+    print("{} host mismatches".format(host_mismatch))
+    return mismatch + host_mismatch
+
 def parse_crawl_line(line):
     # yup, it's just whitespace, and yup, there's a JSON blob at the end that
     # "hopefully" contains no whitespace
@@ -218,11 +353,541 @@ def parse_crawl_line(line):
 
 def parse_full_cdx_line(line):
     line = line.strip().split(' ')
-    assert len(line) == 11
+    if len(line) != 11:
+        return None
     # mimetype
     line[3] = normalize_mimetype(line[3])
     return FullCdxLine(*line)
 
+def expand_input_paths(paths):
+    """
+    Expands a path, or list of paths, possibly with shell-style globs (eg, a
+    set of shard logs), into a flat list. '-' means stdin.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    expanded = []
+    for path in paths:
+        if path != '-' and glob.has_magic(path):
+            matches = sorted(glob.glob(path))
+            if not matches:
+                raise FileNotFoundError("no input files match: {}".format(path))
+            expanded.extend(matches)
+        else:
+            expanded.append(path)
+    return expanded
+
+def open_decompressed(path, raw=None):
+    """
+    Opens a single input file as a binary stream of its decompressed
+    contents, based on file extension (.gz, .bz2, .xz, .zst).
+
+    If raw is an already opened binary file for path, reads through that
+    (so raw.tell() gives the offset in the on-disk, possibly compressed, file).
+    """
+    raw = raw or open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(raw, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.open(raw, 'rb')
+    if path.endswith('.xz'):
+        return lzma.open(raw, 'rb')
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("reading .zst files requires the 'zstandard' package (or pipe through zstdcat)")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw))
+    return raw
+
+def open_compressed(path, raw=None):
+    """
+    Opens a single input file in text mode, decompressing as needed (see
+    open_decompressed). '-' is stdin.
+    """
+    if path == '-':
+        return sys.stdin
+    return io.TextIOWrapper(open_decompressed(path, raw))
+
+class InputReader:
+    """
+    Iterates over the lines of one or more (possibly compressed) input files.
+
+    Decompression and line splitting happen in a background thread, which
+    hands batches of lines to the consumer through a bounded queue. zlib, bz2
+    and lzma release the GIL while decompressing, so one core can decompress
+    while the main thread parses and writes to sqlite3; when parsing is the
+    bottleneck, the queue fills up and the reader blocks.
+
+    bytes_read is the on-disk (compressed) offset behind the lines consumed
+    so far, summed over files; with total_bytes, that gives progress and ETA.
+    """
+
+    def __init__(self, paths, batch_size=2000, queue_size=64):
+        self.paths = expand_input_paths(paths)
+        self.batch_size = batch_size
+        self.bytes_read = 0
+        self.total_bytes = None
+        if '-' not in self.paths:
+            self.total_bytes = sum(os.path.getsize(path) for path in self.paths)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        try:
+            done = 0
+            for path in self.paths:
+                raw = None
+                if path != '-':
+                    raw = open(path, 'rb')
+                f = open_compressed(path, raw)
+                batch = []
+                for line in f:
+                    batch.append(line)
+                    if len(batch) >= self.batch_size:
+                        self.queue.put((batch, done + raw.tell() if raw else 0))
+                        batch = []
+                if batch:
+                    self.queue.put((batch, done + raw.tell() if raw else 0))
+                if raw:
+                    done += os.path.getsize(path)
+                    f.close()
+                    raw.close()
+        except Exception as e:
+            self.queue.put(e)
+        self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            batch, self.bytes_read = batch
+            yield from batch
+
+def test_input_reader(tmp_path):
+    lines = ["line {}\n".format(i) for i in range(5000)]
+    for name, opener in (('a.log', open), ('b.log.gz', gzip.open), ('c.log.bz2', bz2.open), ('d.log.xz', lzma.open)):
+        with opener(str(tmp_path / name), 'wt') as f:
+            f.writelines(lines)
+    for name in ('a.log', 'b.log.gz', 'c.log.bz2', 'd.log.xz'):
+        assert list(InputReader(str(tmp_path / name), batch_size=300, queue_size=2)) == lines
+    reader = InputReader([str(tmp_path / '*.log*')])
+    assert list(reader) == lines * 4
+    assert reader.bytes_read == reader.total_bytes
+    try:
+        list(InputReader(str(tmp_path / 'missing.log')))
+        assert False
+    except FileNotFoundError:
+        pass
+
+class IngestLog:
+    """
+    Records how far each input file has been read for a stage (as a byte
+    offset into the decompressed contents) in an 'ingest_progress' table of
+    the database being written, so re-runs only read lines appended since,
+    and interrupted runs pick up where they left off.
+
+    The caller calls checkpoint() just before each commit, once everything
+    from the lines read so far is written, so offsets are committed (or lost)
+    in the same transaction as the rows made from those lines. Only complete
+    lines are read: a partly written last line is left for next time.
+
+    Files are also tracked by inode, for log rotation: a log renamed since it
+    was last read carries on from its offset under the new name (and is read
+    even if it no longer matches the input paths), and a new file in its old
+    place is read from the start.
+    """
+
+    def __init__(self, db, stage):
+        self.db = db
+        self.stage = stage
+        # (path, offset, lines, eof_size, inode) of the last new line read,
+        # until recorded
+        self.current = None
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS ingest_progress
+                (stage text NOT NULL,
+                 path text NOT NULL,
+                 offset integer NOT NULL,
+                 lines integer NOT NULL,
+                 eof_size integer,
+                 inode integer,
+                 PRIMARY KEY (stage, path))""")
+        if 'inode' not in [row[1] for row in db.execute("PRAGMA table_info(ingest_progress)")]:
+            db.execute("ALTER TABLE ingest_progress ADD COLUMN inode integer")
+
+    def recorded(self, path):
+        """
+        Returns (offset, lines, eof_size) for path, or None if never read.
+        eof_size is the on-disk size when the end of file was last reached.
+        """
+        rows = list(self.db.execute(
+            "SELECT offset, lines, eof_size FROM ingest_progress WHERE stage=? AND path=?",
+            [self.stage, os.path.abspath(path)]))
+        return rows[0] if rows else None
+
+    def any_recorded(self):
+        return bool(list(self.db.execute("SELECT 1 FROM ingest_progress WHERE stage=? LIMIT 1", [self.stage])))
+
+    def record(self, path, offset, lines, eof_size=None, inode=None):
+        self.db.execute("INSERT OR REPLACE INTO ingest_progress VALUES (?,?,?,?,?,?)",
+            [self.stage, os.path.abspath(path), offset, lines, eof_size, inode])
+
+    def start(self, path, inode):
+        """
+        Returns (offset, lines, eof_size) to carry on reading path from: the
+        record for the same inode (under any path), else for this path if it
+        was recorded without one, else the start of the file.
+        """
+        path = os.path.abspath(path)
+        rows = list(self.db.execute(
+            "SELECT offset, lines, eof_size FROM ingest_progress WHERE stage=? AND inode=? ORDER BY path != ?",
+            [self.stage, inode, path]))
+        if not rows:
+            rows = list(self.db.execute(
+                "SELECT offset, lines, eof_size FROM ingest_progress WHERE stage=? AND path=? AND inode IS NULL",
+                [self.stage, path]))
+        if not rows:
+            return 0, 0, None
+        offset, lines, eof_size = rows[0]
+        if os.path.splitext(path)[1] not in ('.gz', '.bz2', '.xz', '.zst') and offset > os.path.getsize(path):
+            # truncated in place (or the inode was reused)
+            return 0, 0, None
+        return offset, lines, eof_size
+
+    def rotated(self, path, inode):
+        """
+        If the file last read as path was a different one, returns where it
+        is now (renamed within the same directory), or None.
+        """
+        rows = list(self.db.execute("SELECT inode FROM ingest_progress WHERE stage=? AND path=?",
+            [self.stage, os.path.abspath(path)]))
+        if not rows or rows[0][0] in (None, inode):
+            return None
+        directory = os.path.dirname(os.path.abspath(path))
+        for name in sorted(os.listdir(directory)):
+            other = os.path.join(directory, name)
+            try:
+                if os.path.isfile(other) and os.stat(other).st_ino == rows[0][0]:
+                    return other
+            except OSError:
+                continue
+        return None
+
+    def pending_bytes(self, paths):
+        """
+        Rough (on-disk) size of input not read yet: whole files for anything
+        not fully read before, and growth since for files that were.
+        """
+        pending = 0
+        for path in paths:
+            size = os.path.getsize(path)
+            recorded = self.recorded(path)
+            if not recorded or recorded[2] is None:
+                pending += size
+            elif size != recorded[2]:
+                pending += max(size - recorded[2], 0)
+        return pending
+
+    def read_bytes(self, paths):
+        return sum((self.recorded(path) or (0, 0, None))[2] or 0 for path in paths)
+
+    def checkpoint(self):
+        if self.current:
+            self.record(*self.current)
+            self.current = None
+
+    def lines(self, paths, new_only=True):
+        """
+        Yields (line, is_new) for each complete line of each file, starting
+        after what was read before (all lines, with is_new False for those,
+        if new_only is False). The offset is recorded at the end of each
+        file; in between, by checkpoint().
+        """
+        paths = expand_input_paths(paths)
+        if '-' in paths:
+            raise ValueError("incremental mode needs input files, not stdin")
+        # where to start each file is worked out before any of it is
+        # recorded, as a rotated log's record is under its old path
+        absolute = set(os.path.abspath(path) for path in paths)
+        plan = []
+        for path in paths:
+            inode = os.stat(path).st_ino
+            old = self.rotated(path, inode)
+            if old and old not in absolute:
+                absolute.add(old)
+                old_inode = os.stat(old).st_ino
+                plan.append((old, old_inode, self.start(old, old_inode)))
+            plan.append((path, inode, self.start(path, inode)))
+        for path, inode, (offset, lines, eof_size) in plan:
+            size = os.path.getsize(path)
+            if new_only and eof_size == size:
+                # unchanged since it was last read to the end
+                continue
+            f = open_decompressed(path)
+            if new_only and offset:
+                f.seek(offset)
+            position = 0 if not new_only else offset
+            eof_size = size
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    # partly written last line; not the end of the file yet
+                    eof_size = None
+                    break
+                position += len(raw)
+                is_new = position > offset
+                if is_new:
+                    lines += 1
+                    self.current = (path, position, lines, None, inode)
+                yield raw.decode('utf-8'), is_new
+            f.close()
+            self.current = None
+            self.record(path, max(position, offset), lines, eof_size=eof_size, inode=inode)
+
+class Metrics:
+    """
+    Instrumentation for the main stages: wall time, rows and counts per stage
+    (with progress lines giving throughput and, from input byte offsets, an
+    ETA), plus cumulative time and call counts per phase (parse, filter,
+    map-lookup, chain-walk, insert, commit, index-build, ...). Written out as
+    JSON by write().
+
+    Stage and coarse phase() tracking is always on. Per-call timing, via
+    timed(), is only done when enabled (eg, with --metrics-file); otherwise
+    timed() returns the function as-is, so there is no overhead.
+
+    If memory_budget (bytes) is set, every progress line also checks resident
+    memory against it, and stops the run with a MemoryError if it's over,
+    instead of letting the box start swapping.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.memory_budget = None
+        self.start = time.time()
+        self.stages = collections.OrderedDict()
+        self.phases = collections.OrderedDict()
+
+    def phase_totals(self, name):
+        if name not in self.phases:
+            self.phases[name] = {'seconds': 0.0, 'calls': 0}
+        return self.phases[name]
+
+    def timed(self, name, func):
+        if not self.enabled:
+            return func
+        totals = self.phase_totals(name)
+        perf_counter = time.perf_counter
+        def timed_func(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                totals['seconds'] += perf_counter() - start
+                totals['calls'] += 1
+        return timed_func
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        totals = self.phase_totals(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            totals['seconds'] += time.perf_counter() - start
+            totals['calls'] += 1
+
+    def start_stage(self, name, source=None):
+        self.stages[name] = {'start': time.time(), 'source': source, 'rows': 0}
+
+    def progress(self, name, rows):
+        """
+        Prints a "... <stage> <rows>" progress line, with rows/sec and, if the
+        stage's input is an InputReader over files, percent done and ETA.
+        """
+        self.check_memory(name)
+        stage = self.stages.get(name)
+        if not stage:
+            print("... {} {}".format(name, rows))
+            return
+        stage['rows'] = rows
+        elapsed = max(time.time() - stage['start'], 0.000001)
+        message = "... {} {} ({:.0f}/sec".format(name, rows, rows / elapsed)
+        source = stage['source']
+        if getattr(source, 'total_bytes', None) and source.bytes_read:
+            done = source.bytes_read / source.total_bytes
+            eta = elapsed * (1 - done) / done
+            message += ", {:.1f}% of input, ETA {}".format(100 * done, format_seconds(eta))
+        print(message + ")")
+
+    def check_memory(self, name):
+        if not self.memory_budget:
+            return
+        rss = current_rss()
+        if rss and rss > self.memory_budget:
+            raise MemoryError("resident memory ({:.0f} MB) went over --memory-budget ({:.0f} MB) during {}; stopping before the box starts swapping (try a smaller --chain-cache-size, or a larger budget)".format(
+                rss / 2**20, self.memory_budget / 2**20, name))
+
+    def finish_stage(self, name, rows=None, counts=None):
+        stage = self.stages.get(name)
+        if not stage:
+            return
+        seconds = time.time() - stage.pop('start')
+        source = stage.pop('source')
+        if rows is not None:
+            stage['rows'] = rows
+        stage['seconds'] = round(seconds, 3)
+        stage['rows_per_sec'] = round(stage['rows'] / max(seconds, 0.000001), 1)
+        if getattr(source, 'total_bytes', None):
+            stage['input_bytes'] = source.total_bytes
+        if counts is not None:
+            stage['counts'] = dict(counts)
+
+    def write(self, path):
+        stages = collections.OrderedDict()
+        for name, stage in self.stages.items():
+            stages[name] = {k: v for k, v in stage.items() if k not in ('start', 'source')}
+        metrics = {
+            'command': sys.argv[1:],
+            'seconds': round(time.time() - self.start, 3),
+            'peak_rss_bytes': peak_rss(),
+            'stages': stages,
+            'phases': {name: {'seconds': round(t['seconds'], 3), 'calls': t['calls']}
+                for name, t in self.phases.items() if t['calls']},
+            'warnings': dict(WARNINGS.counts),
+        }
+        with open(path, 'w') as f:
+            json.dump(metrics, f, indent=2)
+            f.write('\n')
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+class TimedMap:
+    """
+    Wraps a map (SqliteMap, RedirectGraph, ChainCache) so lookups and chain
+    walks count towards the 'map-lookup' and 'chain-walk' phases. Lookups
+    made during a walk count as part of the walk.
+    """
+
+    def __init__(self, m, metrics):
+        self.m = m
+        self.lookup_referrer_row = metrics.timed('map-lookup', m.lookup_referrer_row)
+        self.lookup_all_referred_rows = metrics.timed('map-lookup', m.lookup_all_referred_rows)
+        self.walk_backward = metrics.timed('chain-walk', m.walk_backward)
+        self.walk_forward = metrics.timed('chain-walk', m.walk_forward)
+
+    def close(self):
+        self.m.close()
+
+class WarningStream:
+    """
+    Per-line warnings (bad log lines, missing URLs, etc) go here instead of
+    being mixed in with progress output on stdout. Each kind of warning is
+    rate-limited to `per_minute` messages (0 for no limit); the rest are only
+    counted, and the number dropped is noted on the next message of that
+    kind, and by summary() at the end.
+    """
+
+    def __init__(self, out=None, per_minute=100):
+        self.out = out
+        self.per_minute = per_minute
+        self.counts = collections.Counter()
+        self.dropped = collections.Counter()
+        self.windows = dict()
+
+    def warn(self, kind, message):
+        self.counts[kind] += 1
+        now = time.time()
+        window_start, written = self.windows.get(kind, (now, 0))
+        if now - window_start >= 60:
+            window_start, written = now, 0
+        if self.per_minute and written >= self.per_minute:
+            self.dropped[kind] += 1
+            self.windows[kind] = (window_start, written)
+            return
+        # default to whatever sys.stderr is now (eg, under pytest)
+        out = self.out or sys.stderr
+        if self.dropped[kind]:
+            out.write("({} {} warnings not shown)\n".format(self.dropped.pop(kind), kind))
+        out.write(message + "\n")
+        self.windows[kind] = (window_start, written + 1)
+
+    def summary(self):
+        out = self.out or sys.stderr
+        for kind, count in sorted(self.dropped.items()):
+            out.write("({} {} warnings not shown; {} total)\n".format(count, kind, self.counts[kind]))
+        self.dropped.clear()
+        out.flush()
+
+METRICS = Metrics()
+WARNINGS = WarningStream()
+
+def warn(kind, message):
+    WARNINGS.warn(kind, message)
+
+def test_warning_stream():
+    out = io.StringIO()
+    w = WarningStream(out, per_minute=2)
+    for i in range(5):
+        w.warn('bad-log-line', "BAD LOG LINE: {}".format(i))
+    w.warn('map-url-missing', "MISSING url: x")
+    w.summary()
+    assert out.getvalue().splitlines() == [
+        "BAD LOG LINE: 0",
+        "BAD LOG LINE: 1",
+        "MISSING url: x",
+        "(3 bad-log-line warnings not shown; 5 total)",
+    ]
+    assert w.counts == {'bad-log-line': 5, 'map-url-missing': 1}
+
+class SamplingProfiler:
+    """
+    Opt-in statistical profiler: a background thread samples the stacks of
+    all other threads every `interval` seconds, and writes counts of
+    "collapsed" stacks (thread;outer;...;inner <count>), the input format for
+    flamegraph.pl or speedscope. Low enough overhead to leave on for a full
+    run, unlike cProfile.
+    """
+
+    def __init__(self, path, interval=0.005):
+        self.path = path
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        with open(self.path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write("{} {}\n".format(stack, count))
+        print("Wrote {} profile samples to {}".format(sum(self.samples.values()), self.path))
+
 def lookup_referrer_row(cursor, url):
     #print("Lookup: {}".format(cdx.url))
     raw = list(cursor.execute('SELECT * from referrer WHERE url=? LIMIT 1', [url]))
@@ -246,355 +911,3833 @@ def lookup_all_referred_rows(cursor, url):
         result[i] = ReferrerRow(*raw)
     return result
 
-def create_out_table(db):
-    # "eat my data" style database, for speed
-    # NOTE: don't drop indexes here, because we often reuse DB
-    db.executescript("""
-        PRAGMA main.page_size = 4096;
-        PRAGMA main.cache_size = 20000;
-        PRAGMA main.locking_mode = EXCLUSIVE;
-        PRAGMA main.synchronous = OFF;
-        PRAGMA main.journal_mode = MEMORY;
+def is_skippable_embed(row):
+    """
+    Forward resolution doesn't follow simple embeds (E/X/I breadcrumbs)
+    unless they look like a PDF.
 
-        CREATE TABLE IF NOT EXISTS crawl_result
-            (initial_url text NOT NULL,
-             identifier text,
-             initial_domain text,
-             breadcrumbs text,
-             final_url text,
-             final_domain text text,
-             final_timestamp text,
-             final_status_code text,
-             final_sha1 text,
-             final_mimetype text,
-             final_was_dedupe bool,
-             hit bool,
-             postproc_status text);
-    """)
+    TODO: still PDF-specific
+    """
+    return (('E' in row.breadcrumbs or 'X' in row.breadcrumbs or 'I' in row.breadcrumbs)
+            and not 'pdf' in row.mimetype)
 
-def referrer(log_file, map_db):
+def walk_backward(lookup, final_row, counts):
     """
-    TODO: this would probably be simpler, and much faster, as a simple sqlite3 import from TSV
+    Follows referrers from a terminal row back to the initial (seed) row.
+    `lookup` is a function from URL to ReferrerRow (or None).
     """
-    print("Mapping referrers from crawl logs")
-    # "eat my data" style database, for speed
-    map_db.executescript("""
-        PRAGMA main.page_size = 4096;
-        PRAGMA main.cache_size = 20000;
-        PRAGMA main.locking_mode = EXCLUSIVE;
-        PRAGMA main.synchronous = OFF;
-        PRAGMA main.journal_mode = MEMORY;
+    row = final_row
+    loop_stack = set()
+    while row and row.referrer_url != None:
+        next_row = lookup(row.referrer_url)
+        if next_row:
+            row = next_row
+        else:
+            break
+        if row.referrer_url in loop_stack:
+            counts['map-url-redirect-loop'] += 1
+            break
+        loop_stack.add(row.referrer_url)
+    return row
 
-        CREATE TABLE IF NOT EXISTS referrer
-                 (url text,
-                  referrer text,
-                  status_code text,
-                  breadcrumbs text,
-                  mimetype text,
-                  is_dedupe bool);
-        DROP INDEX IF EXISTS referrer_url;
-        DROP INDEX IF EXISTS referrer_referrer;
-    """)
-    c = map_db.cursor()
-    i = 0
-    for raw in log_file:
-        line = parse_crawl_line(raw)
-        if not line:
-            print("BAD LOG LINE: {}".format(raw.strip()))
-            continue
-        if line.url.startswith('dns:') or line.url.startswith('whois:'):
-            #print("skipping: {}".format(line.url))
-            continue
-        is_dedupe = 'duplicate:digest' in line.annotations
-        # insert {url, referrer, status_code, breadcrumbs, mimetype, is_dedupe}
-        c.execute("INSERT INTO referrer VALUES (?,?,?,?,?,?)",
-            (line.url, line.referrer_url, line.status_code, line.breadcrumbs, line.mimetype, is_dedupe))
-        i = i+1
-        if i % 5000 == 0:
-            print("... referrer {}".format(i))
-            map_db.commit()
+def walk_forward(lookup_all, first_row, counts, limit=40):
+    """
+    Recursively iterates down the referral path from a seed row, returning
+    the "best"/"final" terminal row. Simple for the redirect case (no
+    branching); arbitrary for the fan-out case. `lookup_all` is a function
+    from URL to a list of referred ReferrerRows (or None).
+    """
+    row = first_row
+    while True:
+        limit = limit - 1
+        if limit <= 0:
+            counts['_redirect-recursion-limit'] += 1
+            break
+        next_rows = lookup_all(row.url)
+        if not next_rows:
+            # halt if we hit a dead end
+            break
 
-    map_db.commit()
-    print("Building indices (this can be slow)...")
-    c.executescript("""
-        CREATE INDEX IF NOT EXISTS referrer_url on referrer (url);
-        CREATE INDEX IF NOT EXISTS referrer_referrer on referrer (referrer);
-    """)
-    c.close()
-    print("Referrer map complete.")
+        # there are going to be multiple referrer hits, need to chose among... based on status?
+        updated = False
+        for potential in next_rows:
+            if is_skippable_embed(potential):
+                continue
+            row = potential
+            updated = True
+        if not updated:
+            break
+    return row
 
-def backward_cdx(cdx_file, map_db, output_db, hit_mimetypes=FULLTEXT_MIMETYPES):
+class SqliteMap:
     """
-    TODO: Hrm, just realized we don't usually have CDX files on a per-machine
-    basis.  Need to call this with a shard string that gets parsed from the
-    WARC field of the full CDX for the whole crawl? Oh well. Large file, but
-    can be shared, and filter should be fast (can optimize with grep as well).
+    Referrer map backed directly by the sqlite3 'referrer' table; every hop of
+    a chain is a separate indexed query. Works for any map size.
     """
-    print("Mapping backward from CDX 200/226 to initial urls")
-    counts = collections.Counter({'inserted': 0})
-    m = map_db.cursor()
-    create_out_table(output_db)
-    c = output_db.cursor()
-    i = 0
-    for raw_cdx in cdx_file:
-        if raw_cdx.startswith('CDX') or raw_cdx.startswith(' '):
-            counts['skip-cdx-raw'] += 1
-            continue
-        cdx = parse_full_cdx_line(raw_cdx)
 
-        if not ((cdx.status_code in ("200", "226") and cdx.mimetype in hit_mimetypes)
-                or (cdx.mimetype == "warc/revisit")):
-            counts['skip-cdx-scope'] += 1
-            continue
+    def __init__(self, map_db):
+        self.cursor = map_db.cursor()
 
-        if cdx.mimetype == "application/octet-stream" and line.size_bytes and line.size_bytes != '-' and int(line.size_bytes) < 1000:
-            counts['skip-tiny-octetstream-'] += 1
-            continue
+    def lookup_referrer_row(self, url):
+        return lookup_referrer_row(self.cursor, url)
 
-        #print(time.time())
-        final_row = lookup_referrer_row(m, cdx.url)
-        #print(time.time())
-        if not final_row:
-            print("MISSING url: {}".format(raw_cdx.strip()))
-            counts['map-url-missing'] += 1
-            continue
-        if not (final_row.status_code in ("200", "226") and final_row.mimetype in hit_mimetypes):
-            counts['skip-map-scope'] += 1
-            continue
-        row = final_row
-        while row and row.referrer_url != None:
-            next_row = lookup_referrer_row(m, row.referrer_url)
-            if next_row:
-                row = next_row
-            else:
-                break
-   
-        initial_domain = urllib3.util.parse_url(row.url).host
-        final_domain = urllib3.util.parse_url(final_row.url).host
-        c.execute("INSERT INTO crawl_result VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
-            (row.url, None, initial_domain, final_row.breadcrumbs, final_row.url, final_domain, cdx.timestamp, final_row.status_code, cdx.sha1, final_row.mimetype, final_row.is_dedupe, True))
-        #print(final_row.breadcrumbs)
-        i = i+1
-        counts['inserted'] += 1
-        if i % 2000 == 0:
-            print("... backward {}".format(i))
-            output_db.commit()
+    def lookup_all_referred_rows(self, url):
+        return lookup_all_referred_rows(self.cursor, url)
 
-    output_db.commit()
-    print("Building indices (this can be slow)...")
-    c.executescript("""
-        CREATE INDEX IF NOT EXISTS result_initial_url on crawl_result (initial_url);
-        CREATE INDEX IF NOT EXISTS result_identifier on crawl_result (identifier);
-    """)
-    c.close()
-    m.close()
-    print("Backward map complete.")
-    print(counts)
-    return counts
+    def walk_backward(self, final_row, counts):
+        return walk_backward(self.lookup_referrer_row, final_row, counts)
+
+    def walk_forward(self, first_row, counts):
+        return walk_forward(self.lookup_all_referred_rows, first_row, counts)
 
-def backward(log_file, map_db, output_db, hit_mimetypes=FULLTEXT_MIMETYPES):
+    def close(self):
+        self.cursor.close()
+
+class CompactSqliteMap:
     """
-    This is a variant of backward_cdx that uses the log files, not CDX file
+    Referrer map in the compact format (see referrer() with compact=True):
+    URLs interned in map_url, attribute values in map_value, and map rows as
+    integer ids. Lookups return the same ReferrerRows as SqliteMap; chain
+    walks follow url ids hop to hop, only decoding URLs for the row returned.
     """
-    print("Mapping backward from log file 200s to initial urls")
-    counts = collections.Counter({'inserted': 0})
-    m = map_db.cursor()
-    create_out_table(output_db)
-    c = output_db.cursor()
-    i = 0
-    for raw in log_file:
-        line = parse_crawl_line(raw)
-        if not line:
-            print("BAD LOG LINE: {}".format(raw.strip()))
-            continue
-        if line.url.startswith('dns:') or line.url.startswith('whois:'):
-            counts['skip-log-prereq'] += 1
-            continue
-        is_dedupe = 'duplicate:digest' in line.annotations
 
-        if not (line.status_code in ("200", "226") and line.mimetype in hit_mimetypes):
-            counts['skip-log-scope'] += 1
-            continue
+    def __init__(self, map_db):
+        self.cursor = map_db.cursor()
+        self.values = dict(map_db.execute('SELECT id, value FROM map_value'))
 
-        if line.mimetype == "application/octet-stream" and int(line.size_bytes) < 1000:
-            counts['skip-tiny-octetstream'] += 1
-            continue
+    def url_id(self, url):
+        raw = self.cursor.execute('SELECT id FROM map_url WHERE url=?', [url]).fetchone()
+        return raw[0] if raw else None
 
-        if int(line.size_bytes) == 0 or line.sha1 == "3I42H3S6NNFQ2MSVX7XZKYAYSCX5QBYJ":
-            counts['skip-empty-file'] += 1
-            continue
+    def first_row(self, uid):
+        # same row as lookup_referrer_row(): the lowest rowid for the url
+        return self.cursor.execute('SELECT url_id, referrer_id, status_code_id, breadcrumbs_id, mimetype_id, is_dedupe FROM referrer_row WHERE url_id=? ORDER BY rowid LIMIT 1', [uid]).fetchone()
 
-        #print(time.time())
-        final_row = lookup_referrer_row(m, line.url)
-        #print(time.time())
-        if not final_row:
-            print("MISSING url: {}".format(raw.strip()))
-            counts['map-url-missing'] += 1
-            continue
-        if not (final_row.status_code in ("200", "226") and final_row.mimetype in hit_mimetypes):
-            counts['skip-map-scope'] += 1
-            continue
-        row = final_row
-        loop_stack = []
-        while row and row.referrer_url != None:
-            next_row = lookup_referrer_row(m, row.referrer_url)
-            if next_row:
-                row = next_row
-            else:
-                break
-            if row.referrer_url in loop_stack:
-                counts['map-url-redirect-loop'] += 1
-                break
-            loop_stack.append(row.referrer_url)
-   
-        initial_domain = urllib3.util.parse_url(row.url).host
-        final_domain = urllib3.util.parse_url(final_row.url).host
-        # convert to IA CDX timestamp format
-        #final_timestamp = dateutil.parser.parse(line.timestamp).strftime("%Y%m%d%H%M%S")
-        final_timestamp = None
-        if len(line.timestamp) >= 14 and line.timestamp[4] != '-':
-            final_timestamp = line.timestamp[:14]
-        c.execute("INSERT INTO crawl_result VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
-            (row.url, None, initial_domain, final_row.breadcrumbs, final_row.url, final_domain, final_timestamp, final_row.status_code, line.sha1, final_row.mimetype, final_row.is_dedupe, True, None))
-        #print(final_row.breadcrumbs)
-        i = i+1
-        counts['inserted'] += 1
-        if i % 2000 == 0:
-            print("... backward {}".format(i))
-            output_db.commit()
+    def referred_rows(self, uid):
+        return self.cursor.execute('SELECT url_id, referrer_id, status_code_id, breadcrumbs_id, mimetype_id, is_dedupe FROM referrer_row WHERE referrer_id=? ORDER BY rowid', [uid]).fetchall()
 
-    output_db.commit()
-    m.close()
-    print("Building indices (this can be slow)...")
-    c.executescript("""
-        CREATE INDEX IF NOT EXISTS result_initial_url on crawl_result (initial_url);
-        CREATE INDEX IF NOT EXISTS result_identifier on crawl_result (identifier);
-    """)
-    c.close()
-    print("Backward map complete.")
-    print(counts)
-    return counts
+    def row(self, raw):
+        # (url, referrer, status_code_id, breadcrumbs_id, mimetype_id, is_dedupe)
+        values = self.values
+        return ReferrerRow(raw[0], raw[1], values[raw[2]], values[raw[3]], values[raw[4]], raw[5])
 
-def forward(seed_id_file, map_db, output_db):
-    print("Mapping forwards from seedlist to terminal urls")
-    counts = collections.Counter({'inserted': 0})
-    m = map_db.cursor()
-    create_out_table(output_db)
-    c = output_db.cursor()
+    def decode(self, raw):
+        # a row of url ids, as returned by first_row() or referred_rows()
+        urls = self.cursor.execute('SELECT (SELECT url FROM map_url WHERE id=?), (SELECT url FROM map_url WHERE id=?)', raw[:2]).fetchone()
+        return self.row(urls + tuple(raw[2:]))
 
-    i = 0
-    for raw_line in seed_id_file:
-        line = raw_line.strip().split('\t')
-        if not line:
-            counts['skip-raw-line'] += 1
-            continue
-        if len(line) == 1:
-            seed_url, identifier = line[0], None
-        elif len(line) == 2:
-            seed_url, identifier = line[0:2]
-        else:
-            print("WEIRD: {}".format(raw_line))
-            assert len(line) <= 2
-        raw_url = seed_url
-        seed_url = normalize_url(seed_url)
-        if not seed_url:
-            counts['skip-bad-seed-url'] += 1
-            continue
-        if raw_url != seed_url:
-            counts['_normalized-seed-url'] += 1
-
-        # first check if entry already in output table; if so, only upsert with identifier
-        existing_row = list(c.execute('SELECT identifier, breadcrumbs from crawl_result WHERE initial_url=? LIMIT 1', [seed_url]))
-        if existing_row:
-            if not existing_row[0][0]:
-                # identifier hasn't been updated
-                c.execute('UPDATE crawl_result SET identifier=? WHERE initial_url=?', [identifier, seed_url])
-                counts['existing-id-updated'] += 1
-                continue
-            else:
-                counts['existing-complete'] += 1
-                continue
+    def lookup_referrer_row(self, url):
+        raw = self.cursor.execute("""
+            SELECT u.url, p.url, r.status_code_id, r.breadcrumbs_id, r.mimetype_id, r.is_dedupe
+            FROM map_url u
+            JOIN referrer_row r ON r.url_id = u.id
+            LEFT JOIN map_url p ON p.id = r.referrer_id
+            WHERE u.url=? ORDER BY r.rowid LIMIT 1""", [url]).fetchone()
+        if not raw:
+            return None
+        return self.row(raw)
 
-        # if not, then do a "forward" lookup for the "best"/"final" terminal crawl line
-        # simple for redirect case (no branching); arbitrary for the fan-out case
-        first_row = lookup_referrer_row(m, seed_url)
-        if not first_row:
-            #print("MISSING url: {}".format(raw_line.strip()))
-            # need to insert *something* in this case...
-            initial_domain = urllib3.util.parse_url(seed_url).host
-            c.execute("INSERT INTO crawl_result VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
-                (seed_url, identifier, initial_domain, None, None, None, None, None, None, None, None, False, None))
-            counts['map-url-missing'] += 1
-            continue
-        row = first_row
-        # recursively iterate down referal path
-        limit = 40
+    def lookup_all_referred_rows(self, url):
+        result = self.cursor.execute("""
+            SELECT c.url, p.url, r.status_code_id, r.breadcrumbs_id, r.mimetype_id, r.is_dedupe
+            FROM map_url p
+            JOIN referrer_row r ON r.referrer_id = p.id
+            JOIN map_url c ON c.id = r.url_id
+            WHERE p.url=? ORDER BY r.rowid""", [url]).fetchall()
+        if not result:
+            return None
+        return [self.row(raw) for raw in result]
+
+    def walk_backward(self, final_row, counts):
+        # same loop as walk_backward(), but over url ids
+        if final_row.referrer_url is None:
+            return final_row
+        rid = self.url_id(final_row.referrer_url)
+        row = None
+        loop_stack = set()
+        while rid is not None:
+            raw = self.first_row(rid)
+            if not raw:
+                break
+            row = raw
+            rid = raw[1]
+            if rid in loop_stack:
+                counts['map-url-redirect-loop'] += 1
+                break
+            loop_stack.add(rid)
+        if row is None:
+            return final_row
+        return self.decode(row)
+
+    def walk_forward(self, first_row, counts, limit=40):
+        # same loop as walk_forward(), but over url ids
+        uid = self.url_id(first_row.url)
+        values = self.values
+        row = None
         while True:
             limit = limit - 1
             if limit <= 0:
                 counts['_redirect-recursion-limit'] += 1
                 break
-            next_rows = lookup_all_referred_rows(m, row.url)
-            if not next_rows:
-                # halt if we hit a dead end
-                break
-
-            # there are going to be multiple referrer hits, need to chose among... based on status?
             updated = False
-            for potential in next_rows:
-                if ('E' in potential.breadcrumbs or 'X' in potential.breadcrumbs or 'I' in potential.breadcrumbs) and not 'pdf' in potential.mimetype:
-                    # TODO: still PDF-specific
-                    # don't consider simple embeds unless PDF
+            for raw in self.referred_rows(uid):
+                if is_skippable_embed(ReferrerRow(None, None, None, values[raw[3]], values[raw[4]], None)):
                     continue
-                row = potential
+                row = raw
+                uid = raw[0]
                 updated = True
             if not updated:
                 break
+        if row is None:
+            return first_row
+        return self.decode(row)
 
-        final_row = row
-        initial_domain = urllib3.util.parse_url(seed_url).host
-        final_domain = urllib3.util.parse_url(final_row.url).host
-        # TODO: would pass SHA1 here if we had it? but not stored in referrer table
-        # XXX: None => timestamp
-        c.execute("INSERT INTO crawl_result VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
-            (seed_url, identifier, initial_domain, final_row.breadcrumbs, final_row.url, final_domain, None, final_row.status_code, None, final_row.mimetype, final_row.is_dedupe, False, None))
-        #print(final_row.breadcrumbs)
-        i = i+1
-        counts['inserted'] += 1
-        if i % 2000 == 0:
-            print("... forward {}".format(i))
-            output_db.commit()
+    def close(self):
+        self.cursor.close()
 
-    output_db.commit()
-    m.close()
-    print("Building indices (this can be slow)...")
-    c.executescript("""
-        CREATE INDEX IF NOT EXISTS result_initial_url on crawl_result (initial_url);
-        CREATE INDEX IF NOT EXISTS result_identifier on crawl_result (identifier);
-        CREATE INDEX IF NOT EXISTS result_final_sha1 on crawl_result (final_sha1);
-    """)
-    c.close()
-    print("Forward map complete.")
-    print(counts)
+class RedirectGraph:
+    """
+    Compact in-memory copy of the referrer map, loaded once, so that chains
+    can be walked without a sqlite3 round trip per hop.
+
+    URLs (both crawled and referrer) are interned to integer ids. Every map
+    row gets a slot in a set of parallel arrays: url id, referrer url id,
+    parent row, and small-int codes for status/breadcrumbs/mimetype (indexes
+    into self.values), plus dedupe and "skippable embed" flags.
+
+    Parent pointers follow lookup_referrer_row() semantics: the first map row
+    for the referrer URL, NO_PARENT if the row has no referrer, or
+    MISSING_PARENT if the referrer URL was never crawled.
+
+    Children are stored CSR-style: the rows referred from url id `u` are
+    child_rows[child_start[u]:child_start[u+1]], in map (rowid) order, which
+    matches lookup_all_referred_rows().
+    """
+
+    NO_PARENT = -1
+    MISSING_PARENT = -2
+
+    def __init__(self, map_db):
+        print("Loading referrer map into memory...")
+        self.url_ids = dict()
+        self.urls = []
+        self.values = []
+        value_ids = dict()
+        self.row_url = array.array('l')
+        self.row_referrer = array.array('l')
+        self.row_status = array.array('i')
+        self.row_breadcrumbs = array.array('i')
+        self.row_mimetype = array.array('i')
+        self.row_dedupe = bytearray()
+        self.row_skip = bytearray()
+
+        url_ids = self.url_ids
+        urls = self.urls
+        if is_compact_map(map_db):
+            query = COMPACT_MAP_ROWS + ' ORDER BY r.rowid'
+        else:
+            query = 'SELECT url, referrer, status_code, breadcrumbs, mimetype, is_dedupe FROM referrer ORDER BY rowid'
+        for raw in map_db.execute(query):
+            url, referrer_url = raw[0], raw[1]
+            uid = url_ids.get(url)
+            if uid is None:
+                uid = url_ids[url] = len(urls)
+                urls.append(url)
+            if not referrer_url or referrer_url == '-':
+                rid = -1
+            else:
+                rid = url_ids.get(referrer_url)
+                if rid is None:
+                    rid = url_ids[referrer_url] = len(urls)
+                    urls.append(referrer_url)
+            codes = []
+            for value in raw[2:5]:
+                vid = value_ids.get(value)
+                if vid is None:
+                    vid = value_ids[value] = len(self.values)
+                    self.values.append(value)
+                codes.append(vid)
+            self.row_url.append(uid)
+            self.row_referrer.append(rid)
+            self.row_status.append(codes[0])
+            self.row_breadcrumbs.append(codes[1])
+            self.row_mimetype.append(codes[2])
+            self.row_dedupe.append(1 if raw[5] else 0)
+            self.row_skip.append(1 if is_skippable_embed(ReferrerRow(*raw)) else 0)
+
+        row_count = len(self.row_url)
+        url_count = len(urls)
+
+        # first (lowest rowid) map row for each url id, or -1
+        self.first_row = array.array('l', [-1]) * url_count
+        for r in range(row_count):
+            uid = self.row_url[r]
+            if self.first_row[uid] < 0:
+                self.first_row[uid] = r
+
+        self.parent = array.array('l', [self.NO_PARENT]) * row_count
+        for r in range(row_count):
+            rid = self.row_referrer[r]
+            if rid >= 0:
+                p = self.first_row[rid]
+                self.parent[r] = p if p >= 0 else self.MISSING_PARENT
+
+        # CSR child adjacency, keyed by referrer url id
+        self.child_start = array.array('l', [0]) * (url_count + 1)
+        for r in range(row_count):
+            rid = self.row_referrer[r]
+            if rid >= 0:
+                self.child_start[rid + 1] += 1
+        for u in range(url_count):
+            self.child_start[u + 1] += self.child_start[u]
+        self.child_rows = array.array('l', [0]) * self.child_start[url_count]
+        fill = array.array('l', self.child_start[:url_count])
+        for r in range(row_count):
+            rid = self.row_referrer[r]
+            if rid >= 0:
+                self.child_rows[fill[rid]] = r
+                fill[rid] += 1
+
+        print("Loaded {} map rows ({} distinct urls, {} attribute values)".format(
+            row_count, url_count, len(self.values)))
+
+    def row(self, r):
+        rid = self.row_referrer[r]
+        return ReferrerRow(
+            self.urls[self.row_url[r]],
+            self.urls[rid] if rid >= 0 else None,
+            self.values[self.row_status[r]],
+            self.values[self.row_breadcrumbs[r]],
+            self.values[self.row_mimetype[r]],
+            self.row_dedupe[r])
+
+    def lookup_referrer_row(self, url):
+        uid = self.url_ids.get(url)
+        if uid is None or self.first_row[uid] < 0:
+            return None
+        return self.row(self.first_row[uid])
+
+    def lookup_all_referred_rows(self, url):
+        uid = self.url_ids.get(url)
+        if uid is None or self.child_start[uid] == self.child_start[uid + 1]:
+            return None
+        return [self.row(r) for r in self.child_rows[self.child_start[uid]:self.child_start[uid + 1]]]
+
+    def walk_backward(self, final_row, counts):
+        # same loop as walk_backward(), but over row numbers
+        r = self.first_row[self.url_ids[final_row.url]]
+        loop_stack = set()
+        while self.row_referrer[r] >= 0:
+            p = self.parent[r]
+            if p < 0:
+                break
+            r = p
+            rid = self.row_referrer[r]
+            if rid in loop_stack:
+                counts['map-url-redirect-loop'] += 1
+                break
+            loop_stack.add(rid)
+        return self.row(r)
+
+    def walk_forward(self, first_row, counts, limit=40):
+        # same loop as walk_forward(), but over row numbers
+        r = self.first_row[self.url_ids[first_row.url]]
+        child_start = self.child_start
+        while True:
+            limit = limit - 1
+            if limit <= 0:
+                counts['_redirect-recursion-limit'] += 1
+                break
+            uid = self.row_url[r]
+            updated = False
+            for k in range(child_start[uid], child_start[uid + 1]):
+                c = self.child_rows[k]
+                if self.row_skip[c]:
+                    continue
+                r = c
+                updated = True
+            if not updated:
+                break
+        return self.row(r)
+
+    def close(self):
+        pass
+
+def url_hash(url):
+    return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little')
+
+class MmapUrls:
+    """
+    url id -> URL, from the string heap of a MmapMap file (like
+    RedirectGraph.urls).
+    """
+
+    def __init__(self, offsets, heap):
+        self.offsets = offsets
+        self.heap = heap
+
+    def __getitem__(self, uid):
+        return str(self.heap[self.offsets[uid]:self.offsets[uid + 1]], 'utf-8')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+class MmapUrlIds:
+    """
+    URL -> url id, by interpolation search over the sorted 64-bit URL hashes
+    of a MmapMap file (like RedirectGraph.url_ids). Hash collisions are
+    resolved by comparing the URLs themselves.
+    """
+
+    def __init__(self, hashes, ids, urls):
+        self.hashes = hashes
+        self.ids = ids
+        self.urls = urls
+
+    def get(self, url, default=None):
+        hashes = self.hashes
+        key = url_hash(url)
+        lo, hi = 0, len(hashes) - 1
+        while lo <= hi:
+            lo_key, hi_key = hashes[lo], hashes[hi]
+            if key < lo_key or key > hi_key:
+                return default
+            if hi_key == lo_key:
+                mid = lo
+            else:
+                # hashes are uniform, so this is usually a couple of probes
+                mid = lo + (key - lo_key) * (hi - lo) // (hi_key - lo_key)
+            if hashes[mid] < key:
+                lo = mid + 1
+            elif hashes[mid] > key:
+                hi = mid - 1
+            else:
+                while mid > 0 and hashes[mid - 1] == key:
+                    mid -= 1
+                while mid < len(hashes) and hashes[mid] == key:
+                    if self.urls[self.ids[mid]] == url:
+                        return self.ids[mid]
+                    mid += 1
+                return default
+        return default
+
+    def __getitem__(self, url):
+        uid = self.get(url)
+        if uid is None:
+            raise KeyError(url)
+        return uid
+
+class MmapMap(RedirectGraph):
+    """
+    Read-only referrer map in a fixed-layout binary file, memory-mapped, so
+    opening it costs nothing and worker processes share one copy in the page
+    cache.
+
+    The file holds the same parallel arrays as a RedirectGraph (and the
+    chain walks are RedirectGraph's), plus URL strings in a heap (by url id),
+    and url ids sorted by 64-bit URL hash for lookups. Arrays are in native
+    byte order; the file is a cache built from the sqlite3 map (see
+    build_mmap_map), not an interchange format.
+    """
+
+    MAGIC = b'ARABMAP1'
+    ARRAYS = (
+        ('row_url', 'q'),
+        ('row_referrer', 'q'),
+        ('parent', 'q'),
+        ('row_status', 'i'),
+        ('row_breadcrumbs', 'i'),
+        ('row_mimetype', 'i'),
+        ('row_dedupe', 'B'),
+        ('row_skip', 'B'),
+        ('first_row', 'q'),
+        ('child_start', 'q'),
+        ('child_rows', 'q'),
+        ('url_hashes', 'Q'),
+        ('url_hash_ids', 'q'),
+        ('url_offsets', 'Q'),
+        ('value_offsets', 'Q'),
+        ('heap', 'B'),
+    )
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:8] != self.MAGIC:
+            raise ValueError("not a mmap referrer map: {}".format(path))
+        header_len = struct.unpack_from('<Q', self.mm, 8)[0]
+        header = json.loads(self.mm[16:16 + header_len].decode('utf-8'))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError("mmap referrer map was built with {} byte order".format(header['byteorder']))
+        view = memoryview(self.mm)
+        self.views = [view]
+        for name, typecode in self.ARRAYS:
+            offset, length = header['arrays'][name]
+            array_view = view[offset:offset + length].cast(typecode)
+            self.views.append(array_view)
+            setattr(self, name, array_view)
+        self.urls = MmapUrls(self.url_offsets, self.heap)
+        self.url_ids = MmapUrlIds(self.url_hashes, self.url_hash_ids, self.urls)
+        self.values = [str(self.heap[self.value_offsets[i]:self.value_offsets[i + 1]], 'utf-8')
+                       for i in range(len(self.value_offsets) - 1)]
+
+    def close(self):
+        # memoryviews have to be released before the mmap can be closed
+        for v in reversed(self.views):
+            v.release()
+        self.views = []
+        self.mm.close()
+        self.file.close()
+
+def build_mmap_map(map_db, path):
+    """
+    Writes a MmapMap file for a (plain or compact) sqlite3 map, by way of a
+    RedirectGraph. Written to a unique temporary file in the same directory
+    first, so readers never see a partial file, and concurrent builders each
+    write their own (the last rename wins).
+    """
+    start = time.time()
+    graph = RedirectGraph(map_db)
+    url_count = len(graph.urls)
+    hashes = sorted((url_hash(url), uid) for uid, url in enumerate(graph.urls))
+    heap = bytearray()
+    url_offsets = array.array('Q', [0]) * (url_count + 1)
+    for uid, url in enumerate(graph.urls):
+        heap += url.encode('utf-8')
+        url_offsets[uid + 1] = len(heap)
+    value_offsets = array.array('Q', [len(heap)])
+    for value in graph.values:
+        heap += (value or '').encode('utf-8')
+        value_offsets.append(len(heap))
+    arrays = dict(
+        url_hashes=array.array('Q', [h for h, uid in hashes]),
+        url_hash_ids=array.array('q', [uid for h, uid in hashes]),
+        url_offsets=url_offsets,
+        value_offsets=value_offsets,
+        heap=heap,
+    )
+    del hashes
+    for name, typecode in MmapMap.ARRAYS:
+        if name not in arrays:
+            arrays[name] = array.array(typecode, getattr(graph, name))
+
+    # lay out arrays 8-byte aligned, after a JSON header in the first page
+    layout = dict()
+    offset = 4096
+    for name, typecode in MmapMap.ARRAYS:
+        length = len(arrays[name]) * array.array(typecode).itemsize
+        layout[name] = (offset, length)
+        offset += (length + 7) // 8 * 8
+    header = json.dumps(dict(byteorder=sys.byteorder, arrays=layout)).encode('utf-8')
+    assert len(header) + 16 <= 4096
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MmapMap.MAGIC + struct.pack('<Q', len(header)) + header)
+            for name, typecode in MmapMap.ARRAYS:
+                f.seek(layout[name][0])
+                f.write(arrays[name])
+            # pad out so the last (maybe empty) array is inside the file
+            f.truncate(offset)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    print("Wrote mmap map to {} ({:.1f} MB) in {:.1f}s".format(
+        path, os.path.getsize(path) / 2**20, time.time() - start))
+
+def open_mmap_map(map_db):
+    """
+    Opens the MmapMap file next to a sqlite3 map (<map>.mmap), (re)building
+    it if it's missing or older than the map. For an in-memory map, the file
+    is temporary and removed as soon as it's mapped.
+    """
+    map_path = db_path(map_db)
+    if not map_path:
+        fd, path = tempfile.mkstemp(suffix='.mmap')
+        os.close(fd)
+        build_mmap_map(map_db, path)
+        m = MmapMap(path)
+        os.remove(path)
+        return m
+    path = map_path + '.mmap'
+    db_mtime = max(os.path.getmtime(p) for p in (map_path, map_path + '-wal') if os.path.exists(p))
+    if not os.path.exists(path) or os.path.getmtime(path) < db_mtime:
+        build_mmap_map(map_db, path)
+    return MmapMap(path)
+
+class ChainCache:
+    """
+    Wraps a map engine with a bounded LRU memo of backward chain resolution:
+    URL -> initial (seed) ReferrerRow.
+
+    After a walk, every URL visited along the way is cached with the result
+    (path compression), so later hits sharing a landing page or redirect
+    prefix stop at the first cached ancestor. Only walks that end at a real
+    chain start are cached: where a walk stops in a redirect loop depends on
+    where it entered the loop, so those are always re-walked (and counted).
+    """
+
+    def __init__(self, m, max_size=1000000):
+        self.map = m
+        self.max_size = max_size
+        self.cache = collections.OrderedDict()
+
+    def _get(self, url):
+        row = self.cache.get(url)
+        if row is not None:
+            self.cache.move_to_end(url)
+        return row
+
+    def _put(self, url, row, counts):
+        self.cache[url] = row
+        self.cache.move_to_end(url)
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+            counts['_chain-cache-evict'] += 1
+
+    def lookup_referrer_row(self, url):
+        return self.map.lookup_referrer_row(url)
+
+    def lookup_all_referred_rows(self, url):
+        return self.map.lookup_all_referred_rows(url)
+
+    def walk_forward(self, first_row, counts):
+        return self.map.walk_forward(first_row, counts)
+
+    def walk_backward(self, final_row, counts):
+        cached = self._get(final_row.url)
+        if cached is not None:
+            counts['_chain-cache-hit'] += 1
+            return cached
+        counts['_chain-cache-miss'] += 1
+        row = final_row
+        path = [final_row.url]
+        loop_stack = set()
+        while row and row.referrer_url != None:
+            cached = self._get(row.referrer_url)
+            if cached is not None:
+                counts['_chain-cache-ancestor-hit'] += 1
+                row = cached
+                break
+            next_row = self.map.lookup_referrer_row(row.referrer_url)
+            if next_row:
+                row = next_row
+            else:
+                break
+            if row.referrer_url in loop_stack:
+                counts['map-url-redirect-loop'] += 1
+                return row
+            loop_stack.add(row.referrer_url)
+            path.append(row.url)
+        for url in path:
+            self._put(url, row, counts)
+        return row
+
+    def close(self):
+        self.map.close()
+
+def estimate_graph_memory(map_db):
+    """
+    Rough upper bound (in bytes) of the RedirectGraph footprint for a map:
+    interned URL strings plus dict/list slots, and ~90 bytes of arrays per row.
+    """
+    row_count, url_bytes = list(map_db.execute(
+        'SELECT COUNT(*), SUM(LENGTH(url)) FROM referrer'))[0]
+    return (url_bytes or 0) + row_count * (49 + 100 + 90)
+
+def available_memory():
+    """
+    Returns MemAvailable (bytes) on Linux, or None if we can't tell.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def current_rss():
+    """
+    Returns this process's resident set size (bytes) on Linux, or None if we
+    can't tell.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return None
+
+def peak_rss():
+    # ru_maxrss is KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def parse_size(text):
+    """
+    Parses a size like '512M', '4G' or '1.5GiB' (binary units) to bytes.
+    """
+    text = text.strip().upper()
+    for suffix in ('IB', 'B'):
+        if text.endswith(suffix) and text[:-len(suffix)][-1:].isalpha():
+            text = text[:-len(suffix)]
+            break
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+MAP_ENGINES = ('sqlite', 'graph', 'mmap')
+
+def open_map(map_db, engine='sqlite', memory_limit=None):
+    """
+    Wraps a map sqlite3 connection in a chain-resolution engine. Already-opened
+    engines are passed through (eg, so 'everything' only loads a graph once).
+
+    The 'graph' engine falls back to 'sqlite' if the estimated footprint
+    doesn't fit in `memory_limit` (default: currently available memory). The
+    'mmap' engine builds a binary copy of the map the first time (see
+    open_mmap_map), then needs no loading at all.
+    """
+    if not isinstance(map_db, sqlite3.Connection):
+        return map_db
+    compact = is_compact_map(map_db)
+    if engine == 'mmap':
+        return open_mmap_map(map_db)
+    if engine == 'graph':
+        estimate = estimate_graph_memory(map_db)
+        print("Estimated in-memory graph size: {:.1f} MB".format(estimate / 2**20))
+        limit = memory_limit or available_memory()
+        if limit and estimate > limit:
+            print("Graph won't fit in {:.1f} MB; falling back to sqlite3 map".format(limit / 2**20))
+        else:
+            return RedirectGraph(map_db)
+    if compact:
+        return CompactSqliteMap(map_db)
+    return SqliteMap(map_db)
+
+def bench_map(map_db_paths, sample=1000, map_engines=('sqlite',)):
+    """
+    Compares map DBs (eg, plain and compact builds of the same crawl log) and
+    map engines side by side: file size, and mean latency of lookups and
+    chain walks over the same random sample of map URLs (from the first map),
+    checking that all of them return the same rows.
+    """
+    urls = None
+    results = None
+    print("{:>32} {:>8} {:>7} {:>10} {:>9} {:>11} {:>11} {:>11} {:>11}".format(
+        'map', 'format', 'engine', 'rows', 'size MB', 'lookup us', 'referred us', 'backward us', 'forward us'))
+    ok = True
+    for path, engine in [(path, engine) for path in map_db_paths for engine in map_engines]:
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        map_db = sqlite3.connect(path)
+        compact = is_compact_map(map_db)
+        rows = map_db.execute("SELECT COUNT(*) FROM {}".format('referrer_row' if compact else 'referrer')).fetchone()[0]
+        if urls is None:
+            urls = [url for (url,) in map_db.execute("SELECT url FROM referrer ORDER BY random() LIMIT ?", [sample])]
+        m = open_map(map_db, engine)
+        size = os.path.getsize(path + '.mmap' if engine == 'mmap' else path)
+        timings = []
+        start = time.time()
+        found = [m.lookup_referrer_row(url) for url in urls]
+        timings.append(time.time() - start)
+        start = time.time()
+        referred = [m.lookup_all_referred_rows(url) for url in urls]
+        timings.append(time.time() - start)
+        counts = collections.Counter()
+        start = time.time()
+        backward_rows = [m.walk_backward(row, counts) for row in found if row]
+        timings.append(time.time() - start)
+        start = time.time()
+        forward_rows = [m.walk_forward(row, counts) for row in found if row]
+        timings.append(time.time() - start)
+        print("{:>32} {:>8} {:>7} {:>10} {:>9.1f} {:>11.1f} {:>11.1f} {:>11.1f} {:>11.1f}".format(
+            os.path.basename(path)[-32:], 'compact' if compact else 'plain', engine, rows,
+            size / 2**20, *[t * 1e6 / max(len(urls), 1) for t in timings]))
+        this = (found, referred, backward_rows, forward_rows)
+        if results is None:
+            results = this
+        elif this != results:
+            ok = False
+        m.close()
+        map_db.close()
+    print("results match: {}".format(ok))
+    return ok
+
+TEST_CRAWL_LOG = """\
+2018-07-27T12:26:24.783Z   302          0 http://a.com/1 - - text/html #296 20180727122622741+438 sha1:AAAA - - {}
+2018-07-27T12:26:24.783Z   302          0 http://a.com/2 R http://a.com/1 text/html #296 20180727122622741+438 sha1:AAAA - - {}
+2018-07-27T12:26:24.783Z   200       1000 http://a.com/3 RL http://a.com/2 text/html #296 20180727122622741+438 sha1:AAAA - - {}
+2018-07-27T12:26:24.783Z   200        100 http://a.com/3.png RLE http://a.com/3 image/png #296 20180727122622741+438 sha1:AAAA - - {}
+2018-07-27T12:26:24.783Z   200       9000 http://a.com/3.pdf RLL http://a.com/3 application/pdf #296 20180727122622741+438 sha1:AAAA - duplicate:digest {}
+2018-07-27T12:26:24.783Z   302          0 http://b.com/x R http://b.com/y text/html #296 20180727122622741+438 sha1:AAAA - - {}
+2018-07-27T12:26:24.783Z   302          0 http://b.com/y R http://b.com/x text/html #296 20180727122622741+438 sha1:AAAA - - {}
+2018-07-27T12:26:24.783Z   200       9000 http://b.com/z.pdf RL http://b.com/y application/pdf #296 20180727122622741+438 sha1:AAAA - - {}
+"""
+
+def run_test_chain(seeds, map_db=None, output_db=None, backward_fn=None, referrer_kwargs=None, backward_kwargs=None, forward_kwargs=None):
+    """
+    Runs referrer, backward and forward over TEST_CRAWL_LOG and the given
+    seeds, for tests comparing modes. Returns (backward counts, forward
+    counts, crawl_result rows).
+    """
+    map_db = map_db or sqlite3.connect(':memory:')
+    output_db = output_db or sqlite3.connect(':memory:')
+    referrer(io.StringIO(TEST_CRAWL_LOG), map_db, **(referrer_kwargs or {}))
+    bcounts = (backward_fn or backward)(io.StringIO(TEST_CRAWL_LOG), map_db, output_db, **(backward_kwargs or {}))
+    fcounts = forward(io.StringIO(seeds), map_db, output_db, **(forward_kwargs or {}))
+    query = COMPACT_RESULT_ROWS + " ORDER BY r.rowid" if is_compact_output(output_db) else "SELECT * FROM crawl_result ORDER BY rowid"
+    return bcounts, fcounts, list(output_db.execute(query))
+
+def test_redirect_graph():
+    log = io.StringIO(TEST_CRAWL_LOG)
+    map_db = sqlite3.connect(':memory:')
+    referrer(log, map_db)
+    sql = SqliteMap(map_db)
+    for graph in (RedirectGraph(map_db), open_map(map_db, 'mmap')):
+        check_graph_map(sql, graph)
+
+def check_graph_map(sql, graph):
+    for url in ('http://a.com/1', 'http://a.com/3', 'http://a.com/3.pdf', 'http://b.com/z.pdf', 'http://c.com/'):
+        assert sql.lookup_referrer_row(url) == graph.lookup_referrer_row(url)
+        assert sql.lookup_all_referred_rows(url) == graph.lookup_all_referred_rows(url)
+    for url in ('http://a.com/3.pdf', 'http://b.com/z.pdf'):
+        sql_counts, graph_counts = collections.Counter(), collections.Counter()
+        final_row = sql.lookup_referrer_row(url)
+        assert sql.walk_backward(final_row, sql_counts) == graph.walk_backward(final_row, graph_counts)
+        assert sql_counts == graph_counts
+    assert graph.walk_backward(graph.lookup_referrer_row('http://a.com/3.pdf'), collections.Counter()).url == 'http://a.com/1'
+    first_row = graph.lookup_referrer_row('http://a.com/1')
+    assert graph.walk_forward(first_row, collections.Counter()).url == 'http://a.com/3.pdf'
+    assert sql.walk_forward(first_row, collections.Counter()) == graph.walk_forward(first_row, collections.Counter())
+
+def test_mmap_map(tmp_path):
+    map_path = str(tmp_path / 'map.sqlite')
+    map_db = sqlite3.connect(map_path)
+    referrer(io.StringIO(TEST_CRAWL_LOG), map_db)
+    m = open_map(map_db, 'mmap')
+    sql = SqliteMap(map_db)
+    for url in ('http://c.com/', '', 'http://a.com/1/', 'http://\u00e9.com/', 'zzzz'):
+        assert m.lookup_referrer_row(url) is None
+        assert m.lookup_all_referred_rows(url) == sql.lookup_all_referred_rows(url)
+    assert m.lookup_referrer_row('http://new.com/x.pdf') is None
+    m.close()
+    # hash collisions fall back to comparing URLs
+    ids = MmapUrlIds(array.array('Q', [url_hash('a')] * 2), array.array('q', [0, 1]), ['b', 'a'])
+    assert ids.get('a') == 1
+    assert ids.get('c') is None
+
+    # rebuilt once the map is newer
+    map_db.execute("INSERT INTO referrer VALUES ('http://new.com/x.pdf', '-', '200', '', 'application/pdf', 0)")
+    map_db.commit()
+    os.utime(map_path + '.mmap', (0, 0))
+    m = open_map(map_db, 'mmap')
+    assert m.lookup_referrer_row('http://new.com/x.pdf').url == 'http://new.com/x.pdf'
+    m.close()
+    assert sorted(os.listdir(str(tmp_path))) == ['map.sqlite', 'map.sqlite.mmap']
+
+def test_chain_cache():
+    map_db = sqlite3.connect(':memory:')
+    referrer(io.StringIO(TEST_CRAWL_LOG), map_db)
+    sql = SqliteMap(map_db)
+    cached = ChainCache(sql, max_size=3)
+    counts = collections.Counter()
+    for url in ('http://a.com/3.pdf', 'http://a.com/3', 'http://b.com/z.pdf', 'http://a.com/3.pdf'):
+        final_row = sql.lookup_referrer_row(url)
+        assert cached.walk_backward(final_row, counts) == sql.walk_backward(final_row, collections.Counter())
+    assert counts['_chain-cache-hit'] == 1
+    assert counts['_chain-cache-evict'] > 0
+    # loops are never cached
+    assert counts['map-url-redirect-loop'] == 1
+    assert 'http://b.com/z.pdf' not in cached.cache
+
+def test_compact_map():
+    plain_db, compact_db = sqlite3.connect(':memory:'), sqlite3.connect(':memory:')
+    referrer(io.StringIO(TEST_CRAWL_LOG), plain_db)
+    referrer(io.StringIO(TEST_CRAWL_LOG), compact_db, compact=True)
+    plain, compact = open_map(plain_db), open_map(compact_db)
+    assert isinstance(compact, CompactSqliteMap)
+    for url in ('http://a.com/1', 'http://a.com/3', 'http://a.com/3.pdf', 'http://b.com/y', 'http://b.com/z.pdf', 'http://c.com/'):
+        assert plain.lookup_referrer_row(url) == compact.lookup_referrer_row(url)
+        assert plain.lookup_all_referred_rows(url) == compact.lookup_all_referred_rows(url)
+        final_row = plain.lookup_referrer_row(url)
+        if final_row:
+            plain_counts, compact_counts = collections.Counter(), collections.Counter()
+            assert plain.walk_backward(final_row, plain_counts) == compact.walk_backward(final_row, compact_counts)
+            assert plain_counts == compact_counts
+            assert plain.walk_forward(final_row, plain_counts) == compact.walk_forward(final_row, compact_counts)
+    graph = RedirectGraph(compact_db)
+    assert graph.lookup_all_referred_rows('http://a.com/3') == plain.lookup_all_referred_rows('http://a.com/3')
+    assert len(list(compact_db.execute('SELECT * FROM referrer'))) == 8
+
+# SHA-1s in crawl logs and CDX are base32; compact outputs store them as their
+# 20 bytes. Both ways go through Python ints, which is several times faster
+# than base64.b32decode() and b32encode(): base32 digits translate to int()'s
+# base 32 digits (anything else to '!', which int() rejects), and 10-bit
+# chunks to pairs of characters.
+BASE32_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567'
+BASE32_TO_INT_DIGITS = bytes(b'0123456789abcdefghijklmnopqrstuv'[BASE32_ALPHABET.index(c)] if c in BASE32_ALPHABET else ord('!')
+    for c in range(256))
+BASE32_PAIRS = [chr(BASE32_ALPHABET[i >> 5]) + chr(BASE32_ALPHABET[i & 31]) for i in range(1024)]
+
+def sha1_blob(sha1):
+    """
+    A base32 SHA-1 as its 20 bytes (for compact outputs). Anything else (NULL,
+    or not a valid SHA-1) is returned as is.
+    """
+    if isinstance(sha1, str) and len(sha1) == 32:
+        try:
+            return int(sha1.encode('ascii').translate(BASE32_TO_INT_DIGITS), 32).to_bytes(20, 'big')
+        except (UnicodeEncodeError, ValueError):
+            pass
+    return sha1
+
+def sha1_text(value):
+    """
+    Inverse of sha1_blob().
+    """
+    if isinstance(value, bytes) and len(value) == 20:
+        n = int.from_bytes(value, 'big')
+        return ''.join([BASE32_PAIRS[(n >> shift) & 1023] for shift in range(150, -1, -10)])
+    return value
+
+def test_sha1_blob():
+    sha1 = 'VYW6LDSTKNL5ZGDKVL5NTFLYF6LDHNDG'
+    assert len(sha1_blob(sha1)) == 20
+    assert sha1_blob(sha1) == base64.b32decode(sha1)
+    assert sha1_text(sha1_blob(sha1)) == sha1
+    for value in (None, 'short', sha1.lower(), ' ' + sha1[1:], '0' + sha1[1:], 'é' + sha1[1:]):
+        assert sha1_blob(value) == value
+    db = sqlite3.connect(':memory:')
+    assert db.execute("SELECT {}".format(sha1_base32_sql('?1')), [sha1_blob(sha1)]).fetchone()[0] == sha1
+
+def sha1_base32_sql(column):
+    """
+    SQL expression decoding a 20-byte SHA-1 blob to base32, for sqlite3
+    clients that don't have sha1_text() (there's no unhex() or base32 built
+    in). Each byte's value is found with instr() in a blob of all 256 bytes,
+    once per row (the DISTINCT subqueries aren't flattened), and the four
+    5-byte groups split into 5-bit characters. It's about 18us per row, vs 6
+    for sha1_text().
+    """
+    all_bytes = "X'" + ''.join('{:02X}'.format(i) for i in range(256)) + "'"
+    byte = "(instr({}, substr({}, {{}}, 1)) - 1)".format(all_bytes, column)
+    groups = ", ".join(
+        " | ".join("({} << {})".format(byte.format(5*g + i + 1), 8 * (4 - i)) for i in range(5)) + " AS n{}".format(g)
+        for g in range(4))
+    chars = " || ".join(
+        "substr('ABCDEFGHIJKLMNOPQRSTUVWXYZ234567', ((n{} >> {}) & 31) + 1, 1)".format(g, 35 - 5*k)
+        for g in range(4) for k in range(8))
+    return "(SELECT {} FROM (SELECT DISTINCT {}))".format(chars, groups)
+
+def register_result_functions(db):
+    """
+    sha1_blob() and sha1_text() as SQL functions: the compact crawl_result
+    view's triggers need sha1_blob(), and readers decoding lots of rows use
+    sha1_text() instead of the view's plain SQL.
+    """
+    db.create_function('sha1_blob', 1, sha1_blob, deterministic=True)
+    db.create_function('sha1_text', 1, sha1_text, deterministic=True)
+
+# values (re)interned before writing a row through the compact view
+COMPACT_RESULT_INTERN = """
+        INSERT OR IGNORE INTO result_domain (domain)
+            SELECT NEW.initial_domain WHERE NEW.initial_domain IS NOT NULL
+            UNION ALL SELECT NEW.final_domain WHERE NEW.final_domain IS NOT NULL;
+        INSERT OR IGNORE INTO result_value (value)
+            SELECT NEW.breadcrumbs WHERE NEW.breadcrumbs IS NOT NULL
+            UNION ALL SELECT NEW.final_status_code WHERE NEW.final_status_code IS NOT NULL
+            UNION ALL SELECT NEW.final_mimetype WHERE NEW.final_mimetype IS NOT NULL
+            UNION ALL SELECT NEW.postproc_status WHERE NEW.postproc_status IS NOT NULL;
+"""
+
+# crawl_result_row rows matching a view row; exact duplicates are updated
+# (identically) together
+COMPACT_RESULT_MATCH = """
+        WHERE initial_url = OLD.initial_url
+          AND identifier IS OLD.identifier
+          AND initial_domain IS (SELECT id FROM result_domain WHERE domain = OLD.initial_domain)
+          AND breadcrumbs IS (SELECT id FROM result_value WHERE value = OLD.breadcrumbs)
+          AND final_url IS OLD.final_url
+          AND final_domain IS (SELECT id FROM result_domain WHERE domain = OLD.final_domain)
+          AND final_timestamp IS OLD.final_timestamp
+          AND final_status_code IS (SELECT id FROM result_value WHERE value = OLD.final_status_code)
+          AND final_sha1 IS sha1_blob(OLD.final_sha1)
+          AND final_mimetype IS (SELECT id FROM result_value WHERE value = OLD.final_mimetype)
+          AND final_was_dedupe IS OLD.final_was_dedupe
+          AND hit IS OLD.hit
+          AND postproc_status IS (SELECT id FROM result_value WHERE value = OLD.postproc_status);
+"""
+
+# decoded crawl_result rows of a compact output; {sha1} decodes r.final_sha1
+COMPACT_RESULT_SELECT = """
+    SELECT r.initial_url AS initial_url,
+           r.identifier AS identifier,
+           di.domain AS initial_domain,
+           b.value AS breadcrumbs,
+           r.final_url AS final_url,
+           df.domain AS final_domain,
+           r.final_timestamp AS final_timestamp,
+           s.value AS final_status_code,
+           {sha1} AS final_sha1,
+           m.value AS final_mimetype,
+           r.final_was_dedupe AS final_was_dedupe,
+           r.hit AS hit,
+           p.value AS postproc_status
+    FROM crawl_result_row r
+    LEFT JOIN result_domain di ON di.id = r.initial_domain
+    LEFT JOIN result_value b ON b.id = r.breadcrumbs
+    LEFT JOIN result_domain df ON df.id = r.final_domain
+    LEFT JOIN result_value s ON s.id = r.final_status_code
+    LEFT JOIN result_value m ON m.id = r.final_mimetype
+    LEFT JOIN result_value p ON p.id = r.postproc_status
+"""
+
+# for readers with register_result_functions()
+COMPACT_RESULT_ROWS = COMPACT_RESULT_SELECT.format(sha1="sha1_text(r.final_sha1)")
+
+COMPACT_RESULT_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS result_value
+        (id INTEGER PRIMARY KEY,
+         value text UNIQUE);
+    CREATE TABLE IF NOT EXISTS result_domain
+        (id INTEGER PRIMARY KEY,
+         domain text UNIQUE);
+    CREATE TABLE IF NOT EXISTS crawl_result_row
+        (initial_url text NOT NULL,
+         identifier text,
+         initial_domain integer,
+         breadcrumbs integer,
+         final_url text,
+         final_domain integer,
+         final_timestamp text,
+         final_status_code integer,
+         final_sha1 blob,
+         final_mimetype integer,
+         final_was_dedupe bool,
+         hit bool,
+         postproc_status integer);
+
+    CREATE VIEW IF NOT EXISTS crawl_result AS {rows};
+
+    CREATE TRIGGER IF NOT EXISTS crawl_result_insert INSTEAD OF INSERT ON crawl_result
+    BEGIN
+        {intern}
+        INSERT INTO crawl_result_row VALUES
+            (NEW.initial_url,
+             NEW.identifier,
+             (SELECT id FROM result_domain WHERE domain = NEW.initial_domain),
+             (SELECT id FROM result_value WHERE value = NEW.breadcrumbs),
+             NEW.final_url,
+             (SELECT id FROM result_domain WHERE domain = NEW.final_domain),
+             NEW.final_timestamp,
+             (SELECT id FROM result_value WHERE value = NEW.final_status_code),
+             sha1_blob(NEW.final_sha1),
+             (SELECT id FROM result_value WHERE value = NEW.final_mimetype),
+             NEW.final_was_dedupe,
+             NEW.hit,
+             (SELECT id FROM result_value WHERE value = NEW.postproc_status));
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS crawl_result_update INSTEAD OF UPDATE ON crawl_result
+    BEGIN
+        {intern}
+        UPDATE crawl_result_row SET
+            initial_url = NEW.initial_url,
+            identifier = NEW.identifier,
+            initial_domain = (SELECT id FROM result_domain WHERE domain = NEW.initial_domain),
+            breadcrumbs = (SELECT id FROM result_value WHERE value = NEW.breadcrumbs),
+            final_url = NEW.final_url,
+            final_domain = (SELECT id FROM result_domain WHERE domain = NEW.final_domain),
+            final_timestamp = NEW.final_timestamp,
+            final_status_code = (SELECT id FROM result_value WHERE value = NEW.final_status_code),
+            final_sha1 = sha1_blob(NEW.final_sha1),
+            final_mimetype = (SELECT id FROM result_value WHERE value = NEW.final_mimetype),
+            final_was_dedupe = NEW.final_was_dedupe,
+            hit = NEW.hit,
+            postproc_status = (SELECT id FROM result_value WHERE value = NEW.postproc_status)
+        {match}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS crawl_result_delete INSTEAD OF DELETE ON crawl_result
+    BEGIN
+        DELETE FROM crawl_result_row
+        {match}
+    END;
+""".format(
+    rows=COMPACT_RESULT_SELECT.format(sha1="CASE WHEN typeof(r.final_sha1) = 'blob' THEN {} ELSE r.final_sha1 END".format(
+        sha1_base32_sql('r.final_sha1'))).strip(),
+    intern=COMPACT_RESULT_INTERN,
+    match=COMPACT_RESULT_MATCH)
+
+# crawl_result columns, for the plain table and staging tables
+RESULT_COLUMNS = """
+    (initial_url text NOT NULL,
+     identifier text,
+     initial_domain text,
+     breadcrumbs text,
+     final_url text,
+     final_domain text text,
+     final_timestamp text,
+     final_status_code text,
+     final_sha1 text,
+     final_mimetype text,
+     final_was_dedupe bool,
+     hit bool,
+     postproc_status text)
+"""
+
+# moves temp.result_staging rows to crawl_result_row, in order (see
+# insert_result_rows)
+COMPACT_RESULT_ENCODE = """
+    INSERT OR IGNORE INTO result_domain (domain)
+        SELECT initial_domain FROM result_staging WHERE initial_domain IS NOT NULL
+        UNION SELECT final_domain FROM result_staging WHERE final_domain IS NOT NULL;
+    INSERT OR IGNORE INTO result_value (value)
+        SELECT breadcrumbs FROM result_staging WHERE breadcrumbs IS NOT NULL
+        UNION SELECT final_status_code FROM result_staging WHERE final_status_code IS NOT NULL
+        UNION SELECT final_mimetype FROM result_staging WHERE final_mimetype IS NOT NULL
+        UNION SELECT postproc_status FROM result_staging WHERE postproc_status IS NOT NULL;
+    INSERT INTO crawl_result_row
+        SELECT t.initial_url, t.identifier, di.id, b.id, t.final_url, df.id, t.final_timestamp,
+               s.id, sha1_blob(t.final_sha1), m.id, t.final_was_dedupe, t.hit, p.id
+        FROM result_staging t
+        LEFT JOIN result_domain di ON di.domain = t.initial_domain
+        LEFT JOIN result_value b ON b.value = t.breadcrumbs
+        LEFT JOIN result_domain df ON df.domain = t.final_domain
+        LEFT JOIN result_value s ON s.value = t.final_status_code
+        LEFT JOIN result_value m ON m.value = t.final_mimetype
+        LEFT JOIN result_value p ON p.value = t.postproc_status
+        ORDER BY t.rowid;
+    DROP TABLE temp.result_staging;
+"""
+
+def is_compact_output(db):
+    return list(db.execute("SELECT type FROM sqlite_master WHERE name='crawl_result'")) == [('view',)]
+
+def result_rows_table(db):
+    """
+    The table crawl_result rows are actually stored in (with rowids, and the
+    same initial_url and identifier columns): crawl_result_row for compact
+    outputs, where crawl_result is a view.
+    """
+    return 'crawl_result_row' if is_compact_output(db) else 'crawl_result'
+
+RESULT_INDEX_COLUMNS = ('initial_url', 'identifier', 'final_sha1')
+
+def create_result_indexes(db, columns=RESULT_INDEX_COLUMNS):
+    for column in columns:
+        db.execute("CREATE INDEX IF NOT EXISTS result_{0} on {1} ({0})".format(column, result_rows_table(db)))
+
+class ResultWriter:
+    """
+    Inserts crawl_result rows. For compact outputs, values are interned here
+    (like CompactMapWriter) and rows written straight to crawl_result_row,
+    instead of running the view's INSERT trigger for every row.
+    """
+
+    def __init__(self, output_db):
+        self.db = output_db
+        self.cursor = output_db.cursor()
+        self.compact = is_compact_output(output_db)
+        if self.compact:
+            self.domain_ids = dict((domain, did) for did, domain in output_db.execute('SELECT id, domain FROM result_domain'))
+            self.value_ids = dict((value, vid) for vid, value in output_db.execute('SELECT id, value FROM result_value'))
+
+    def intern(self, ids, table, column, value):
+        if value is None:
+            return None
+        vid = ids.get(value)
+        if vid is None:
+            # (the view's triggers, or postprocess, may have added it since)
+            self.cursor.execute("INSERT OR IGNORE INTO {} ({}) VALUES (?)".format(table, column), [value])
+            vid = ids[value] = self.cursor.execute("SELECT id FROM {} WHERE {} = ?".format(table, column), [value]).fetchone()[0]
+        return vid
+
+    def encode(self, row):
+        row = list(row)
+        # initial_domain, final_domain
+        for i in (2, 5):
+            row[i] = self.domain_ids.get(row[i]) or self.intern(self.domain_ids, 'result_domain', 'domain', row[i])
+        # breadcrumbs, final_status_code, final_mimetype, postproc_status
+        for i in (3, 7, 9, 12):
+            row[i] = self.value_ids.get(row[i]) or self.intern(self.value_ids, 'result_value', 'value', row[i])
+        row[8] = sha1_blob(row[8])
+        return row
+
+    def insert(self, row):
+        if self.compact:
+            self.cursor.execute("INSERT INTO crawl_result_row VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", self.encode(row))
+        else:
+            self.cursor.execute("INSERT INTO crawl_result VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", row)
+
+    def insert_many(self, rows):
+        if self.compact:
+            self.cursor.executemany("INSERT INTO crawl_result_row VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", [self.encode(row) for row in rows])
+        else:
+            self.cursor.executemany("INSERT INTO crawl_result VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+
+def insert_result_rows(output_db, select, params=()):
+    """
+    INSERT INTO crawl_result <select>, for set-based writers. For compact
+    outputs, rows are staged in a temp table, then interned and moved to
+    crawl_result_row with a few set-based statements (COMPACT_RESULT_ENCODE),
+    instead of running the view's INSERT trigger for every row.
+    """
+    if not is_compact_output(output_db):
+        output_db.execute("INSERT INTO crawl_result " + select, params)
+        return
+    output_db.executescript("""
+        DROP TABLE IF EXISTS temp.result_staging;
+        CREATE TEMP TABLE result_staging {};
+    """.format(RESULT_COLUMNS))
+    output_db.execute("INSERT INTO result_staging " + select, params)
+    output_db.executescript(COMPACT_RESULT_ENCODE)
+
+def create_out_table(db, compact=False):
+    """
+    With compact, a new output DB gets the compact format: rows are stored in
+    crawl_result_row, with status codes, mimetypes, breadcrumbs and
+    postproc_status as ids into result_value, domains as ids into
+    result_domain, and SHA-1s as 20-byte blobs. crawl_result is then a view
+    joining them back, so existing SQL (and report templates) work unchanged
+    from any sqlite3 client, except that view rows have no rowid, and
+    selecting final_sha1 through it is slow (see sha1_base32_sql). Writes
+    through the view go through INSTEAD OF triggers, which need the
+    functions from register_result_functions() (done here); arabesque's own
+    writers skip them (see ResultWriter and insert_result_rows).
+    """
+    register_result_functions(db)
+    existing = dict(db.execute("SELECT name, type FROM sqlite_master WHERE name='crawl_result'"))
+    if compact and existing.get('crawl_result') == 'table':
+        raise ValueError("output DB already has a plain (not compact) crawl_result table")
+    # "eat my data" style database, for speed
+    # NOTE: don't drop indexes here, because we often reuse DB
+    # NOTE: keep WAL mode (set for incremental runs, which need to survive
+    # being interrupted), without exclusive locking, so reports can read the
+    # output while it's being written (eg, by follow)
+    if db.execute("PRAGMA main.journal_mode").fetchone()[0] != 'wal':
+        db.execute("PRAGMA main.journal_mode = MEMORY")
+        db.execute("PRAGMA main.locking_mode = EXCLUSIVE")
+    db.executescript("""
+        PRAGMA main.page_size = 4096;
+        PRAGMA main.cache_size = 20000;
+        PRAGMA main.synchronous = OFF;
+    """)
+    if compact and not existing:
+        db.executescript(COMPACT_RESULT_SCHEMA)
+    # (a no-op if crawl_result is a compact view)
+    db.execute("CREATE TABLE IF NOT EXISTS crawl_result " + RESULT_COLUMNS)
+
+def test_compact_output():
+    seeds = "http://a.com/1\t10.123/a\nhttp://b.com/x\t10.123/b\nhttp://c.com/missing\t10.123/c\n"
+    sha1 = 'VYW6LDSTKNL5ZGDKVL5NTFLYF6LDHNDG'
+    results = []
+    for compact in (False, True):
+        output_db = sqlite3.connect(':memory:')
+        create_out_table(output_db, compact=compact)
+        bcounts, fcounts, rows = run_test_chain(seeds, output_db=output_db)
+        # through the view's triggers
+        output_db.execute("UPDATE crawl_result SET final_sha1 = ? WHERE identifier = '10.123/a'", [sha1])
+        output_db.execute("INSERT INTO crawl_result (initial_url, final_domain, final_mimetype, hit) VALUES ('http://d.com/', 'd.com', 'text/html', 0)")
+        pcounts = postprocess(io.StringIO("sha1:{}\t200\n".format(sha1)), output_db)
+        summarize(output_db)
+        query = COMPACT_RESULT_ROWS + " ORDER BY r.rowid" if compact else "SELECT * FROM crawl_result ORDER BY rowid"
+        results.append((bcounts, fcounts, pcounts, list(output_db.execute(query)),
+            sorted(output_db.execute("SELECT * FROM crawl_result"), key=repr),
+            [list(output_db.execute("SELECT * FROM " + table)) for table in ('summary_totals', 'summary_cube')], rows))
+    assert results[0][:5] == results[1][:5]
+    assert results[0][6] == results[1][6]
+    # (apart from the update time)
+    assert [row[:-1] for row in results[0][5][0]] == [row[:-1] for row in results[1][5][0]]
+    assert sorted(results[0][5][1], key=repr) == sorted(results[1][5][1], key=repr)
+    assert is_compact_output(output_db)
+    assert any(row[12] == '200' for row in results[1][3])
+    assert output_db.execute("SELECT length(final_sha1) FROM crawl_result_row WHERE identifier = '10.123/a'").fetchone()[0] == 20
+    # each distinct value is stored once
+    assert output_db.execute("SELECT COUNT(*) FROM result_value WHERE value = '200'").fetchone()[0] == 1
+    # set-based writers
+    copy_db = sqlite3.connect(':memory:')
+    create_out_table(copy_db, compact=True)
+    copy_db.execute("CREATE TEMP TABLE plain_rows " + RESULT_COLUMNS)
+    copy_db.executemany("INSERT INTO plain_rows VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", results[0][3])
+    insert_result_rows(copy_db, "SELECT * FROM plain_rows ORDER BY rowid")
+    assert list(copy_db.execute(COMPACT_RESULT_ROWS + " ORDER BY r.rowid")) == results[0][3]
+    output_db.execute("DELETE FROM crawl_result WHERE hit = 0")
+    assert list(output_db.execute("SELECT COUNT(*) FROM crawl_result_row WHERE hit = 0")) == [(0,)]
+    plain_db = sqlite3.connect(':memory:')
+    create_out_table(plain_db)
+    try:
+        create_out_table(plain_db, compact=True)
+        assert False
+    except ValueError:
+        pass
+
+BackwardHit = collections.namedtuple('BackwardHit', [
+    'url',
+    'timestamp',
+    'sha1'])
+
+def is_backward_hit(line, counts, hit_mimetypes=FULLTEXT_MIMETYPES):
+    """
+    Checks whether a (non-prereq) crawl log line is an in-scope terminal hit
+    for backward resolution; counts the reason if not.
+    """
+    if not (line.status_code in ("200", "226") and line.mimetype in hit_mimetypes):
+        counts['skip-log-scope'] += 1
+        return False
+
+    if line.mimetype == "application/octet-stream" and int(line.size_bytes) < 1000:
+        counts['skip-tiny-octetstream'] += 1
+        return False
+
+    if int(line.size_bytes) == 0 or line.sha1 == "3I42H3S6NNFQ2MSVX7XZKYAYSCX5QBYJ":
+        counts['skip-empty-file'] += 1
+        return False
+    return True
+
+MAP_INDEX_PRAGMAS = """
+    PRAGMA temp_store = MEMORY;
+    PRAGMA main.cache_size = -262144;
+"""
+
+MAP_INDEXES = """
+    CREATE INDEX IF NOT EXISTS referrer_url on referrer (url);
+    CREATE INDEX IF NOT EXISTS referrer_referrer on referrer (referrer);
+"""
+
+# decoded (url, referrer, status_code, breadcrumbs, mimetype, is_dedupe) rows
+# of a compact map; also the 'referrer' view, so ad-hoc queries still work
+COMPACT_MAP_ROWS = """
+    SELECT u.url AS url, p.url AS referrer, s.value AS status_code,
+           b.value AS breadcrumbs, m.value AS mimetype, r.is_dedupe AS is_dedupe
+    FROM referrer_row r
+    JOIN map_url u ON u.id = r.url_id
+    LEFT JOIN map_url p ON p.id = r.referrer_id
+    JOIN map_value s ON s.id = r.status_code_id
+    JOIN map_value b ON b.id = r.breadcrumbs_id
+    JOIN map_value m ON m.id = r.mimetype_id
+"""
+
+COMPACT_MAP_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS map_url
+             (id INTEGER PRIMARY KEY,
+              url text NOT NULL);
+    CREATE TABLE IF NOT EXISTS map_value
+             (id INTEGER PRIMARY KEY,
+              value text);
+    CREATE TABLE IF NOT EXISTS referrer_row
+             (url_id int,
+              referrer_id int,
+              status_code_id int,
+              breadcrumbs_id int,
+              mimetype_id int,
+              is_dedupe bool);
+    CREATE VIEW IF NOT EXISTS referrer AS {};
+    DROP INDEX IF EXISTS map_url_url;
+    DROP INDEX IF EXISTS referrer_row_url;
+    DROP INDEX IF EXISTS referrer_row_referrer;
+""".format(COMPACT_MAP_ROWS)
+
+COMPACT_MAP_INDEXES = """
+    CREATE UNIQUE INDEX IF NOT EXISTS map_url_url on map_url (url);
+    CREATE INDEX IF NOT EXISTS referrer_row_url on referrer_row (url_id);
+    CREATE INDEX IF NOT EXISTS referrer_row_referrer on referrer_row (referrer_id);
+"""
+
+def is_compact_map(map_db):
+    return bool(list(map_db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='map_url'")))
+
+class CompactMapWriter:
+    """
+    Interns URLs and attribute values to integer ids for a compact map,
+    writing new ones to map_url and map_value on flush(). A '-' or empty
+    referrer is stored as NULL.
+    """
+
+    def __init__(self, map_db):
+        self.db = map_db
+        self.url_ids = dict((url, uid) for uid, url in map_db.execute('SELECT id, url FROM map_url'))
+        self.value_ids = dict((value, vid) for vid, value in map_db.execute('SELECT id, value FROM map_value'))
+        self.new_urls = []
+        self.new_values = []
+
+    def url_id(self, url):
+        if not url or url == '-':
+            return None
+        uid = self.url_ids.get(url)
+        if uid is None:
+            uid = self.url_ids[url] = len(self.url_ids) + 1
+            self.new_urls.append((uid, url))
+        return uid
+
+    def value_id(self, value):
+        vid = self.value_ids.get(value)
+        if vid is None:
+            vid = self.value_ids[value] = len(self.value_ids) + 1
+            self.new_values.append((vid, value))
+        return vid
+
+    def encode(self, row):
+        url, referrer_url, status_code, breadcrumbs, mimetype, is_dedupe = row
+        return (self.url_id(url), self.url_id(referrer_url), self.value_id(status_code),
+                self.value_id(breadcrumbs), self.value_id(mimetype), is_dedupe)
+
+    def flush(self):
+        if self.new_urls:
+            self.db.executemany("INSERT INTO map_url VALUES (?,?)", self.new_urls)
+            self.new_urls = []
+        if self.new_values:
+            self.db.executemany("INSERT INTO map_value VALUES (?,?)", self.new_values)
+            self.new_values = []
+
+def referrer(log_file, map_db, hit_mimetypes=None, bulk=False, batch_size=50000, staging_tsv=None, compact=False, pipeline=False, cache_size=20000):
+    """
+    If hit_mimetypes is passed, also collects backward() candidate hits in the
+    same pass, so a log only needs to be read and parsed once; returns a
+    (hits, counts) tuple for backward_hits() in that case.
+
+    In bulk mode, rows are inserted with large executemany() batches inside a
+    single transaction, and indexes are built with a big page cache and
+    in-memory temp store (for the sorter). Rows are *not* re-sorted before
+    insert: rowid order is what makes lookup_referrer_row() return the first
+    crawl of a URL.
+
+    If staging_tsv is a path, the parsed map rows are written there as TSV
+    instead of being inserted, for import with the sqlite3 command line tool
+    (which is faster still); the commands to do so are printed at the end.
+    Fields with quotes, tabs or newlines are quoted CSV-style, which is what
+    the sqlite3 tool's .import expects.
+
+    In compact mode, URLs are interned in a map_url (id, url) table, status,
+    breadcrumbs and mimetype in a map_value table, and map rows (referrer_row)
+    are all integer ids, which makes the map DB much smaller. A 'referrer'
+    view decodes rows for ad-hoc queries; open_map() picks the format.
+
+    With pipeline, lines are parsed in a separate thread (see PipelineStage)
+    and rows inserted here with executemany(), committing every batch_size
+    rows (or only at the end, in bulk mode).
+
+    cache_size is the map's page cache, as for PRAGMA cache_size (pages, or
+    KiB if negative); see plan_map_db().
+    """
+    print("Mapping referrers from crawl logs")
+    hits = []
+    counts = collections.Counter({'inserted': 0})
+    existing = dict(map_db.execute("SELECT name, type FROM sqlite_master WHERE name='referrer'"))
+    if existing.get('referrer') == ('table' if compact else 'view'):
+        raise ValueError("map DB already has a {} referrer map".format('plain' if compact else 'compact'))
+    if compact and staging_tsv:
+        raise ValueError("--staging-tsv only writes plain referrer maps")
+    if pipeline and staging_tsv:
+        raise ValueError("--staging-tsv can't be combined with pipeline mode")
+    # "eat my data" style database, for speed
+    map_db.executescript("""
+        PRAGMA main.page_size = 4096;
+        PRAGMA main.cache_size = {};
+        PRAGMA main.locking_mode = EXCLUSIVE;
+        PRAGMA main.synchronous = OFF;
+        PRAGMA main.journal_mode = MEMORY;
+    """.format(int(cache_size)))
+    if compact:
+        map_db.executescript(COMPACT_MAP_SCHEMA)
+        writer = CompactMapWriter(map_db)
+        insert_sql = "INSERT INTO referrer_row VALUES (?,?,?,?,?,?)"
+    else:
+        map_db.executescript("""
+            CREATE TABLE IF NOT EXISTS referrer
+                     (url text,
+                      referrer text,
+                      status_code text,
+                      breadcrumbs text,
+                      mimetype text,
+                      is_dedupe bool);
+            DROP INDEX IF EXISTS referrer_url;
+            DROP INDEX IF EXISTS referrer_referrer;
+        """)
+        insert_sql = "INSERT INTO referrer VALUES (?,?,?,?,?,?)"
+    c = map_db.cursor()
+    tsv = None
+    if staging_tsv:
+        tsv_file = open(staging_tsv, 'w', newline='')
+        tsv = csv.writer(tsv_file, delimiter='\t', lineterminator='\n')
+    batch = []
+    start = time.time()
+    METRICS.start_stage('referrer', log_file)
+    parse = METRICS.timed('parse', parse_crawl_line)
+    insert = METRICS.timed('insert', c.execute)
+    insert_many = METRICS.timed('insert', c.executemany)
+    commit = METRICS.timed('commit', map_db.commit)
+    check_hit = METRICS.timed('filter', is_backward_hit)
+    lines = 0
+    i = 0
+    if pipeline:
+        parse_stage = PipelineStage('parse', functools.partial(parse_referrer_batch, hit_mimetypes=hit_mimetypes), batched(log_file, 2000))
+        uncommitted = 0
+        for rows, batch_hits, batch_counts, batch_lines in parse_stage:
+            if compact:
+                rows = [writer.encode(row) for row in rows]
+            insert_many(insert_sql, rows)
+            hits.extend(batch_hits)
+            counts.update(batch_counts)
+            lines += batch_lines
+            i += len(rows)
+            uncommitted += len(rows)
+            if uncommitted >= batch_size:
+                uncommitted = 0
+                METRICS.progress('referrer', i)
+                if not bulk:
+                    if compact:
+                        writer.flush()
+                    commit()
+        report_pipeline('referrer', [parse_stage], start)
+    else:
+        for raw in log_file:
+            lines += 1
+            line = parse(raw)
+            if not line:
+                warn('bad-log-line', "BAD LOG LINE: {}".format(raw.strip()))
+                continue
+            if line.url.startswith('dns:') or line.url.startswith('whois:'):
+                #print("skipping: {}".format(line.url))
+                counts['skip-log-prereq'] += 1
+                continue
+            is_dedupe = 'duplicate:digest' in line.annotations
+            # insert {url, referrer, status_code, breadcrumbs, mimetype, is_dedupe}
+            row = (line.url, line.referrer_url, line.status_code, line.breadcrumbs, line.mimetype, is_dedupe)
+            if compact:
+                row = writer.encode(row)
+            if tsv:
+                tsv.writerow(row[:5] + (int(is_dedupe),))
+            elif bulk:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    insert_many(insert_sql, batch)
+                    batch = []
+            else:
+                insert(insert_sql, row)
+            if hit_mimetypes and check_hit(line, counts, hit_mimetypes):
+                hits.append(BackwardHit(line.url, line.timestamp, line.sha1))
+            i = i+1
+            if bulk or tsv:
+                if i % batch_size == 0:
+                    METRICS.progress('referrer', i)
+            elif i % 5000 == 0:
+                METRICS.progress('referrer', i)
+                if compact:
+                    writer.flush()
+                commit()
+
+    if batch:
+        insert_many(insert_sql, batch)
+    if compact:
+        writer.flush()
+    commit()
+    METRICS.finish_stage('referrer', rows=i, counts=counts)
+    elapsed = time.time() - start
+    print("Ingested {} lines ({} map rows) in {:.1f}s: {:.0f} lines/sec".format(
+        lines, i, elapsed, lines / max(elapsed, 0.001)))
+
+    if tsv:
+        tsv_file.close()
+        c.close()
+        print("Wrote map rows to {}; to import and index:".format(staging_tsv))
+        print("    sqlite3 <map.sqlite> '.mode tabs' '.import {} referrer'{}".format(
+            staging_tsv, ''.join(" '{}'".format(stmt.strip()) for stmt in MAP_INDEXES.strip().split('\n'))))
+        if hit_mimetypes:
+            return hits, counts
+        return
+
+    print("Building indices (this can be slow)...")
+    start = time.time()
+    with METRICS.phase('index-build'):
+        if bulk:
+            c.executescript(MAP_INDEX_PRAGMAS)
+        c.executescript(COMPACT_MAP_INDEXES if compact else MAP_INDEXES)
+    print("Built indices in {:.1f}s".format(time.time() - start))
+    c.close()
+    print("Referrer map complete.")
+    if hit_mimetypes:
+        print("Collected {} candidate backward hits".format(len(hits)))
+        return hits, counts
+
+def test_referrer_bulk(tmp_path):
+    import shlex
+    import shutil
+    import subprocess
+    # quotes in fields have to survive the staging TSV
+    log = TEST_CRAWL_LOG + TEST_CRAWL_LOG.splitlines()[0].replace('http://a.com/1 - -', 'http://a.com/"q" - "http://a.com/1') + "\n"
+    query = 'SELECT * FROM referrer ORDER BY rowid'
+    normal_db, bulk_db = sqlite3.connect(':memory:'), sqlite3.connect(':memory:')
+    referrer(io.StringIO(log), normal_db)
+    referrer(io.StringIO(log), bulk_db, bulk=True, batch_size=3)
+    rows = list(normal_db.execute(query))
+    assert list(bulk_db.execute(query)) == rows
+    assert rows[-1][:2] == ('http://a.com/"q"', '"http://a.com/1')
+
+    map_path, tsv_path = str(tmp_path / 'map.sqlite'), str(tmp_path / 'map.tsv')
+    map_db = sqlite3.connect(map_path)
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        referrer(io.StringIO(log), map_db, staging_tsv=tsv_path)
+    map_db.close()
+    with open(tsv_path) as f:
+        assert list(csv.reader(f, delimiter='\t')) == [[str(v) for v in row] for row in rows]
+    if shutil.which('sqlite3'):
+        command = [line for line in out.getvalue().splitlines() if line.strip().startswith('sqlite3 ')][0]
+        subprocess.run([map_path if arg == '<map.sqlite>' else arg for arg in shlex.split(command)], check=True)
+        assert list(sqlite3.connect(map_path).execute(query)) == rows
+
+def referrer_incremental(log_paths, map_db, batch_size=5000, index_threshold=0.25):
+    """
+    Appends only crawl log lines not already in the map (per file, by
+    offset; see IngestLog), so a growing crawl doesn't need a full rebuild,
+    and an interrupted run resumes where it stopped. Uses a rollback journal
+    (WAL) instead of the "eat my data" settings, so an interrupted run leaves
+    a consistent map behind.
+
+    The indexes are kept (and updated as rows go in) when the new input is
+    small compared to what has already been read (index_threshold), and
+    otherwise dropped and rebuilt at the end, like referrer().
+    """
+    print("Mapping referrers from crawl logs (incremental)")
+    counts = collections.Counter({'inserted': 0})
+    if is_compact_map(map_db):
+        raise ValueError("incremental mode needs a plain (not compact) referrer map")
+    map_db.executescript("""
+        PRAGMA main.page_size = 4096;
+        PRAGMA main.cache_size = 20000;
+        PRAGMA main.locking_mode = EXCLUSIVE;
+        PRAGMA main.journal_mode = WAL;
+        PRAGMA main.synchronous = NORMAL;
+
+        CREATE TABLE IF NOT EXISTS referrer
+                 (url text,
+                  referrer text,
+                  status_code text,
+                  breadcrumbs text,
+                  mimetype text,
+                  is_dedupe bool);
+    """)
+    progress = IngestLog(map_db, 'referrer')
+    has_rows = bool(list(map_db.execute("SELECT 1 FROM referrer LIMIT 1")))
+    if has_rows and not progress.any_recorded():
+        raise ValueError("map already has rows from a non-incremental run; rebuild it with --incremental")
+    log_paths = expand_input_paths(log_paths)
+    pending = progress.pending_bytes(log_paths)
+    already = progress.read_bytes(log_paths)
+    indexes = [r[0] for r in map_db.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='referrer'")]
+    keep_indexes = len(indexes) == 2 and pending <= index_threshold * already
+    if keep_indexes:
+        print("Keeping indexes ({:.1f} MB new vs {:.1f} MB already read)".format(pending / 2**20, already / 2**20))
+    else:
+        map_db.executescript("""
+            DROP INDEX IF EXISTS referrer_url;
+            DROP INDEX IF EXISTS referrer_referrer;
+        """)
+    map_db.commit()
+
+    c = map_db.cursor()
+    METRICS.start_stage('referrer')
+    parse = METRICS.timed('parse', parse_crawl_line)
+    insert_many = METRICS.timed('insert', c.executemany)
+    commit = METRICS.timed('commit', map_db.commit)
+    batch = []
+    i = 0
+    for raw, is_new in progress.lines(log_paths):
+        line = parse(raw)
+        if not line:
+            warn('bad-log-line', "BAD LOG LINE: {}".format(raw.strip()))
+            continue
+        if line.url.startswith('dns:') or line.url.startswith('whois:'):
+            counts['skip-log-prereq'] += 1
+            continue
+        is_dedupe = 'duplicate:digest' in line.annotations
+        batch.append((line.url, line.referrer_url, line.status_code, line.breadcrumbs, line.mimetype, is_dedupe))
+        i = i+1
+        if len(batch) >= batch_size:
+            insert_many("INSERT INTO referrer VALUES (?,?,?,?,?,?)", batch)
+            batch = []
+            progress.checkpoint()
+            commit()
+            METRICS.progress('referrer', i)
+    if batch:
+        insert_many("INSERT INTO referrer VALUES (?,?,?,?,?,?)", batch)
+    # also commits offsets recorded after the last batch (eg, end of file)
+    commit()
+    counts['inserted'] = i
+    METRICS.finish_stage('referrer', rows=i, counts=counts)
+    print("Appended {} map rows".format(i))
+
+    if not keep_indexes:
+        print("Building indices (this can be slow)...")
+        with METRICS.phase('index-build'):
+            c.executescript(MAP_INDEX_PRAGMAS)
+            c.executescript(MAP_INDEXES)
+    c.close()
+    print("Referrer map complete.")
+    print(counts)
+    return counts
+
+def get_incremental_state(db, name):
+    db.execute("CREATE TABLE IF NOT EXISTS incremental_state (name text PRIMARY KEY, value integer)")
+    rows = list(db.execute("SELECT value FROM incremental_state WHERE name=?", [name]))
+    return rows[0][0] if rows else None
+
+def set_incremental_state(db, name, value):
+    db.execute("INSERT OR REPLACE INTO incremental_state VALUES (?,?)", [name, value])
+
+@functools.lru_cache(maxsize=4096)
+def cdx_mimetype_in_scope(raw_mimetype, hit_mimetypes):
+    mimetype = normalize_mimetype(raw_mimetype.decode('utf-8', errors='replace'))
+    return mimetype in hit_mimetypes or mimetype == "warc/revisit"
+
+def scan_cdx_line(raw, counts, hit_mimetypes=FULLTEXT_MIMETYPES, shard=None):
+    """
+    Filters a raw (bytes) CDX line for backward_cdx(), returning a BackwardHit
+    or None. The shard selector (bytes) has to appear in the WARC filename
+    (last) field; status and (normalized, memoized) mimetype are checked on
+    the raw fields, so only in-scope lines get decoded and parsed.
+    """
+    if raw.startswith(b'CDX') or raw.startswith(b' '):
+        counts['skip-cdx-raw'] += 1
+        return None
+    if shard and shard not in raw.rsplit(b' ', 1)[-1]:
+        counts['skip-cdx-shard'] += 1
+        return None
+    fields = raw.split(b' ', 5)
+    if len(fields) < 6 or not ((fields[4] in (b'200', b'226') or fields[3] == b'warc/revisit')
+            and cdx_mimetype_in_scope(fields[3], hit_mimetypes)):
+        counts['skip-cdx-scope'] += 1
+        return None
+
+    cdx = parse_full_cdx_line(raw.decode('utf-8', errors='replace'))
+    if not cdx:
+        warn('bad-cdx-line', "BAD CDX LINE: {}".format(raw.strip()))
+        return None
+    if not ((cdx.status_code in ("200", "226") and cdx.mimetype in hit_mimetypes)
+            or (cdx.mimetype == "warc/revisit")):
+        counts['skip-cdx-scope'] += 1
+        return None
+    # CDX only has the compressed (WARC record) size
+    if cdx.mimetype == "application/octet-stream" and cdx.c_size.isdigit() and int(cdx.c_size) < 1000:
+        counts['skip-tiny-octetstream'] += 1
+        return None
+    return BackwardHit(cdx.url, cdx.datetime, cdx.sha1)
+
+def test_scan_cdx_line():
+    counts = collections.Counter()
+    lines = [
+        b" CDX N b a m s k r M S V g\n",
+        b"com,a)/3.pdf 20180727122622 http://a.com/3.pdf application/pdf 200 AAAA - - 9000 10 CRAWL-2018-07-20180727-svc282.warc.gz\n",
+        b"com,a)/3.pdf 20180727122622 http://a.com/3.pdf application/pdf 200 AAAA - - 9000 10 CRAWL-2018-07-20180727-svc279.warc.gz\n",
+        b"com,a)/3 20180727122622 http://a.com/3 text/html 200 BBBB - - 900 10 CRAWL-2018-07-20180727-svc282.warc.gz\n",
+        b"com,a)/4.pdf 20180727122622 http://a.com/4.pdf warc/revisit - CCCC - - 900 10 CRAWL-2018-07-20180727-svc282.warc.gz\n",
+        b"com,a)/5.pdf 20180727122622 http://a.com/5.pdf application/pdf 404 DDDD - - 900 10 CRAWL-2018-07-20180727-svc282.warc.gz\n",
+        b"com,a)/6.bin 20180727122622 http://a.com/6.bin application/octet-stream 200 EEEE - - 900 10 CRAWL-2018-07-20180727-svc282.warc.gz\n",
+    ]
+    hits = [scan_cdx_line(raw, counts, shard=b'svc282') for raw in lines]
+    assert hits == [None, BackwardHit('http://a.com/3.pdf', '20180727122622', 'AAAA'), None, None,
+        BackwardHit('http://a.com/4.pdf', '20180727122622', 'CCCC'), None, None]
+    assert counts == collections.Counter({'skip-cdx-raw': 1, 'skip-cdx-shard': 1, 'skip-cdx-scope': 2, 'skip-tiny-octetstream': 1})
+
+def iter_cdx_lines(path, start=0, end=None):
+    """
+    Yields raw (bytes) lines of a CDX file. With a byte range, yields the
+    lines that *start* in [start, end), so adjacent ranges split a file
+    without losing or repeating lines. Ranges only work on uncompressed files.
+    """
+    if path == '-':
+        yield from sys.stdin.buffer
+        return
+    if start or end is not None:
+        f = open(path, 'rb')
+    else:
+        f = open_decompressed(path)
+    try:
+        if start or end is not None:
+            if start:
+                # skip the line that started before the range
+                f.seek(start - 1)
+                f.readline()
+            position = f.tell()
+            while end is None or position < end:
+                raw = f.readline()
+                if not raw:
+                    break
+                position += len(raw)
+                yield raw
+        else:
+            yield from f
+    finally:
+        f.close()
+
+def cdx_byte_ranges(paths, workers):
+    """
+    Splits CDX inputs into about `workers` (path, start, end) jobs: byte
+    ranges of uncompressed files, or whole compressed files (can't seek).
+    """
+    paths = expand_input_paths(paths)
+    if '-' in paths:
+        raise ValueError("can't split stdin across workers")
+    plain = [p for p in paths if p != '-' and os.path.splitext(p)[1] not in ('.gz', '.bz2', '.xz', '.zst')]
+    jobs = [(p, 0, None) for p in paths if p not in plain]
+    total = sum(os.path.getsize(p) for p in plain)
+    chunk = max(total // max(workers - len(jobs), 1), 1)
+    for path in plain:
+        size = os.path.getsize(path)
+        for start in range(0, size, chunk):
+            jobs.append((path, start, start + chunk if start + chunk < size else None))
+    return jobs
+
+def test_cdx_byte_ranges(tmp_path):
+    lines = [b"a.com/1 x\n", b"\n", b"a.com/22 xx\n", b"a.com/333 xxx\n", b"b.com/4 no-newline"]
+    path = str(tmp_path / 'test.cdx')
+    with open(path, 'wb') as f:
+        f.write(b"".join(lines))
+    data = b"".join(lines)
+    newline = data.index(b"\n", 12)
+    # in a line, exactly on a newline, right after one, and the ends
+    for offsets in ([5], [newline], [newline + 1], [0, 1, 2], [len(data) - 1], [newline, newline + 1, newline + 2]):
+        bounds = [0] + offsets + [None]
+        split = [list(iter_cdx_lines(path, start, end)) for start, end in zip(bounds, bounds[1:])]
+        assert [raw for part in split for raw in part] == lines
+    for workers in range(1, len(data) + 2):
+        ranges = cdx_byte_ranges(path, workers)
+        assert [raw for p, start, end in ranges for raw in iter_cdx_lines(p, start, end)] == lines
+
+def db_path(db):
+    """
+    File name of a sqlite3 connection's main database ('' if in-memory).
+    """
+    return [row[2] for row in db.execute("PRAGMA database_list") if row[1] == 'main'][0]
+
+def run_backward_cdx_range(job):
+    """
+    Process pool worker for backward_cdx(): resolves one byte range of a CDX
+    into its own output DB. Returns counts.
+    """
+    path, start, end, map_path, out_path, hit_mimetypes, shard, map_engine, chain_cache_size = job
+    sys.stdout = PrefixedWriter(sys.stdout, "[{}:{}] ".format(os.path.basename(path), start))
+    counts = collections.Counter({'inserted': 0})
+    hits = (hit for hit in (scan_cdx_line(raw, counts, hit_mimetypes, shard) for raw in iter_cdx_lines(path, start, end)) if hit)
+    map_db = sqlite3.connect(map_path)
+    output_db = sqlite3.connect(out_path, isolation_level='EXCLUSIVE')
+    counts = backward_hits(hits, map_db, output_db, counts, hit_mimetypes=hit_mimetypes, map_engine=map_engine, chain_cache_size=chain_cache_size, source=path)
+    output_db.close()
+    map_db.close()
+    return counts
+
+def backward_cdx(cdx_file, map_db, output_db, hit_mimetypes=FULLTEXT_MIMETYPES, shard=None, workers=1, map_engine='sqlite', chain_cache_size=1000000):
+    """
+    Variant of backward() that takes terminal hits from a CDX instead of the
+    crawl log. CDX files usually cover the whole crawl, not one machine, so
+    `shard` (eg, 'wbgrp-svc282') selects lines by WARC filename; lines are
+    filtered on raw bytes before any parsing (see scan_cdx_line). To consume
+    a crawl-wide CDX once for all shards, build one map from all the shard
+    logs and leave out `shard`.
+
+    With workers > 1, uncompressed CDX files are split by byte range across a
+    process pool, each worker writing to its own output DB next to the output
+    (map and output have to be files), which are then combined.
+    """
+    print("Mapping backward from CDX 200/226 to initial urls")
+    counts = collections.Counter({'inserted': 0})
+    shard = shard.encode('utf-8') if shard else None
+    if workers <= 1:
+        hits = (hit for hit in (scan_cdx_line(raw, counts, hit_mimetypes, shard) for path in expand_input_paths(cdx_file) for raw in iter_cdx_lines(path)) if hit)
+        return backward_hits(hits, map_db, output_db, counts, hit_mimetypes=hit_mimetypes, map_engine=map_engine, chain_cache_size=chain_cache_size)
+
+    map_path, out_path = db_path(map_db), db_path(output_db)
+    if not (map_path and out_path):
+        raise ValueError("backward_cdx with workers needs on-disk map and output DBs")
+    jobs = []
+    for i, (path, start, end) in enumerate(cdx_byte_ranges(cdx_file, workers)):
+        part_path = "{}.part{}".format(out_path, i)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        jobs.append((path, start, end, map_path, part_path, hit_mimetypes, shard, map_engine, chain_cache_size))
+    if map_engine == 'mmap':
+        # build it once, before the workers all try to
+        open_map(map_db, 'mmap').close()
+    print("Processing {} CDX ranges with {} processes".format(len(jobs), workers))
+    with multiprocessing.Pool(workers) as pool:
+        for part_counts in pool.imap_unordered(run_backward_cdx_range, jobs):
+            counts.update(part_counts)
+    combine_outputs([job[4] for job in jobs], output_db)
+    for job in jobs:
+        os.remove(job[4])
+    print("Backward map complete.")
+    print(counts)
+    return counts
+
+def scan_backward_lines(raw_lines, counts, hit_mimetypes=FULLTEXT_MIMETYPES):
+    """
+    Lean equivalent of parse_crawl_line() + the prereq and is_backward_hit()
+    checks, for backward(): returns the BackwardHits in a batch of log lines,
+    with the same counts (and BAD LOG LINE warnings).
+
+    Each line is split once and rejected on status before the mimetype is
+    normalized or any record built. Working on a batch saves a function call
+    per line, and skips are tallied in locals and added to counts at the end.
+    """
+    hits = []
+    prereq = scope = tiny = empty = 0
+    for raw in raw_lines:
+        # same test as parse_crawl_line(): exactly 13 whitespace-separated fields
+        fields = raw.split()
+        if len(fields) != 13:
+            warn('bad-log-line', "BAD LOG LINE: {}".format(raw.strip()))
+            continue
+        url = fields[3]
+        if url.startswith(('dns:', 'whois:')):
+            prereq += 1
+            continue
+        status_code = fields[1]
+        if status_code != '200' and status_code != '226':
+            scope += 1
+            continue
+        mimetype = fields[6]
+        # FTP success; need to munge mimetype
+        if status_code == '226' and mimetype == "application/octet-stream" and url.startswith('ftp://'):
+            if url.lower().endswith('.pdf'):
+                mimetype = "application/pdf"
+            elif url.lower().endswith('.ps'):
+                mimetype = "application/postscript"
+        mimetype = normalize_mimetype(mimetype)
+        if mimetype not in hit_mimetypes:
+            scope += 1
+            continue
+
+        size_bytes = int(fields[2])
+        if mimetype == "application/octet-stream" and size_bytes < 1000:
+            tiny += 1
+            continue
+
+        sha1 = fields[9].replace('sha1:', '')
+        if size_bytes == 0 or sha1 == "3I42H3S6NNFQ2MSVX7XZKYAYSCX5QBYJ":
+            empty += 1
+            continue
+        hits.append(BackwardHit(url, fields[8], sha1))
+    for name, n in (('skip-log-prereq', prereq), ('skip-log-scope', scope), ('skip-tiny-octetstream', tiny), ('skip-empty-file', empty)):
+        if n:
+            counts[name] += n
+    return hits
+
+def test_scan_backward_lines():
+    lines = TEST_CRAWL_LOG.splitlines(keepends=True) + [
+        "2018-07-27T12:26:24.783Z   200         24 http://www.phywe-es.com/robots.txt 15+LREELLLLLRLELLRLLLRLLLLRLELRRLLLLLLLLLLLLLLLLLLLLP http://www.phywe-es.com/index.php/fuseaction/download/lrn_file/versuchsanleitungen/P2522015/tr/P2522015.pdf text/html #296 20180727122622741+438 sha1:YR6M6GSJYJGMLBBEGCVHLRZO6SISSJAS - unsatisfiableCharsetInHeader:ISO 8859-1 {\"contentSize\":254}\n",
+        "2018-07-27T12:26:24.783Z   200         24 http://a.com/short.pdf - - application/pdf\n",
+        "2018-07-27T12:26:24.783Z     1         24 dns:a.com P http://a.com/ text/dns #296 20180727122622741+438 sha1:AAAA - - {}\n",
+        "2018-07-27T12:26:24.783Z   226       9999 ftp://a.com/x.PDF - - application/octet-stream #296 20180727122622741+438 sha1:BBBB - - {}\n",
+        "2018-07-27T12:26:24.783Z   200        999 http://a.com/tiny - - unknown #296 20180727122622741+438 sha1:CCCC - - {}\n",
+        "2018-07-27T12:26:24.783Z   200          0 http://a.com/empty.pdf - - application/pdf #296 20180727122622741+438 sha1:DDDD - - {}\n",
+        "2018-07-27T12:26:24.783Z   200       9999 http://a.com/\u00e9t\u00e9.pdf - - application/pdf #296 20180727122622741+438 sha1:EEEE - - {}\n",
+        "2018-07-27T12:26:24.783Z   200       9999 http://a.com/a\xa0b.pdf - - application/pdf #296 20180727122622741+438 sha1:EEEE - - {}\n",
+        "2018-07-27T12:26:24.783Z   200       9999 http://a.com/a\x1cb.pdf - - application/pdf #296 20180727122622741+438 sha1:EEEE - - {}\n",
+    ]
+    expected_counts = collections.Counter()
+    expected = []
+    for raw in lines:
+        line = parse_crawl_line(raw)
+        if not line:
+            expected.append(None)
+        elif line.url.startswith('dns:') or line.url.startswith('whois:'):
+            expected_counts['skip-log-prereq'] += 1
+            expected.append(None)
+        elif is_backward_hit(line, expected_counts):
+            expected.append(BackwardHit(line.url, line.timestamp, line.sha1))
+        else:
+            expected.append(None)
+    counts = collections.Counter()
+    assert scan_backward_lines(lines, counts) == [hit for hit in expected if hit]
+    assert counts == expected_counts
+
+def iter_backward_hits(log_file, counts, hit_mimetypes=FULLTEXT_MIMETYPES, batch_size=2000):
+    # the lean parser does filtering too, so this is 'parse' and 'filter'
+    scan = METRICS.timed('parse', scan_backward_lines)
+    for raw_lines in batched(log_file, batch_size):
+        yield from scan(raw_lines, counts, hit_mimetypes)
+
+def bench_parse(log_file, hit_mimetypes=FULLTEXT_MIMETYPES, limit=None):
+    """
+    Micro-benchmark for crawl log parsing in backward(): lines/sec for the full
+    parse_crawl_line() + filters vs scan_backward_lines(), and a check that
+    results and counts match. The lean scan was meant to be at least 2x
+    faster; the speedup is printed, and called out when it falls short.
+    """
+    raw_lines = []
+    for raw in log_file:
+        raw_lines.append(raw)
+        if limit and len(raw_lines) >= limit:
+            break
+    print("Benchmarking backward() log parsing with {} lines".format(len(raw_lines)))
+
+    def full(raw, counts):
+        line = parse_crawl_line(raw)
+        if not line:
+            warn('bad-log-line', "BAD LOG LINE: {}".format(raw.strip()))
+            return None
+        if line.url.startswith('dns:') or line.url.startswith('whois:'):
+            counts['skip-log-prereq'] += 1
+            return None
+        if is_backward_hit(line, counts, hit_mimetypes):
+            return BackwardHit(line.url, line.timestamp, line.sha1)
+
+    def run(name, func, lines, repeat=3):
+        # best of a few runs, since a single one is noisy
+        elapsed = None
+        for _ in range(repeat):
+            counts = collections.Counter()
+            normalize_mimetype.cache_clear()
+            start = time.perf_counter()
+            results = func(lines, counts)
+            elapsed = min(elapsed or float('inf'), max(time.perf_counter() - start, 0.000001))
+        print("{:>24}: {:.0f} lines/sec".format(name, len(lines) / elapsed))
+        return results, counts, elapsed
+
+    before = run('full parse', lambda lines, counts: [hit for hit in (full(raw, counts) for raw in lines) if hit], raw_lines)
+    after = run('lean', lambda lines, counts: scan_backward_lines(lines, counts, hit_mimetypes), raw_lines)
+    speedup = before[2] / after[2]
+    print("{:>24}: {:.1f}x{}".format('speedup', speedup, '' if speedup >= 2 else " (short of the 2x target)"))
+    ok = before[:2] == after[:2]
+    print("results match: {}".format(ok))
+    return ok
+
+def backward(log_file, map_db, output_db, hit_mimetypes=FULLTEXT_MIMETYPES, map_engine='sqlite', chain_cache_size=1000000, workers=1, pipeline=False):
+    """
+    This is a variant of backward_cdx that uses the log files, not CDX file
+
+    With workers > 1, log lines are scanned and resolved by a pool of
+    processes with the map opened read-only (see parallel_backward_rows);
+    this process does all the writes, in log order.
+
+    With pipeline, scanning, resolution and writes run as separate threads
+    instead (see backward_pipelined).
+    """
+    print("Mapping backward from log file 200s to initial urls")
+    counts = collections.Counter({'inserted': 0})
+    if pipeline:
+        return backward_pipelined(log_file, map_db, output_db, counts, hit_mimetypes=hit_mimetypes, map_engine=map_engine, chain_cache_size=chain_cache_size)
+    if workers > 1:
+        return backward_parallel(log_file, map_db, output_db, counts, hit_mimetypes=hit_mimetypes, map_engine=map_engine, chain_cache_size=chain_cache_size, workers=workers)
+    hits = iter_backward_hits(log_file, counts, hit_mimetypes)
+    return backward_hits(hits, map_db, output_db, counts, hit_mimetypes=hit_mimetypes, map_engine=map_engine, chain_cache_size=chain_cache_size, source=log_file)
+
+def resolve_backward_hit(hit, lookup, walk, counts, hit_mimetypes=FULLTEXT_MIMETYPES):
+    """
+    Resolves one BackwardHit to a crawl_result row (tuple), or None (and
+    counts why). `lookup` and `walk` are a map engine's lookup_referrer_row
+    and walk_backward.
+    """
+    final_row = lookup(hit.url)
+    if not final_row:
+        warn('map-url-missing', "MISSING url: {}".format(hit.url))
+        counts['map-url-missing'] += 1
+        return None
+    if not (final_row.status_code in ("200", "226") and final_row.mimetype in hit_mimetypes):
+        counts['skip-map-scope'] += 1
+        return None
+    row = walk(final_row, counts)
+
+    initial_domain = url_host(row.url)
+    final_domain = url_host(final_row.url)
+    # convert to IA CDX timestamp format
+    #final_timestamp = dateutil.parser.parse(hit.timestamp).strftime("%Y%m%d%H%M%S")
+    final_timestamp = None
+    if len(hit.timestamp) >= 14 and hit.timestamp[4] != '-':
+        final_timestamp = hit.timestamp[:14]
+    #print(final_row.breadcrumbs)
+    return (row.url, None, initial_domain, final_row.breadcrumbs, final_row.url, final_domain, final_timestamp, final_row.status_code, hit.sha1, final_row.mimetype, final_row.is_dedupe, True, None)
+
+def backward_hits(hits, map_db, output_db, counts, hit_mimetypes=FULLTEXT_MIMETYPES, map_engine='sqlite', chain_cache_size=1000000, source=None, checkpoint=None):
+    """
+    Resolves (already filtered) BackwardHits to initial urls and inserts
+    crawl_result rows. `hits` can be a generator over a log file (backward) or
+    a buffer collected while building the map (referrer with hit_mimetypes).
+    If given, checkpoint() is called before each commit (see IngestLog).
+
+    Chain walks are memoized in a ChainCache of chain_cache_size URLs (0 to
+    disable), except on an in-memory RedirectGraph, where walks are already
+    cheaper than the cache.
+    """
+    m = open_map(map_db, map_engine)
+    walker = m
+    if chain_cache_size and not isinstance(m, RedirectGraph):
+        walker = ChainCache(m, chain_cache_size)
+    create_out_table(output_db)
+    writer = ResultWriter(output_db)
+    METRICS.start_stage('backward', source)
+    lookup = METRICS.timed('map-lookup', m.lookup_referrer_row)
+    walk = METRICS.timed('chain-walk', walker.walk_backward)
+    insert = METRICS.timed('insert', writer.insert)
+    commit = METRICS.timed('commit', output_db.commit)
+    i = 0
+    for hit in hits:
+        result = resolve_backward_hit(hit, lookup, walk, counts, hit_mimetypes)
+        if not result:
+            continue
+        insert(result)
+        i = i+1
+        counts['inserted'] += 1
+        if i % 2000 == 0:
+            METRICS.progress('backward', i)
+            if checkpoint:
+                checkpoint()
+            commit()
+
+    commit()
+    if m is not map_db:
+        m.close()
+    walks = counts['_chain-cache-hit'] + counts['_chain-cache-miss']
+    if walks:
+        print("Chain cache: {:.1f}% hits, {:.1f}% of misses stopped at a cached ancestor".format(
+            100. * counts['_chain-cache-hit'] / walks,
+            100. * counts['_chain-cache-ancestor-hit'] / max(counts['_chain-cache-miss'], 1)))
+    print("Building indices (this can be slow)...")
+    with METRICS.phase('index-build'):
+        create_result_indexes(output_db, ('initial_url', 'identifier'))
+    writer.cursor.close()
+    METRICS.finish_stage('backward', rows=i, counts=counts)
+    print("Backward map complete.")
+    print(counts)
+    return counts
+
+def backward_incremental(log_paths, map_db, output_db, hit_mimetypes=FULLTEXT_MIMETYPES, map_engine='sqlite', chain_cache_size=1000000):
+    """
+    Incremental variant of backward(), to run after referrer_incremental():
+    resolves hits only from log lines not read before (see IngestLog), and
+    re-resolves only the existing results whose chains changed.
+
+    New map rows can't change the lookup of a URL already in the map (the
+    first row wins), so the only way an old chain changes is if it stopped
+    because its top row's referrer wasn't in the map, and now is. Those
+    results get their initial_url (and identifier, until forward sets it
+    again) updated. Initial urls of new and changed rows are queued in
+    'incremental_seed' for forward_incremental().
+    """
+    print("Mapping backward from log file 200s to initial urls (incremental)")
+    counts = collections.Counter({'inserted': 0})
+    if output_db.execute("PRAGMA main.journal_mode = WAL").fetchone()[0] != 'wal':
+        raise ValueError("couldn't switch output database to WAL mode")
+    create_out_table(output_db)
+    output_db.execute("CREATE TABLE IF NOT EXISTS incremental_seed (url text PRIMARY KEY)")
+    progress = IngestLog(output_db, 'backward')
+    since_rowid = get_incremental_state(output_db, 'backward_map_rowid')
+    if since_rowid is None and list(output_db.execute("SELECT 1 FROM crawl_result LIMIT 1")):
+        raise ValueError("output already has rows from a non-incremental run; rebuild it with --incremental")
+    map_rowid = map_db.execute("SELECT COALESCE(MAX(rowid), 0) FROM referrer").fetchone()[0]
+    m = open_map(map_db, map_engine)
+    c = output_db.cursor()
+
+    if since_rowid:
+        print("Re-resolving chains extended by map rows after {}...".format(since_rowid))
+        mc = map_db.cursor()
+        new_urls = mc.execute("""
+            SELECT DISTINCT r.url FROM referrer r
+            WHERE r.rowid > ? AND NOT EXISTS
+                (SELECT 1 FROM referrer o WHERE o.url = r.url AND o.rowid <= ?)
+        """, [since_rowid, since_rowid]).fetchall()
+        for (new_url,) in new_urls:
+            for (top_url,) in map_db.execute("SELECT DISTINCT url FROM referrer WHERE referrer=?", [new_url]).fetchall():
+                top_row = m.lookup_referrer_row(top_url)
+                if not top_row or top_row.referrer_url != new_url:
+                    continue
+                for rowid, final_url in c.execute("SELECT rowid, final_url FROM crawl_result WHERE initial_url=? AND hit=1", [top_url]).fetchall():
+                    row = m.walk_backward(m.lookup_referrer_row(final_url), counts)
+                    if row.url == top_url:
+                        continue
+                    c.execute("UPDATE crawl_result SET initial_url=?, initial_domain=?, identifier=NULL WHERE rowid=?",
+                        [row.url, url_host(row.url), rowid])
+                    c.executemany("INSERT OR IGNORE INTO incremental_seed VALUES (?)", [[top_url], [row.url]])
+                    counts['chain-extended'] += 1
+        mc.close()
+        output_db.commit()
+
+    first_new_rowid = c.execute("SELECT COALESCE(MAX(rowid), 0) FROM crawl_result").fetchone()[0]
+    hits = iter_backward_hits((raw for raw, is_new in progress.lines(log_paths)), counts, hit_mimetypes)
+    counts = backward_hits(hits, m, output_db, counts, hit_mimetypes=hit_mimetypes, chain_cache_size=chain_cache_size, checkpoint=progress.checkpoint)
+    c.execute("""
+        INSERT OR IGNORE INTO incremental_seed
+            SELECT DISTINCT initial_url FROM crawl_result WHERE rowid > ? AND hit = 1
+    """, [first_new_rowid])
+    set_incremental_state(output_db, 'backward_map_rowid', map_rowid)
+    output_db.commit()
+    c.close()
+    if m is not map_db:
+        m.close()
+    return counts
+
+def parse_seed_line(raw_line, counts):
+    """
+    Parses and normalizes a seed_id TSV line. Returns (seed_url, identifier),
+    or None (and counts why) if the line should be skipped.
+    """
+    line = raw_line.strip().split('\t')
+    if not line:
+        counts['skip-raw-line'] += 1
+        return None
+    if len(line) == 1:
+        seed_url, identifier = line[0], None
+    elif len(line) == 2:
+        seed_url, identifier = line[0:2]
+    else:
+        warn('weird-seed-line', "WEIRD: {}".format(raw_line))
+        assert len(line) <= 2
+    raw_url = seed_url
+    seed_url = normalize_url(seed_url)
+    if not seed_url:
+        counts['skip-bad-seed-url'] += 1
+        return None
+    if raw_url != seed_url:
+        counts['_normalized-seed-url'] += 1
+    return seed_url, identifier
+
+def resolve_forward_seed(m, seed_url, identifier, counts):
+    """
+    Does a "forward" lookup from a seed for the "best"/"final" terminal crawl
+    line. Returns a crawl_result row (tuple), and whether the seed was found
+    in the map.
+    """
+    # simple for redirect case (no branching); arbitrary for the fan-out case
+    first_row = m.lookup_referrer_row(seed_url)
+    if not first_row:
+        #print("MISSING url: {}".format(seed_url))
+        # need to insert *something* in this case...
+        initial_domain = url_host(seed_url)
+        counts['map-url-missing'] += 1
+        return (seed_url, identifier, initial_domain, None, None, None, None, None, None, None, None, False, None), False
+    final_row = m.walk_forward(first_row, counts)
+    initial_domain = url_host(seed_url)
+    final_domain = url_host(final_row.url)
+    # TODO: would pass SHA1 here if we had it? but not stored in referrer table
+    # XXX: None => timestamp
+    #print(final_row.breadcrumbs)
+    return (seed_url, identifier, initial_domain, final_row.breadcrumbs, final_row.url, final_domain, None, final_row.status_code, None, final_row.mimetype, final_row.is_dedupe, False, None), True
+
+def forward_seed(m, writer, seed_url, identifier, counts):
+    """
+    resolve_forward_seed(), and inserts the crawl_result row with a
+    ResultWriter. Returns True if the seed was found in the map.
+    """
+    row, found = resolve_forward_seed(m, seed_url, identifier, counts)
+    writer.insert(row)
+    if found:
+        counts['inserted'] += 1
+    return found
+
+def forward(seed_id_file, map_db, output_db, map_engine='sqlite', set_based=False, checkpoint=None, workers=1, cte=False, pipeline=False):
+    """
+    With workers > 1, seeds are parsed and resolved by a pool of processes
+    with the map opened read-only (see parallel_forward_seeds); this process
+    still checks for existing rows and does all the writes, in seed order.
+
+    With cte, seeds are staged as in set_based mode and resolved with a
+    recursive query inside sqlite3 (see forward_cte); map_db has to be a
+    sqlite3 connection then.
+
+    With pipeline, seeds are parsed and resolved in threads feeding this one
+    (see pipelined_forward_seeds).
+    """
+    print("Mapping forwards from seedlist to terminal urls")
+    counts = collections.Counter({'inserted': 0})
+    set_based = set_based or cte
+    parallel = (workers > 1 or pipeline) and not set_based
+    if parallel:
+        if pipeline:
+            seeds = pipelined_forward_seeds(seed_id_file, map_db, counts, map_engine=map_engine)
+        else:
+            seeds = parallel_forward_seeds(seed_id_file, map_db, counts, map_engine=map_engine, workers=workers)
+        # only used for writes here
+        map_engine = 'sqlite'
+    m = open_map(map_db, map_engine)
+    create_out_table(output_db)
+    c = output_db.cursor()
+    writer = ResultWriter(output_db)
+    # (identifier and initial_url are stored as is in both formats)
+    table = result_rows_table(output_db)
+    METRICS.start_stage('forward', seed_id_file)
+    timed_m = TimedMap(m, METRICS) if METRICS.enabled else m
+
+    if set_based:
+        forward_set_based(seed_id_file, timed_m, output_db, counts, cte_map_db=map_db if cte else None)
+    else:
+        parse = METRICS.timed('parse', parse_seed_line)
+        # lookup and update of existing rows
+        query = METRICS.timed('result-lookup', c.execute)
+        commit = METRICS.timed('commit', output_db.commit)
+        if not parallel:
+            seeds = ((parse(raw_line, counts), None) for raw_line in seed_id_file)
+        i = 0
+        for seed, resolved in seeds:
+            if not seed:
+                continue
+            seed_url, identifier = seed
+
+            # first check if entry already in output table; if so, only upsert with identifier
+            existing_row = list(query('SELECT identifier from {} WHERE initial_url=? LIMIT 1'.format(table), [seed_url]))
+            if existing_row:
+                if not existing_row[0][0]:
+                    # identifier hasn't been updated
+                    query('UPDATE {} SET identifier=? WHERE initial_url=?'.format(table), [identifier, seed_url])
+                    counts['existing-id-updated'] += 1
+                    continue
+                else:
+                    counts['existing-complete'] += 1
+                    continue
+
+            if resolved:
+                row, found, seed_counts = resolved
+                counts.update(seed_counts)
+                writer.insert(row)
+                if found:
+                    counts['inserted'] += 1
+            else:
+                found = forward_seed(timed_m, writer, seed_url, identifier, counts)
+            if not found:
+                continue
+            i = i+1
+            if i % 2000 == 0:
+                METRICS.progress('forward', i)
+                if checkpoint:
+                    checkpoint()
+                commit()
+
+    output_db.commit()
+    if m is not map_db:
+        m.close()
+    print("Building indices (this can be slow)...")
+    with METRICS.phase('index-build'):
+        create_result_indexes(output_db)
+    c.close()
+    METRICS.finish_stage('forward', rows=counts['inserted'], counts=counts)
+    print("Forward map complete.")
+    print(counts)
+    return counts
+
+def open_map_readonly(map_path):
+    """
+    Opens a map DB read-only and immutable (no locking or change checks), for
+    sharing between processes once it's complete.
+    """
+    return sqlite3.connect('file:{}?mode=ro&immutable=1'.format(urllib.parse.quote(os.path.abspath(map_path))), uri=True)
+
+# per-process state of parallel resolution workers: (map, walker, hit_mimetypes)
+PARALLEL_WORKER = None
+
+def init_parallel_worker(map_path, map_engine, chain_cache_size, hit_mimetypes):
+    global PARALLEL_WORKER
+    m = open_map(open_map_readonly(map_path), map_engine)
+    walker = m
+    if chain_cache_size and not isinstance(m, RedirectGraph):
+        walker = ChainCache(m, chain_cache_size)
+    PARALLEL_WORKER = (m, walker, hit_mimetypes)
+
+def backward_batch_worker(raw_lines):
+    """
+    Scans and resolves a batch of crawl log lines; returns (rows, counts).
+    """
+    m, walker, hit_mimetypes = PARALLEL_WORKER
+    counts = collections.Counter()
+    rows = []
+    for hit in scan_backward_lines(raw_lines, counts, hit_mimetypes):
+        row = resolve_backward_hit(hit, m.lookup_referrer_row, walker.walk_backward, counts, hit_mimetypes)
+        if row:
+            rows.append(row)
+    return rows, counts
+
+def forward_batch_worker(raw_lines):
+    """
+    Parses and resolves a batch of seed lines; returns (parse counts, list of
+    (seed, (row, found, resolve counts))). Resolve counts are kept per seed,
+    since they only count if the writer doesn't already have a row for it.
+    """
+    m, walker, hit_mimetypes = PARALLEL_WORKER
+    counts = collections.Counter()
+    results = []
+    for raw_line in raw_lines:
+        seed = parse_seed_line(raw_line, counts)
+        resolved = None
+        if seed:
+            seed_counts = collections.Counter()
+            row, found = resolve_forward_seed(m, seed[0], seed[1], seed_counts)
+            resolved = (row, found, seed_counts)
+        results.append((seed, resolved))
+    return counts, results
+
+def batched(lines, batch_size):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# marks the end of a PipelineStage's output
+PIPELINE_DONE = object()
+
+class PipelineStage:
+    """
+    Runs func over each item (batch) of an upstream iterable in a background
+    thread, handing results on through a bounded queue; iterating over the
+    stage yields them, in order. Chaining stages (the last one consumed by
+    the thread that owns the output DB, as the writer) overlaps parsing, map
+    lookups and sqlite3 writes, which release the GIL while they work. A full
+    queue blocks the stage feeding it, so memory use stays bounded.
+
+    Tracks time spent working, waiting for input, and blocked on a full
+    output queue (and the consumer's time waiting on this stage), plus queue
+    depth at each put; see report_pipeline(). If given, finish() is called in
+    the stage's thread at the end (eg, to close a connection opened there).
+    """
+
+    def __init__(self, name, func, upstream, queue_size=16, finish=None):
+        self.name = name
+        self.func = func
+        self.upstream = upstream
+        self.finish = finish
+        self.queue = queue.Queue(queue_size)
+        self.error = None
+        self.stats = {'items': 0, 'busy': 0.0, 'starved': 0.0, 'blocked': 0.0,
+            'depth_total': 0, 'depth_max': 0, 'consumer_starved': 0.0}
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        stats = self.stats
+        perf_counter = time.perf_counter
+        try:
+            upstream = iter(self.upstream)
+            while True:
+                start = perf_counter()
+                try:
+                    item = next(upstream)
+                except StopIteration:
+                    break
+                got = perf_counter()
+                result = self.func(item)
+                done = perf_counter()
+                depth = self.queue.qsize()
+                self.queue.put(result)
+                stats['starved'] += got - start
+                stats['busy'] += done - got
+                stats['blocked'] += perf_counter() - done
+                stats['items'] += 1
+                stats['depth_total'] += depth
+                stats['depth_max'] = max(stats['depth_max'], depth)
+            if self.finish:
+                self.finish()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.queue.put(PIPELINE_DONE)
+
+    def __iter__(self):
+        perf_counter = time.perf_counter
+        while True:
+            start = perf_counter()
+            item = self.queue.get()
+            self.stats['consumer_starved'] += perf_counter() - start
+            if item is PIPELINE_DONE:
+                if self.error:
+                    raise self.error
+                return
+            yield item
+
+def report_pipeline(name, stages, start):
+    """
+    Prints per-stage busy/stall times and queue depths for a chain of
+    PipelineStages (and the writer consuming the last one), and records them
+    with the stage's metrics. The busiest stage is the bottleneck.
+    """
+    elapsed = time.time() - start
+    report = collections.OrderedDict()
+    for stage in stages:
+        stats = stage.stats
+        report[stage.name] = {
+            'busy_seconds': round(stats['busy'], 3),
+            'input_wait_seconds': round(stats['starved'], 3),
+            'output_blocked_seconds': round(stats['blocked'], 3),
+            'queue_depth_avg': round(stats['depth_total'] / max(stats['items'], 1), 1),
+            'queue_depth_max': stats['depth_max'],
+            'queue_size': stage.queue.maxsize,
+        }
+    writer_wait = stages[-1].stats['consumer_starved']
+    report['write'] = {
+        'busy_seconds': round(max(elapsed - writer_wait, 0), 3),
+        'input_wait_seconds': round(writer_wait, 3),
+    }
+    print("Pipeline ({:.1f}s):".format(elapsed))
+    for stage_name, stats in report.items():
+        line = "    {:<8} {:7.1f}s busy {:7.1f}s waiting for input".format(
+            stage_name, stats['busy_seconds'], stats['input_wait_seconds'])
+        if 'queue_size' in stats:
+            line += " {:7.1f}s blocked on output, queue {:.1f} avg {} max (of {})".format(
+                stats['output_blocked_seconds'], stats['queue_depth_avg'], stats['queue_depth_max'], stats['queue_size'])
+        print(line)
+    bottleneck = max(report, key=lambda stage_name: report[stage_name]['busy_seconds'])
+    print("    bottleneck: {}".format(bottleneck))
+    if name in METRICS.stages:
+        METRICS.stages[name]['pipeline'] = report
+    return report
+
+def pipeline_map_opener(map_db, map_engine='sqlite', chain_cache_size=1000000):
+    """
+    Returns a function giving (map, walker) for a pipeline resolve stage:
+    the (complete, on-disk) map is opened read-only on the first call, in the
+    calling thread, as sqlite3 connections can't be shared between threads.
+    The returned function has a close() for the end of the stage.
+    """
+    map_path = db_path(map_db)
+    if not map_path:
+        raise ValueError("pipeline mode needs an on-disk map (eg, everything --map_db_file)")
+    map_db.commit()
+    if map_engine == 'mmap':
+        open_map(map_db, 'mmap').close()
+    opened = []
+
+    def get():
+        if not opened:
+            m = open_map(open_map_readonly(map_path), map_engine)
+            walker = m
+            if chain_cache_size and not isinstance(m, RedirectGraph):
+                walker = ChainCache(m, chain_cache_size)
+            opened.append((m, walker))
+        return opened[0]
+
+    def close():
+        if opened:
+            opened[0][0].close()
+    get.close = close
+    return get
+
+def parallel_map_ordered(map_db, func, lines, workers, map_engine='sqlite', chain_cache_size=1000000, hit_mimetypes=FULLTEXT_MIMETYPES, batch_size=2000):
+    """
+    Runs func over batches of lines in a pool of workers that each open the
+    (complete, on-disk) map read-only, yielding results in input order. Only
+    a few batches per worker are in flight, so input is read as it's used.
+    """
+    map_path = db_path(map_db)
+    if not map_path:
+        raise ValueError("parallel workers need an on-disk map (eg, everything --map_db_file)")
+    map_db.commit()
+    if map_engine == 'mmap':
+        # build it once, before the workers all try to
+        open_map(map_db, 'mmap').close()
+    with multiprocessing.Pool(workers, initializer=init_parallel_worker,
+            initargs=(map_path, map_engine, chain_cache_size, hit_mimetypes)) as pool:
+        pending = collections.deque()
+        for batch in batched(lines, batch_size):
+            pending.append(pool.apply_async(func, (batch,)))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+def parallel_forward_seeds(seed_id_file, map_db, counts, map_engine='sqlite', workers=2):
+    """
+    Yields (seed, resolved) for forward(), in seed file order, adding parse
+    counts to `counts`.
+    """
+    for parse_counts, results in parallel_map_ordered(map_db, forward_batch_worker, seed_id_file, workers, map_engine=map_engine):
+        counts.update(parse_counts)
+        yield from results
+
+def backward_parallel(log_file, map_db, output_db, counts, hit_mimetypes=FULLTEXT_MIMETYPES, map_engine='sqlite', chain_cache_size=1000000, workers=2):
+    """
+    backward() with scanning and chain resolution in a pool of workers, and
+    batched inserts here. Output rows are in the same order as backward();
+    counts are the same, except that chain cache stats are per worker.
+    """
+    create_out_table(output_db)
+    c = output_db.cursor()
+    METRICS.start_stage('backward', log_file)
+    insert_many = METRICS.timed('insert', ResultWriter(output_db).insert_many)
+    commit = METRICS.timed('commit', output_db.commit)
+    print("Resolving with {} worker processes".format(workers))
+    for rows, batch_counts in parallel_map_ordered(map_db, backward_batch_worker, log_file, workers,
+            map_engine=map_engine, chain_cache_size=chain_cache_size, hit_mimetypes=hit_mimetypes):
+        insert_many(rows)
+        counts.update(batch_counts)
+        counts['inserted'] += len(rows)
+        if rows:
+            commit()
+            METRICS.progress('backward', counts['inserted'])
+    commit()
+    print("Building indices (this can be slow)...")
+    with METRICS.phase('index-build'):
+        create_result_indexes(output_db, ('initial_url', 'identifier'))
+    c.close()
+    METRICS.finish_stage('backward', rows=counts['inserted'], counts=counts)
+    print("Backward map complete.")
+    print(counts)
+    return counts
+
+def scan_backward_batch(raw_lines, hit_mimetypes=FULLTEXT_MIMETYPES):
+    counts = collections.Counter()
+    return scan_backward_lines(raw_lines, counts, hit_mimetypes), counts
+
+def backward_pipelined(log_file, map_db, output_db, counts, hit_mimetypes=FULLTEXT_MIMETYPES, map_engine='sqlite', chain_cache_size=1000000, batch_size=2000, commit_rows=20000):
+    """
+    backward() as a pipeline (see PipelineStage): log lines are scanned in one
+    thread, resolved against the map in another, and written here in large
+    executemany() batches, committing every commit_rows rows. Output rows and
+    counts are the same as backward().
+    """
+    get_map = pipeline_map_opener(map_db, map_engine, chain_cache_size)
+    create_out_table(output_db)
+    c = output_db.cursor()
+    METRICS.start_stage('backward', log_file)
+    insert_many = METRICS.timed('insert', ResultWriter(output_db).insert_many)
+    commit = METRICS.timed('commit', output_db.commit)
+
+    def resolve(scanned):
+        hits, batch_counts = scanned
+        m, walker = get_map()
+        rows = []
+        for hit in hits:
+            row = resolve_backward_hit(hit, m.lookup_referrer_row, walker.walk_backward, batch_counts, hit_mimetypes)
+            if row:
+                rows.append(row)
+        return rows, batch_counts
+
+    start = time.time()
+    scan_stage = PipelineStage('scan', functools.partial(scan_backward_batch, hit_mimetypes=hit_mimetypes), batched(log_file, batch_size))
+    resolve_stage = PipelineStage('resolve', resolve, scan_stage, finish=get_map.close)
+    uncommitted = 0
+    for rows, batch_counts in resolve_stage:
+        insert_many(rows)
+        counts.update(batch_counts)
+        counts['inserted'] += len(rows)
+        uncommitted += len(rows)
+        if uncommitted >= commit_rows:
+            commit()
+            uncommitted = 0
+            METRICS.progress('backward', counts['inserted'])
+    commit()
+    report_pipeline('backward', [scan_stage, resolve_stage], start)
+    print("Building indices (this can be slow)...")
+    with METRICS.phase('index-build'):
+        create_result_indexes(output_db, ('initial_url', 'identifier'))
+    c.close()
+    METRICS.finish_stage('backward', rows=counts['inserted'], counts=counts)
+    print("Backward map complete.")
+    print(counts)
+    return counts
+
+def pipelined_forward_seeds(seed_id_file, map_db, counts, map_engine='sqlite', batch_size=2000):
+    """
+    Yields (seed, resolved) for forward(), like parallel_forward_seeds(), with
+    seed lines parsed in one thread and resolved in another (see
+    PipelineStage), adding parse counts to `counts`.
+    """
+    get_map = pipeline_map_opener(map_db, map_engine, chain_cache_size=0)
+
+    def parse(raw_lines):
+        batch_counts = collections.Counter()
+        return [parse_seed_line(raw_line, batch_counts) for raw_line in raw_lines], batch_counts
+
+    def resolve(parsed):
+        seeds, batch_counts = parsed
+        m, walker = get_map()
+        results = []
+        for seed in seeds:
+            resolved = None
+            if seed:
+                seed_counts = collections.Counter()
+                row, found = resolve_forward_seed(m, seed[0], seed[1], seed_counts)
+                resolved = (row, found, seed_counts)
+            results.append((seed, resolved))
+        return batch_counts, results
+
+    start = time.time()
+    parse_stage = PipelineStage('parse', parse, batched(seed_id_file, batch_size))
+    resolve_stage = PipelineStage('resolve', resolve, parse_stage, finish=get_map.close)
+    for parse_counts, results in resolve_stage:
+        counts.update(parse_counts)
+        yield from results
+    report_pipeline('forward', [parse_stage, resolve_stage], start)
+
+def parse_referrer_batch(raw_lines, hit_mimetypes=None):
+    """
+    The referrer() loop body, for a batch of log lines in a pipeline parse
+    stage: returns (map rows, backward hits, counts, lines).
+    """
+    counts = collections.Counter()
+    rows = []
+    hits = []
+    for raw in raw_lines:
+        line = parse_crawl_line(raw)
+        if not line:
+            warn('bad-log-line', "BAD LOG LINE: {}".format(raw.strip()))
+            continue
+        if line.url.startswith('dns:') or line.url.startswith('whois:'):
+            counts['skip-log-prereq'] += 1
+            continue
+        is_dedupe = 'duplicate:digest' in line.annotations
+        rows.append((line.url, line.referrer_url, line.status_code, line.breadcrumbs, line.mimetype, is_dedupe))
+        if hit_mimetypes and is_backward_hit(line, counts, hit_mimetypes):
+            hits.append(BackwardHit(line.url, line.timestamp, line.sha1))
+    return rows, hits, counts, len(raw_lines)
+
+def forward_touched_urls(map_db, since_rowid, limit=40):
+    """
+    URLs whose forward() result may have changed since map row since_rowid:
+    new URLs and referrers of new rows (which gained a child), and everything
+    upstream of those (by referrer, up to the walk_forward() hop limit).
+    """
+    c = map_db.cursor()
+    frontier = set()
+    for url, referrer_url in c.execute("SELECT url, referrer FROM referrer WHERE rowid > ?", [since_rowid]):
+        frontier.add(url)
+        if referrer_url:
+            frontier.add(referrer_url)
+    touched = set(frontier)
+    for hop in range(limit):
+        parents = set()
+        for url in frontier:
+            for (referrer_url,) in c.execute("SELECT referrer FROM referrer WHERE url=?", [url]):
+                if referrer_url and referrer_url not in touched:
+                    parents.add(referrer_url)
+        if not parents:
+            break
+        touched |= parents
+        frontier = parents
+    c.close()
+    return touched
+
+def forward_incremental(seed_paths, map_db, output_db, map_engine='sqlite'):
+    """
+    Incremental variant of forward(), to run after backward_incremental():
+    processes seed lines not read before (see IngestLog), and replays earlier
+    seed lines only for seed URLs whose results may have changed: those
+    queued by backward_incremental(), and those upstream of new map rows
+    (forward_touched_urls). Replayed URLs have their forward rows deleted and
+    identifiers cleared first, so they end up the same as in a full run.
+
+    Earlier seed lines are only read back if some URL may have changed; if
+    none did, only new lines are read, and unchanged seed files not at all.
+    """
+    if output_db.execute("PRAGMA main.journal_mode = WAL").fetchone()[0] != 'wal':
+        raise ValueError("couldn't switch output database to WAL mode")
+    create_out_table(output_db)
+    output_db.execute("CREATE TABLE IF NOT EXISTS incremental_seed (url text PRIMARY KEY)")
+    progress = IngestLog(output_db, 'forward')
+    since_rowid = get_incremental_state(output_db, 'forward_map_rowid')
+    map_rowid = map_db.execute("SELECT COALESCE(MAX(rowid), 0) FROM referrer").fetchone()[0]
+    affected = set()
+    if since_rowid is not None:
+        affected = forward_touched_urls(map_db, since_rowid)
+    affected.update(url for (url,) in output_db.execute("SELECT url FROM incremental_seed"))
+    print("{} possibly changed seed URLs".format(len(affected)))
+
+    def seed_lines():
+        replayed = set()
+        scratch = collections.Counter()
+        # nothing to replay: skip reading old lines
+        for raw_line, is_new in progress.lines(seed_paths, new_only=not affected):
+            if is_new:
+                yield raw_line
+                continue
+            seed = parse_seed_line(raw_line, scratch)
+            if not seed or seed[0] not in affected:
+                continue
+            if seed[0] not in replayed:
+                replayed.add(seed[0])
+                output_db.execute("DELETE FROM crawl_result WHERE initial_url=? AND hit=0", [seed[0]])
+                output_db.execute("UPDATE crawl_result SET identifier=NULL WHERE initial_url=?", [seed[0]])
+            yield raw_line
+
+    counts = forward(seed_lines(), map_db, output_db, map_engine=map_engine, checkpoint=progress.checkpoint)
+    output_db.execute("DELETE FROM incremental_seed")
+    set_incremental_state(output_db, 'forward_map_rowid', map_rowid)
+    output_db.commit()
+    return counts
+
+def forward_set_based(seed_id_file, m, output_db, counts, batch_size=50000, cte_map_db=None):
+    """
+    Set-based variant of the forward() seed loop, for very large seed lists.
+
+    Normalized seeds are bulk-loaded into a temp staging table, then joined
+    against crawl_result once. Seeds which already have rows get their
+    identifiers updated with a single UPDATE; only the remaining seeds are
+    resolved forward through the map.
+
+    Results and counts match the per-seed loop, including repeated seed URLs:
+    the first occurrence of a new URL inserts a row, and each later
+    occurrence counts as 'existing-id-updated' until the URL has a non-null
+    identifier, then as 'existing-complete'. So the final identifier is
+    always the first non-null one (in seed file order).
+
+    If cte_map_db is given, the remaining seeds are resolved inside sqlite3
+    instead, against that map (see forward_cte).
+    """
+    c = output_db.cursor()
+    c.executescript("""
+        DROP TABLE IF EXISTS temp.forward_seed;
+        DROP TABLE IF EXISTS temp.forward_existing;
+        DROP TABLE IF EXISTS temp.forward_update;
+        CREATE TEMP TABLE forward_seed
+            (seq INTEGER PRIMARY KEY,
+             url text NOT NULL,
+             identifier text);
+        CREATE TEMP TABLE forward_update
+            (url text PRIMARY KEY,
+             identifier text);
+    """)
+    create_result_indexes(output_db, ('initial_url',))
+
+    print("Loading seeds into staging table...")
+    parse = METRICS.timed('parse', parse_seed_line)
+    batch = []
+    for raw_line in seed_id_file:
+        seed = parse(raw_line, counts)
+        if not seed:
+            continue
+        batch.append(seed)
+        if len(batch) >= batch_size:
+            c.executemany("INSERT INTO forward_seed (url, identifier) VALUES (?,?)", batch)
+            batch = []
+    if batch:
+        c.executemany("INSERT INTO forward_seed (url, identifier) VALUES (?,?)", batch)
+
+    print("Joining seeds against existing results...")
+    with METRICS.phase('result-lookup'):
+        # identifier of the first (lowest rowid) existing row for each seed URL;
+        # sqlite3 takes bare columns from the MIN() row
+        c.executescript("""
+            CREATE INDEX forward_seed_url on forward_seed (url, seq);
+            CREATE TEMP TABLE forward_existing AS
+                SELECT r.initial_url AS url, MIN(r.rowid) AS first_rowid, r.identifier AS identifier
+                FROM (SELECT DISTINCT url FROM forward_seed) s
+                JOIN {} r ON r.initial_url = s.url
+                GROUP BY r.initial_url;
+            CREATE UNIQUE INDEX forward_existing_url on forward_existing (url);
+        """.format(result_rows_table(output_db)))
+
+    # one ordered scan over the seeds, grouped by URL
+    new_seeds = []
+    updates = []
+    cur = output_db.execute("""
+        SELECT s.url, s.seq, s.identifier, e.first_rowid IS NOT NULL, e.identifier
+        FROM forward_seed s LEFT JOIN forward_existing e ON e.url = s.url
+        ORDER BY s.url, s.seq
+    """)
+    last_url = None
+    for url, seq, identifier, existing, existing_identifier in cur:
+        if url != last_url:
+            last_url = url
+            if existing:
+                current = existing_identifier
+            else:
+                # first occurrence; will be resolved and inserted below
+                current = identifier
+                new_seeds.append([seq, url, identifier])
+                continue
+        if not current:
+            current = identifier
+            counts['existing-id-updated'] += 1
+            if existing:
+                if updates and updates[-1][0] == url:
+                    updates[-1][1] = identifier
+                else:
+                    updates.append([url, identifier])
+            else:
+                new_seeds[-1][2] = identifier
+        else:
+            counts['existing-complete'] += 1
+
+    print("Updating identifiers for {} existing seed URLs...".format(len(updates)))
+    with METRICS.phase('result-update'):
+        c.executemany("INSERT INTO forward_update VALUES (?,?)", updates)
+        c.execute("""
+            UPDATE {0}
+            SET identifier = (SELECT u.identifier FROM forward_update u WHERE u.url = {0}.initial_url)
+            WHERE initial_url IN (SELECT url FROM forward_update)
+        """.format(result_rows_table(output_db)))
+        output_db.commit()
+
+    print("Resolving {} remaining seeds forward...".format(len(new_seeds)))
+    # in seed file order, so rows get inserted in the same order as forward()
+    new_seeds.sort()
+    if cte_map_db is not None:
+        forward_cte(new_seeds, cte_map_db, output_db, counts)
+        new_seeds = []
+    writer = ResultWriter(output_db)
+    i = 0
+    for seq, url, identifier in new_seeds:
+        if not forward_seed(m, writer, url, identifier, counts):
+            continue
+        i = i+1
+        if i % 2000 == 0:
+            METRICS.progress('forward', i)
+            output_db.commit()
+    output_db.commit()
+    c.executescript("""
+        DROP TABLE temp.forward_seed;
+        DROP TABLE temp.forward_existing;
+        DROP TABLE temp.forward_update;
+    """)
+    c.close()
+
+# temp tables for load_cte_map, over the map attached as 'map'; {rows} is
+# map_row's SELECT, and {table}, {url} and {referrer} the map table and its
+# url and referrer columns. skippable: see is_skippable_embed()
+CTE_MAP_TABLES = """
+    CREATE TEMP VIEW map_row AS {rows};
+    CREATE TEMP TABLE map_first (id INTEGER PRIMARY KEY, first_id int NOT NULL);
+    INSERT INTO map_first
+        SELECT id, first_id FROM
+            (SELECT r.rowid AS id, (SELECT MIN(f.rowid) FROM map.{table} f WHERE f.{url} = r.{referrer}) AS first_id
+             FROM map.{table} r)
+        WHERE first_id IS NOT NULL;
+    CREATE TEMP TABLE map_next (id INTEGER PRIMARY KEY, next_id int NOT NULL);
+    INSERT INTO map_next
+        SELECT id, next_id FROM
+            (SELECT r.rowid AS id,
+                    (SELECT MAX(n.rowid) FROM map.{table} n JOIN map_row x ON x.id = n.rowid
+                     WHERE n.{referrer} = r.{url}
+                         AND NOT ((instr(x.breadcrumbs, 'E') OR instr(x.breadcrumbs, 'X') OR instr(x.breadcrumbs, 'I'))
+                                  AND NOT instr(x.mimetype, 'pdf'))) AS next_id
+             FROM map.{table} r)
+        WHERE next_id IS NOT NULL;
+"""
+
+def load_cte_map(map_db, output_db):
+    """
+    Attaches the referrer map to the output connection as 'map', and sets up
+    temp tables for the recursive CTE resolvers (a no-op if already done):
+
+        map_row:   view of every map row, by map rowid ('-' referrers as NULL)
+        map_first: for each row whose referrer is in the map, the first row
+                   of that url (what lookup_referrer_row finds)
+        map_next:  for each row, the row forward resolution steps to from its
+                   url: the last one referred from it that isn't a skippable
+                   embed
+
+    map_first and map_next only hold row ids; everything else is read from
+    the map through its indexes. In-memory maps can't be attached, so they
+    are copied into an attached in-memory DB first.
+    """
+    if not isinstance(map_db, sqlite3.Connection):
+        raise ValueError("recursive CTE resolution needs a sqlite3 map, not a map engine")
+    if list(output_db.execute("SELECT 1 FROM sqlite_temp_master WHERE name='map_first'")):
+        return
+    print("Indexing referrer map for recursive queries...")
+    output_db.create_function('url_host', 1, url_host, deterministic=True)
+    compact = is_compact_map(map_db)
+    map_path = db_path(map_db)
+    if map_path:
+        # referrer() leaves the map locked exclusively; the lock is dropped
+        # on the next read after switching back
+        map_db.commit()
+        map_db.execute("PRAGMA main.locking_mode = NORMAL")
+        map_db.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        output_db.execute("ATTACH DATABASE ? AS map", [map_path])
+    else:
+        output_db.execute("ATTACH DATABASE ':memory:' AS map")
+        output_db.execute("""
+            CREATE TABLE map.referrer
+                (url text,
+                 referrer text,
+                 status_code text,
+                 breadcrumbs text,
+                 mimetype text,
+                 is_dedupe bool)
+        """)
+        if compact:
+            query = COMPACT_MAP_ROWS + " ORDER BY r.rowid"
+        else:
+            query = "SELECT url, referrer, status_code, breadcrumbs, mimetype, is_dedupe FROM referrer ORDER BY rowid"
+        cur = map_db.execute(query)
+        while True:
+            rows = cur.fetchmany(50000)
+            if not rows:
+                break
+            output_db.executemany("INSERT INTO map.referrer VALUES (?,?,?,?,?,?)", rows)
+        output_db.executescript("""
+            CREATE INDEX map.referrer_url on referrer (url);
+            CREATE INDEX map.referrer_referrer on referrer (referrer);
+        """)
+        compact = False
+    if compact:
+        script = CTE_MAP_TABLES.format(table='referrer_row', url='url_id', referrer='referrer_id', rows="""
+            SELECT r.rowid AS id, u.url AS url, p.url AS referrer, s.value AS status_code,
+                   b.value AS breadcrumbs, m.value AS mimetype, r.is_dedupe AS is_dedupe
+            FROM map.referrer_row r
+            JOIN map.map_url u ON u.id = r.url_id
+            LEFT JOIN map.map_url p ON p.id = r.referrer_id
+            JOIN map.map_value s ON s.id = r.status_code_id
+            JOIN map.map_value b ON b.id = r.breadcrumbs_id
+            JOIN map.map_value m ON m.id = r.mimetype_id""")
+    else:
+        script = CTE_MAP_TABLES.format(table='referrer', url='url', referrer='referrer', rows="""
+            SELECT rowid AS id, url, NULLIF(NULLIF(referrer, '-'), '') AS referrer, status_code, breadcrumbs,
+                   mimetype, is_dedupe
+            FROM map.referrer""")
+    output_db.executescript(script)
+
+def backward_cte(log_file, map_db, output_db, hit_mimetypes=FULLTEXT_MIMETYPES, batch_size=50000):
+    """
+    Variant of backward() that resolves all chains inside sqlite3: hits are
+    staged in a temp table, then walked back with one WITH RECURSIVE query
+    over the map (see load_cte_map), and inserted with INSERT ... SELECT.
+
+    Loop detection is the same as walk_backward(): each step records the
+    referrer of the row it moved to, and the walk stops at a row whose
+    referrer was already recorded. Output rows (in the same order) and
+    counts match backward(), except for chain cache stats.
+    """
+    print("Mapping backward from log file 200s to initial urls (recursive CTE)")
+    counts = collections.Counter({'inserted': 0})
+    create_out_table(output_db)
+    METRICS.start_stage('backward', log_file)
+    with METRICS.phase('map-load'):
+        load_cte_map(map_db, output_db)
+    c = output_db.cursor()
+    c.executescript("""
+        DROP TABLE IF EXISTS temp.backward_hit;
+        DROP TABLE IF EXISTS temp.backward_walk;
+        CREATE TEMP TABLE backward_hit
+            (seq INTEGER PRIMARY KEY,
+             url text,
+             timestamp text,
+             sha1 text,
+             final_id int);
+        CREATE TEMP TABLE backward_walk
+            (seq INTEGER PRIMARY KEY,
+             id int,
+             looped bool);
+    """)
+    batch = []
+    for hit in iter_backward_hits(log_file, counts, hit_mimetypes):
+        batch.append(hit)
+        if len(batch) >= batch_size:
+            c.executemany("INSERT INTO backward_hit (url, timestamp, sha1) VALUES (?,?,?)", batch)
+            batch = []
+    if batch:
+        c.executemany("INSERT INTO backward_hit (url, timestamp, sha1) VALUES (?,?,?)", batch)
+
+    with METRICS.phase('map-lookup'):
+        c.execute("UPDATE backward_hit SET final_id = (SELECT MIN(f.id) FROM map_row f WHERE f.url = backward_hit.url)")
+        for (url,) in c.execute("SELECT url FROM backward_hit WHERE final_id IS NULL ORDER BY seq").fetchall():
+            warn('map-url-missing', "MISSING url: {}".format(url))
+            counts['map-url-missing'] += 1
+        scope = """
+            DELETE FROM backward_hit WHERE final_id IN
+                (SELECT f.id FROM backward_hit h JOIN map_row f ON f.id = h.final_id
+                 WHERE NOT (f.status_code IN ('200', '226') AND f.mimetype IN ({})))
+        """.format(','.join('?' * len(hit_mimetypes)))
+        skipped = c.execute(scope, list(hit_mimetypes)).rowcount
+        if skipped:
+            counts['skip-map-scope'] += skipped
+        c.execute("DELETE FROM backward_hit WHERE final_id IS NULL")
+
+    with METRICS.phase('chain-walk'):
+        # sqlite3 takes the bare columns from the MAX(depth) row. Referrers
+        # go on the stack as the id of their first row (unique per url)
+        c.execute("""
+            INSERT INTO backward_walk
+            WITH RECURSIVE walk(seq, id, depth, stack, looped) AS (
+                SELECT seq, final_id, 0, ' ', 0 FROM backward_hit
+                UNION ALL
+                SELECT w.seq, nf.first_id, w.depth + 1,
+                       w.stack || COALESCE(nr.first_id, '') || ' ',
+                       COALESCE(instr(w.stack, ' ' || nr.first_id || ' '), 0) > 0
+                FROM walk w
+                JOIN map_first nf ON nf.id = w.id
+                LEFT JOIN map_first nr ON nr.id = nf.first_id
+                WHERE NOT w.looped
+            )
+            SELECT seq, id, looped FROM (SELECT seq, MAX(depth), id, looped FROM walk GROUP BY seq)
+        """)
+        loops = c.execute("SELECT COUNT(*) FROM backward_walk WHERE looped").fetchone()[0]
+        if loops:
+            counts['map-url-redirect-loop'] += loops
+
+    with METRICS.phase('insert'):
+        insert_result_rows(output_db, """
+            SELECT i.url, NULL, url_host(i.url), f.breadcrumbs, f.url, url_host(f.url),
+                   CASE WHEN length(h.timestamp) >= 14 AND substr(h.timestamp, 5, 1) != '-'
+                        THEN substr(h.timestamp, 1, 14) END,
+                   f.status_code, h.sha1, f.mimetype, f.is_dedupe, 1, NULL
+            FROM backward_hit h
+            JOIN backward_walk w ON w.seq = h.seq
+            JOIN map_row i ON i.id = w.id
+            JOIN map_row f ON f.id = h.final_id
+            ORDER BY h.seq
+        """)
+        output_db.commit()
+    # one row per walk
+    counts['inserted'] += c.execute("SELECT COUNT(*) FROM backward_walk").fetchone()[0]
+    c.executescript("""
+        DROP TABLE temp.backward_hit;
+        DROP TABLE temp.backward_walk;
+    """)
+    print("Building indices (this can be slow)...")
+    with METRICS.phase('index-build'):
+        create_result_indexes(output_db, ('initial_url', 'identifier'))
+    c.close()
+    METRICS.finish_stage('backward', rows=counts['inserted'], counts=counts)
+    print("Backward map complete.")
+    print(counts)
     return counts
 
-def everything(log_file, seed_id_file, map_db, output_db, hit_mimetypes=FULLTEXT_MIMETYPES):
-    referrer(open(log_file, 'r'), map_db)
-    bcounts = backward(open(log_file, 'r'), map_db, output_db, hit_mimetypes=hit_mimetypes)
-    fcounts = forward(seed_id_file, map_db, output_db)
+def forward_cte(new_seeds, map_db, output_db, counts, limit=40):
+    """
+    Resolves (seq, url, identifier) seeds forward inside sqlite3, with one
+    WITH RECURSIVE query over the map (see load_cte_map), and inserts their
+    crawl_result rows in seq order. Same steps and hop limit as
+    walk_forward(): at most limit-1 steps, and a walk that gets that far
+    counts as '_redirect-recursion-limit' (no loop detection needed).
+    """
+    load_cte_map(map_db, output_db)
+    c = output_db.cursor()
+    c.executescript("""
+        DROP TABLE IF EXISTS temp.forward_new;
+        CREATE TEMP TABLE forward_new
+            (seq INTEGER PRIMARY KEY,
+             url text NOT NULL,
+             identifier text,
+             final_id int,
+             depth int);
+    """)
+    c.executemany("INSERT INTO forward_new (seq, url, identifier) VALUES (?,?,?)", new_seeds)
+    with METRICS.phase('chain-walk'):
+        c.execute("""
+            WITH RECURSIVE walk(seq, id, depth) AS (
+                SELECT seq, id, 0 FROM
+                    (SELECT s.seq, (SELECT MIN(f.id) FROM map_row f WHERE f.url = s.url) AS id FROM forward_new s)
+                WHERE id IS NOT NULL
+                UNION ALL
+                SELECT w.seq, n.next_id, w.depth + 1
+                FROM walk w
+                JOIN map_next n ON n.id = w.id
+                WHERE w.depth < ?
+            )
+            REPLACE INTO forward_new
+            SELECT s.seq, s.url, s.identifier, w.id, w.depth
+            FROM (SELECT seq, MAX(depth) AS depth, id FROM walk GROUP BY seq) w
+            JOIN forward_new s ON s.seq = w.seq
+        """, [limit - 1])
+    missing = c.execute("SELECT COUNT(*) FROM forward_new WHERE final_id IS NULL").fetchone()[0]
+    found = len(new_seeds) - missing
+    if missing:
+        counts['map-url-missing'] += missing
+    limited = c.execute("SELECT COUNT(*) FROM forward_new WHERE depth = ?", [limit - 1]).fetchone()[0]
+    if limited:
+        counts['_redirect-recursion-limit'] += limited
+    with METRICS.phase('insert'):
+        insert_result_rows(output_db, """
+            SELECT s.url, s.identifier, url_host(s.url), f.breadcrumbs, f.url,
+                   CASE WHEN f.id IS NOT NULL THEN url_host(f.url) END,
+                   NULL, f.status_code, NULL, f.mimetype, f.is_dedupe, 0, NULL
+            FROM forward_new s
+            LEFT JOIN map_row f ON f.id = s.final_id
+            ORDER BY s.seq
+        """)
+        output_db.commit()
+    counts['inserted'] += found
+    c.execute("DROP TABLE temp.forward_new")
+    c.close()
+
+def test_cte_resolution(tmp_path):
+    seeds = "http://a.com/1\t10.123/a\nhttp://b.com/x\t10.123/b\nhttp://c.com/missing\t10.123/c\nhttp://a.com/2\n"
+    results = []
+    # in-memory maps are copied, on-disk ones attached
+    for cte, map_path, compact in ((False, ':memory:', False), (True, ':memory:', False), (True, ':memory:', True),
+            (True, str(tmp_path / 'map.sqlite'), False), (True, str(tmp_path / 'map-compact.sqlite'), True)):
+        backward_fn, backward_kwargs = (backward_cte, {}) if cte else (backward, {'chain_cache_size': 0})
+        results.append(run_test_chain(seeds, sqlite3.connect(map_path), backward_fn=backward_fn, referrer_kwargs={'compact': compact},
+            backward_kwargs=backward_kwargs, forward_kwargs={'set_based': True, 'cte': cte}))
+    assert all(result == results[0] for result in results)
+    assert results[1][0]['map-url-redirect-loop'] == 1
+
+def test_forward_set_based():
+    seeds = "\n".join([
+        "http://a.com/1",
+        "http://a.com/1\t10.123/a",
+        "http://b.com/x\t10.123/b",
+        "HTTP://B.com/x\t10.123/bb",
+        "http://c.com/missing",
+        "http://c.com/missing\t10.123/c",
+        "http://c.com/missing\t10.123/cc",
+        "http://a.com/3.pdf\t10.123/pdf",
+    ]) + "\n"
+    results = [run_test_chain(seeds, forward_kwargs={'set_based': set_based}) for set_based in (False, True)]
+    assert results[0] == results[1]
+    assert results[1][1]['existing-id-updated'] == 3
+    assert results[1][1]['existing-complete'] == 2
+
+def test_single_pass_backward():
+    two_map, two_out = sqlite3.connect(':memory:'), sqlite3.connect(':memory:')
+    referrer(io.StringIO(TEST_CRAWL_LOG), two_map)
+    two_counts = backward(io.StringIO(TEST_CRAWL_LOG), two_map, two_out)
+
+    one_map, one_out = sqlite3.connect(':memory:'), sqlite3.connect(':memory:')
+    hits, one_counts = referrer(io.StringIO(TEST_CRAWL_LOG), one_map, hit_mimetypes=FULLTEXT_MIMETYPES)
+    one_counts = backward_hits(hits, one_map, one_out, one_counts)
+
+    assert one_counts == two_counts
+    assert one_counts['inserted'] == 2
+    query = 'SELECT * FROM crawl_result ORDER BY rowid'
+    assert list(one_out.execute(query)) == list(two_out.execute(query))
+
+def test_everything_stdin_needs_single_pass():
+    try:
+        everything('-', io.StringIO(""), sqlite3.connect(':memory:'), sqlite3.connect(':memory:'))
+        assert False
+    except ValueError:
+        pass
+
+def test_parallel_workers(tmp_path):
+    seeds = "http://a.com/1\t10.123/a\nhttp://b.com/x\t10.123/b\nhttp://c.com/missing\t10.123/c\n"
+    # workers open the map by path, so it has to be on disk
+    results = [run_test_chain(seeds, sqlite3.connect(str(tmp_path / 'map{}.sqlite'.format(workers))),
+        backward_kwargs={'chain_cache_size': 0, 'workers': workers}, forward_kwargs={'workers': workers}) for workers in (1, 2)]
+    assert results[0] == results[1]
+    assert results[1][1]['existing-id-updated'] == 1
+
+def test_pipeline(tmp_path):
+    seeds = "http://a.com/1\t10.123/a\nhttp://b.com/x\t10.123/b\nhttp://c.com/missing\t10.123/c\n"
+    results = []
+    for pipeline in (False, True):
+        map_db = sqlite3.connect(str(tmp_path / 'map{}.sqlite'.format(int(pipeline))))
+        results.append(run_test_chain(seeds, map_db, referrer_kwargs={'pipeline': pipeline},
+            backward_kwargs={'chain_cache_size': 0, 'pipeline': pipeline}, forward_kwargs={'pipeline': pipeline})
+            + (list(map_db.execute('SELECT * FROM referrer ORDER BY rowid')),))
+    assert results[0] == results[1]
+    assert results[1][1]['existing-id-updated'] == 1
+
+# rough per-URL cost of a ChainCache entry (key, OrderedDict link, row)
+CHAIN_CACHE_ENTRY_BYTES = 300
+# memory held back from the map for the output DB page cache, parse
+# batches, hits buffered for backward, etc
+MEMORY_BUDGET_RESERVE = 256 * 2**20
+# sqlite3 page cache overhead over the raw database size
+MAP_CACHE_OVERHEAD = 1.25
+
+def estimate_map_size(log_paths, compact=False, sample_lines=20000):
+    """
+    Estimates the size (bytes) of the referrer map for a crawl log, by
+    building a map of the first sample_lines lines in memory and scaling it
+    by how much of the (possibly compressed) input those lines were. Returns
+    None for stdin. Compact maps come out high (37 vs 21 MB on a 300k line
+    crawl), since URLs repeat more over a whole crawl than in its first lines.
+    """
+    paths = expand_input_paths(log_paths)
+    if '-' in paths:
+        return None
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    rows = []
+    with open(paths[0], 'rb') as raw:
+        f = open_compressed(paths[0], raw)
+        for raw_line in itertools.islice(f, sample_lines):
+            line = parse_crawl_line(raw_line)
+            if line and not (line.url.startswith('dns:') or line.url.startswith('whois:')):
+                rows.append((line.url, line.referrer_url, line.status_code, line.breadcrumbs, line.mimetype,
+                    'duplicate:digest' in line.annotations))
+        sample_bytes = raw.tell()
+    if not sample_bytes:
+        return 0
+    db = sqlite3.connect(':memory:')
+    if compact:
+        db.executescript(COMPACT_MAP_SCHEMA)
+        writer = CompactMapWriter(db)
+        rows = [writer.encode(row) for row in rows]
+        writer.flush()
+        db.executemany("INSERT INTO referrer_row VALUES (?,?,?,?,?,?)", rows)
+        db.executescript(COMPACT_MAP_INDEXES)
+    else:
+        db.execute("CREATE TABLE referrer (url text, referrer text, status_code text, breadcrumbs text, mimetype text, is_dedupe bool)")
+        db.executemany("INSERT INTO referrer VALUES (?,?,?,?,?,?)", rows)
+        db.executescript(MAP_INDEXES)
+    (pages,), = db.execute("PRAGMA page_count")
+    (page_size,), = db.execute("PRAGMA page_size")
+    db.close()
+    return int(pages * page_size * total_bytes / sample_bytes)
+
+def choose_map_storage(estimate, map_budget, needs_path=False):
+    """
+    Picks where to build the referrer map, given its estimated size and the
+    part of the memory budget left for it:
+
+    - 'memory': a plain :memory: database, when it fits twice over
+    - 'hybrid': an anonymous temporary database (sqlite3.connect('')), which
+      sqlite3 keeps in its page cache (sized to the budget) and only spills
+      to a temp file if the estimate was low
+    - 'disk': a map file, with a page cache and mmap_size splitting the budget
+
+    Parallel workers and pipeline threads open the map by path, so those
+    always get 'disk'.
+    """
+    if needs_path:
+        return 'disk'
+    if estimate is None:
+        return 'hybrid'
+    size = estimate * MAP_CACHE_OVERHEAD
+    if size * 2 <= map_budget:
+        return 'memory'
+    if size <= map_budget:
+        return 'hybrid'
+    return 'disk'
+
+def plan_map_db(log_paths, memory_budget, map_db_file=':memory:', output_db_file=None, compact=False, chain_cache_size=1000000, needs_path=False):
+    """
+    Opens the referrer map for 'everything --memory-budget': estimates the map
+    size from the input, subtracts what the process already uses, the chain
+    cache and a fixed reserve from the budget, and picks in-memory, hybrid or
+    on-disk storage (see choose_map_storage) with a page cache to match.
+
+    An explicit map_db_file is always used as-is (on disk); otherwise an
+    on-disk map goes next to the output DB (and main removes it once
+    everything is done). Fails early, with ValueError, if
+    the budget is more than the memory available or too small to run in.
+
+    Returns (map_db, map cache_size for referrer(), bytes left for the map).
+    """
+    baseline = current_rss() or 0
+    available = available_memory()
+    if available and memory_budget > baseline + available:
+        raise ValueError("--memory-budget {:.0f} MB is more than the {:.0f} MB this process could have (MemAvailable plus what it uses now)".format(
+            memory_budget / 2**20, (baseline + available) / 2**20))
+    chain_cache = chain_cache_size * CHAIN_CACHE_ENTRY_BYTES
+    map_budget = memory_budget - baseline - chain_cache - MEMORY_BUDGET_RESERVE
+    if map_budget < 64 * 2**20:
+        raise ValueError("--memory-budget {:.0f} MB is too small: {:.0f} MB already in use, {:.0f} MB for --chain-cache-size {} and {:.0f} MB reserved leave {:.0f} MB for the map (at least 64 MB needed)".format(
+            memory_budget / 2**20, baseline / 2**20, chain_cache / 2**20, chain_cache_size,
+            MEMORY_BUDGET_RESERVE / 2**20, map_budget / 2**20))
+    estimate = estimate_map_size(log_paths, compact=compact)
+    storage = choose_map_storage(estimate, map_budget, needs_path=needs_path or map_db_file != ':memory:')
+    print("Memory budget {:.0f} MB: {:.0f} MB for the map, estimated at {}; using {} map".format(
+        memory_budget / 2**20, map_budget / 2**20,
+        "{:.0f} MB".format(estimate / 2**20) if estimate is not None else "? (stdin)", storage))
+    METRICS.memory_budget = memory_budget
+    if storage == 'memory':
+        return sqlite3.connect(':memory:'), 20000, map_budget
+    cache_kib = map_budget // 1024
+    if storage == 'hybrid':
+        return sqlite3.connect(''), -cache_kib, map_budget
+    if map_db_file == ':memory:':
+        map_db_file = os.path.splitext(output_db_file)[0] + '-map.sqlite'
+        if os.path.exists(map_db_file):
+            raise ValueError("{} already exists (from an earlier run?); remove it first".format(map_db_file))
+        print("Building referrer map on disk: {}".format(map_db_file))
+    map_db = sqlite3.connect(map_db_file)
+    map_db.execute("PRAGMA main.mmap_size = {}".format(map_budget // 2))
+    return map_db, -(cache_kib // 2), map_budget
+
+def test_memory_budget(tmp_path):
+    assert parse_size('512M') == 512 * 2**20
+    assert parse_size('1.5GiB') == int(1.5 * 2**30)
+    assert parse_size('4096') == 4096
+    assert choose_map_storage(10, 100) == 'memory'
+    assert choose_map_storage(60, 100) == 'hybrid'
+    assert choose_map_storage(200, 100) == 'disk'
+    assert choose_map_storage(10, 100, needs_path=True) == 'disk'
+    assert choose_map_storage(None, 100) == 'hybrid'
+    log_path = tmp_path / 'crawl.log'
+    log_path.write_text(TEST_CRAWL_LOG)
+    assert estimate_map_size(str(log_path)) > 0
+    try:
+        plan_map_db(str(log_path), 2**20, output_db_file=str(tmp_path / 'out.sqlite'))
+        assert False
+    except ValueError:
+        pass
+    METRICS.memory_budget = 1
+    try:
+        METRICS.check_memory('test')
+        assert False
+    except MemoryError:
+        pass
+    finally:
+        METRICS.memory_budget = None
+
+def everything(log_file, seed_id_file, map_db, output_db, hit_mimetypes=FULLTEXT_MIMETYPES, map_engine='sqlite', single_pass=False, chain_cache_size=1000000, set_based_forward=False, incremental=False, compact_map=False, workers=1, cte=False, pipeline=False, map_cache_size=20000, memory_limit=None):
+    """
+    In single_pass mode, the crawl log is only read once (so it can be '-' for
+    stdin): backward candidate hits are buffered while building the referrer
+    map, then resolved. Output rows and counts are the same either way.
+
+    In incremental mode, log_file and seed_id_file are paths, and only input
+    appended since the last incremental run is read (see referrer_incremental).
+
+    With workers > 1, backward and forward resolution run in parallel over
+    the finished map (which has to be on disk).
+
+    With cte, both are resolved with recursive queries inside sqlite3 (see
+    backward_cte and forward_cte).
+
+    With pipeline, every stage parses, resolves and writes in separate
+    threads (see PipelineStage); the map has to be on disk.
+
+    map_cache_size is passed on to referrer(), and memory_limit to open_map()
+    (see plan_map_db, for --memory-budget).
+    """
+    if not single_pass and '-' in expand_input_paths(log_file):
+        raise ValueError("reading the crawl log from stdin needs --single-pass (otherwise it's read twice)")
+    if incremental:
+        referrer_incremental(log_file, map_db)
+        bcounts = backward_incremental(log_file, map_db, output_db, hit_mimetypes=hit_mimetypes, map_engine=map_engine, chain_cache_size=chain_cache_size)
+        fcounts = forward_incremental(seed_id_file, map_db, output_db, map_engine=map_engine)
+        m = map_db
+    elif cte:
+        referrer(InputReader(log_file), map_db, compact=compact_map, cache_size=map_cache_size)
+        bcounts = backward_cte(InputReader(log_file), map_db, output_db, hit_mimetypes=hit_mimetypes)
+        m = map_db
+    elif single_pass:
+        log = InputReader(log_file)
+        hits, bcounts = referrer(log, map_db, hit_mimetypes=hit_mimetypes, compact=compact_map, cache_size=map_cache_size)
+        m = open_map(map_db, map_engine, memory_limit=memory_limit)
+        print("Mapping backward from buffered log file 200s to initial urls")
+        bcounts = backward_hits(hits, m, output_db, bcounts, hit_mimetypes=hit_mimetypes, chain_cache_size=chain_cache_size)
+    elif workers > 1 or pipeline:
+        referrer(InputReader(log_file), map_db, compact=compact_map, pipeline=pipeline, cache_size=map_cache_size)
+        bcounts = backward(InputReader(log_file), map_db, output_db, hit_mimetypes=hit_mimetypes, map_engine=map_engine, chain_cache_size=chain_cache_size, workers=workers, pipeline=pipeline)
+        m = map_db
+    else:
+        referrer(InputReader(log_file), map_db, compact=compact_map, cache_size=map_cache_size)
+        m = open_map(map_db, map_engine, memory_limit=memory_limit)
+        bcounts = backward(InputReader(log_file), m, output_db, hit_mimetypes=hit_mimetypes, chain_cache_size=chain_cache_size)
+    if not incremental:
+        fcounts = forward(seed_id_file, m, output_db, map_engine=map_engine, set_based=set_based_forward, workers=workers, cte=cte, pipeline=pipeline)
+    m.close()
     print()
     print("Everything complete!")
     print(bcounts)
     print(fcounts)
+    if METRICS.memory_budget:
+        print("Peak RSS: {:.0f} MB (--memory-budget {:.0f} MB)".format(peak_rss() / 2**20, METRICS.memory_budget / 2**20))
+    return bcounts, fcounts
+
+def follow(log_paths, map_db, output_db, seed_paths=None, hit_mimetypes=FULLTEXT_MIMETYPES, map_engine='sqlite', chain_cache_size=1000000, interval=60.0, passes=None, summary=True):
+    """
+    Tails a crawl log while the crawl is still running: every interval
+    seconds, lines appended since the last pass (including the rest of a log
+    that has been rotated away; see IngestLog) go through
+    referrer_incremental, backward_incremental and, with seed_paths,
+    forward_incremental. Each stage commits as it goes, and (unless summary
+    is False) the summary tables are rebuilt after each pass, so reports always see consistent
+    results up to the last commit; the output stays in WAL mode so they can
+    be run without blocking the writer.
+
+    Runs until interrupted, or for the given number of passes.
+    """
+    print("Following crawl log(s): {}".format(log_paths if isinstance(log_paths, str) else ' '.join(log_paths)))
+    i = 0
+    while passes is None or i < passes:
+        start = time.time()
+        try:
+            ready = all(os.path.exists(path) for path in expand_input_paths(log_paths))
+        except FileNotFoundError:
+            ready = False
+        if ready:
+            referrer_incremental(log_paths, map_db)
+            bcounts = backward_incremental(log_paths, map_db, output_db, hit_mimetypes=hit_mimetypes, map_engine=map_engine, chain_cache_size=chain_cache_size)
+            fcounts = collections.Counter()
+            if seed_paths:
+                fcounts = forward_incremental(seed_paths, map_db, output_db, map_engine=map_engine)
+            if summary:
+                summarize(output_db)
+            print("Pass {} done in {:.1f}s: {} new hits, {} chains extended, {} seeds resolved".format(
+                i + 1, time.time() - start, bcounts['inserted'], bcounts['chain-extended'], fcounts['inserted']))
+        else:
+            print("Waiting for crawl log(s) to appear...")
+        i += 1
+        if passes is None or i < passes:
+            time.sleep(max(interval - (time.time() - start), 0))
+
+def test_follow(tmp_path):
+    lines = TEST_CRAWL_LOG.splitlines(keepends=True)
+    seeds = "http://a.com/1\t10.123/a\nhttp://b.com/x\t10.123/b\nhttp://c.com/missing\t10.123/c\n"
+    log_path, seed_path = str(tmp_path / 'crawl.log'), str(tmp_path / 'seeds.tsv')
+    query = 'SELECT * FROM crawl_result ORDER BY initial_url, final_url, hit'
+    with open(seed_path, 'w') as f:
+        f.write(seeds)
+    with open(str(tmp_path / 'full.log'), 'w') as f:
+        f.write(TEST_CRAWL_LOG)
+    full_out = sqlite3.connect(':memory:')
+    everything(str(tmp_path / 'full.log'), io.StringIO(seeds), sqlite3.connect(':memory:'), full_out)
+
+    map_db = sqlite3.connect(str(tmp_path / 'map.sqlite'))
+    output_db = sqlite3.connect(str(tmp_path / 'out.sqlite'))
+    follow(log_path, map_db, output_db, seed_paths=seed_path, passes=1)
+    third = len(lines) // 3
+    with open(log_path, 'w') as f:
+        f.write("".join(lines[:third]))
+    follow(log_path, map_db, output_db, seed_paths=seed_path, passes=1)
+    # more lines, then rotated away before the next pass
+    with open(log_path, 'a') as f:
+        f.write("".join(lines[third:2*third]))
+    os.rename(log_path, log_path + '.20200101000000')
+    with open(log_path, 'w') as f:
+        f.write("".join(lines[2*third:]))
+    follow(log_path, map_db, output_db, seed_paths=seed_path, passes=2, interval=0)
+    # readable by another connection while the writer's is still open
+    reader = sqlite3.connect(str(tmp_path / 'out.sqlite'))
+    assert list(reader.execute(query)) == list(full_out.execute(query))
+    assert reader.execute("SELECT rows FROM summary_totals").fetchone()[0] == len(list(full_out.execute(query)))
+
+    # --no-summary
+    output_db = sqlite3.connect(str(tmp_path / 'out-nosummary.sqlite'))
+    follow(log_path, sqlite3.connect(str(tmp_path / 'map-nosummary.sqlite')), output_db, seed_paths=seed_path, passes=1, summary=False)
+    assert list(output_db.execute("SELECT name FROM sqlite_master WHERE name LIKE 'summary_%'")) == []
+
+def test_incremental(tmp_path, monkeypatch):
+    lines = TEST_CRAWL_LOG.splitlines(keepends=True)
+    seeds = "http://a.com/1\t10.123/a\nhttp://b.com/x\t10.123/b\nhttp://c.com/missing\t10.123/c\n"
+    log_path, seed_path = str(tmp_path / 'crawl.log'), str(tmp_path / 'seeds.tsv')
+    query = 'SELECT * FROM crawl_result ORDER BY initial_url, final_url, hit'
+
+    with open(log_path, 'w') as f:
+        f.write(TEST_CRAWL_LOG)
+    with open(seed_path, 'w') as f:
+        f.write(seeds)
+    full_out = sqlite3.connect(':memory:')
+    everything(log_path, io.StringIO(seeds), sqlite3.connect(':memory:'), full_out)
+
+    half = len(lines) // 2
+    # second chunk ends with a partly written line, finished by the third
+    chunks = ["".join(lines[:half]), lines[half][:10], lines[half][10:] + "".join(lines[half+1:])]
+    with open(log_path, 'w') as f:
+        pass
+    for chunk in chunks:
+        with open(log_path, 'a') as f:
+            f.write(chunk)
+        output_db = sqlite3.connect(str(tmp_path / 'out.sqlite'))
+        everything(log_path, seed_path, sqlite3.connect(str(tmp_path / 'map.sqlite')), output_db, incremental=True)
+        output_db.close()
+    output_db = sqlite3.connect(str(tmp_path / 'out.sqlite'))
+    assert list(output_db.execute(query)) == list(full_out.execute(query))
+
+    # unchanged seeds and no new map rows: no seed URLs affected, so the
+    # seed file isn't even opened
+    opened = []
+    real_open = open_decompressed
+    monkeypatch.setattr(sys.modules[__name__], 'open_decompressed', lambda path, *args: opened.append(path) or real_open(path, *args))
+    map_db = sqlite3.connect(str(tmp_path / 'map.sqlite'))
+    counts = forward_incremental(seed_path, map_db, output_db)
+    assert opened == []
+    assert counts == collections.Counter({'inserted': 0})
+    assert list(output_db.execute(query)) == list(full_out.execute(query))
+    # only a new seed line is read
+    with open(seed_path, 'a') as f:
+        f.write("http://a.com/1\t10.123/a2\n")
+    counts = forward_incremental(seed_path, map_db, output_db)
+    assert opened == [seed_path]
+    assert counts['existing-complete'] == 1 and counts['inserted'] == 0
+
+class PrefixedWriter:
+    """
+    Wraps a text stream so every line written is tagged with a prefix (eg,
+    shard name), to keep progress output from parallel workers readable.
+    """
+
+    def __init__(self, stream, prefix):
+        self.stream = stream
+        self.prefix = prefix
+        self.partial = ''
+
+    def write(self, text):
+        # only write whole lines, so lines from different processes don't mix
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        if lines:
+            self.stream.write(''.join(self.prefix + line + '\n' for line in lines))
+            self.stream.flush()
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+def shard_name(log_path):
+    """
+    Short name for a shard, from its crawl log filename. Eg,
+    'CRAWL-2018-07.wbgrp-svc282.us.archive.org.crawl.log.gz' becomes
+    'CRAWL-2018-07.wbgrp-svc282.us.archive.org'
+    """
+    name = os.path.basename(log_path)
+    for suffix in ('.gz', '.bz2', '.xz', '.zst', '.log', '.crawl'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+def run_shard(shard):
+    """
+    Process pool worker: runs referrer/backward/forward for a single shard,
+    with its own on-disk map and output DB. Returns (name, bcounts, fcounts).
+    """
+    name, log_path, seed_path, map_path, out_path, hit_mimetypes, map_engine = shard
+    sys.stdout = PrefixedWriter(sys.stdout, "[{}] ".format(name))
+    bcounts, fcounts = everything(log_path,
+        InputReader(seed_path),
+        sqlite3.connect(map_path, isolation_level='EXCLUSIVE'),
+        sqlite3.connect(out_path, isolation_level='EXCLUSIVE'),
+        hit_mimetypes=hit_mimetypes,
+        map_engine=map_engine,
+        single_pass=True)
+    return name, bcounts, fcounts
+
+def combine_outputs(shard_db_paths, output_db):
+    """
+    Concatenates crawl_result rows from several per-shard output DBs into one
+    output DB, then builds indexes once at the end.
+    """
+    create_out_table(output_db)
+    for path in shard_db_paths:
+        print("Combining {}".format(path))
+        output_db.execute("ATTACH DATABASE ? AS shard", [path])
+        insert_result_rows(output_db, "SELECT * FROM shard.crawl_result")
+        output_db.commit()
+        output_db.execute("DETACH DATABASE shard")
+    print("Building indices (this can be slow)...")
+    create_result_indexes(output_db)
+
+def merge_latest(row):
+    # latest final_timestamp, then crawled (a miss with a final_url, rather
+    # than a seed missing from that crawl's map), then having an identifier
+    return (row[6] or '', row[4] is not None, bool(row[1]))
+
+def merge_url_rows(rows, counts):
+    """
+    Resolves the crawl_result rows for one initial_url, from all merge inputs:
+
+    - a hit beats a miss: if any input has hit rows, misses are dropped
+    - the latest timestamp wins: hit rows are kept one per final_url, misses
+      one per initial_url, the latest (then crawled at all, then with an
+      identifier; ties go to the earlier input)
+    - an identifier beats a null: kept rows without one get the identifier of
+      the latest row that has one (hits first), like forward() does for
+      backward rows
+    """
+    hits = [row for row in rows if row[11]]
+    if hits:
+        counts['dropped-miss'] += len(rows) - len(hits)
+        latest = collections.OrderedDict()
+        for row in hits:
+            current = latest.get(row[4])
+            if current is None or merge_latest(row) > merge_latest(current):
+                latest[row[4]] = row
+        kept = list(latest.values())
+        counts['dropped-duplicate'] += len(hits) - len(kept)
+    else:
+        kept = [max(rows, key=merge_latest)]
+        counts['dropped-duplicate'] += len(rows) - 1
+    with_identifier = [row for row in rows if row[1]]
+    if with_identifier:
+        identifier = max(with_identifier, key=lambda row: (bool(row[11]), row[6] or ''))[1]
+        for i, row in enumerate(kept):
+            if not row[1]:
+                kept[i] = row[:1] + (identifier,) + row[2:]
+                counts['identifier-filled'] += 1
+    return kept
+
+def merge(db_paths, output_db, batch_size=10000):
+    """
+    Combines the crawl_result tables of several output DBs (eg, per-shard
+    outputs, where the same seed can be a miss in one and a hit in another)
+    into a new output DB, resolving rows for the same initial_url with
+    merge_url_rows.
+
+    Inputs are read in initial_url order (by index, or sqlite3's external
+    sort if they have none) and k-way merged as streams, so only one URL's
+    rows are held in memory at a time. Indexes are built once at the end.
+    """
+    paths = expand_input_paths(db_paths)
+    out_path = db_path(output_db)
+    if out_path and os.path.abspath(out_path) in [os.path.abspath(path) for path in paths]:
+        raise ValueError("can't merge an output DB into itself: {}".format(out_path))
+    create_out_table(output_db)
+    if output_db.execute("SELECT 1 FROM crawl_result LIMIT 1").fetchone():
+        raise ValueError("merge output DB already has results (pass it as an input to a new one instead)")
+    print("Merging {} output DBs".format(len(paths)))
+    counts = collections.Counter({'inserted': 0})
+    sources = []
+    for path in paths:
+        db = sqlite3.connect('file:{}?mode=ro'.format(urllib.parse.quote(os.path.abspath(path))), uri=True)
+        if is_compact_output(db):
+            # view rows have no rowid; order by the underlying rows' instead
+            register_result_functions(db)
+            sources.append(db.execute(COMPACT_RESULT_ROWS + " ORDER BY r.initial_url, r.rowid"))
+        else:
+            sources.append(db.execute("SELECT * FROM crawl_result ORDER BY initial_url, rowid"))
+    rows = heapq.merge(*sources, key=lambda row: row[0])
+    METRICS.start_stage('merge')
+    writer = ResultWriter(output_db)
+    batch = []
+    for initial_url, url_rows in itertools.groupby(rows, key=lambda row: row[0]):
+        url_rows = list(url_rows)
+        counts['rows-read'] += len(url_rows)
+        batch.extend(merge_url_rows(url_rows, counts))
+        if len(batch) >= batch_size:
+            writer.insert_many(batch)
+            counts['inserted'] += len(batch)
+            batch = []
+            output_db.commit()
+            METRICS.progress('merge', counts['inserted'])
+    writer.insert_many(batch)
+    counts['inserted'] += len(batch)
+    output_db.commit()
+    print("Building indices (this can be slow)...")
+    with METRICS.phase('index-build'):
+        create_result_indexes(output_db)
+    METRICS.finish_stage('merge', rows=counts['inserted'], counts=counts)
+    print("Merge complete.")
+    print(counts)
+    return counts
 
-def postprocess(sha1_status_file, output_db):
+def test_merge(tmp_path):
+    def row(url, identifier, final_url, timestamp, hit):
+        return (url, identifier, 'a.com', 'L', final_url, 'a.com', timestamp, '200' if hit else '404', None, None, False, hit, None)
+    shard_rows = [
+        [row('http://a.com/1', '10.123/1', 'http://a.com/1', '20180101000000', False),
+         row('http://a.com/2', None, 'http://a.com/2.pdf', '20180101000000', True),
+         row('http://a.com/3', '10.123/3', 'http://a.com/3', '20180101000000', False),
+         row('http://a.com/5', '10.123/5', None, None, False)],
+        [row('http://a.com/1', None, 'http://a.com/1.pdf', '20180102000000', True),
+         row('http://a.com/2', '10.123/2', 'http://a.com/2.pdf', '20180102000000', True),
+         row('http://a.com/3', None, 'http://a.com/3', '20180102000000', False),
+         row('http://a.com/4', None, 'http://a.com/4.pdf', '20180102000000', True),
+         row('http://a.com/5', None, 'http://a.com/5.html', None, False)],
+    ]
+    paths = []
+    for i, rows in enumerate(shard_rows):
+        paths.append(str(tmp_path / 'shard{}.sqlite'.format(i)))
+        db = sqlite3.connect(paths[-1])
+        create_out_table(db)
+        db.executemany("INSERT INTO crawl_result VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+        db.commit()
+        db.close()
+    output_db = sqlite3.connect(str(tmp_path / 'merged.sqlite'))
+    counts = merge(paths, output_db)
+    merged = list(output_db.execute('SELECT initial_url, identifier, final_url, final_timestamp, hit FROM crawl_result ORDER BY rowid'))
+    assert merged == [
+        ('http://a.com/1', '10.123/1', 'http://a.com/1.pdf', '20180102000000', 1),
+        ('http://a.com/2', '10.123/2', 'http://a.com/2.pdf', '20180102000000', 1),
+        ('http://a.com/3', '10.123/3', 'http://a.com/3', '20180102000000', 0),
+        ('http://a.com/4', None, 'http://a.com/4.pdf', '20180102000000', 1),
+        # crawled beats missing from one crawl's map
+        ('http://a.com/5', '10.123/5', 'http://a.com/5.html', None, 0),
+    ]
+    assert counts['dropped-miss'] == 1
+    assert counts['dropped-duplicate'] == 3
+    assert counts['identifier-filled'] == 3
+    try:
+        merge(paths, output_db)
+        assert False
+    except ValueError:
+        pass
+
+def shards(shard_files, output_db_file, work_dir=None, processes=None, hit_mimetypes=FULLTEXT_MIMETYPES, map_engine='sqlite'):
+    """
+    Runs the full referrer/backward/forward pipeline for a set of shards
+    (per-machine crawl logs, each with a matching seed_id file) in a process
+    pool, one map and output DB per shard, then merges the outputs (see
+    merge).
+
+    `shard_files` is a list of (log_path, seed_id_path) tuples.
+    """
+    work_dir = work_dir or os.path.dirname(os.path.abspath(output_db_file))
+    processes = processes or min(len(shard_files), os.cpu_count() or 1)
+    jobs = []
+    for log_path, seed_path in shard_files:
+        name = shard_name(log_path)
+        if name in [j[0] for j in jobs]:
+            name = "{}.{}".format(name, len(jobs))
+        jobs.append((name,
+            log_path,
+            seed_path,
+            os.path.join(work_dir, name + '.map.sqlite'),
+            os.path.join(work_dir, name + '.out.sqlite'),
+            hit_mimetypes,
+            map_engine))
+
+    for job in jobs:
+        for path in (job[3], job[4]):
+            if os.path.exists(path):
+                # re-running would append duplicate map and output rows
+                raise FileExistsError("per-shard DB already exists (remove it first): {}".format(path))
+
+    print("Processing {} shards with {} processes".format(len(jobs), processes))
+    total = collections.Counter()
+    with multiprocessing.Pool(processes) as pool:
+        for name, bcounts, fcounts in pool.imap_unordered(run_shard, jobs):
+            print("Shard complete: {}".format(name))
+            print(bcounts)
+            print(fcounts)
+            total.update({'shards': 1, 'backward-inserted': bcounts['inserted'], 'forward-inserted': fcounts['inserted']})
+
+    output_db = sqlite3.connect(output_db_file, isolation_level='EXCLUSIVE')
+    merge([j[4] for j in jobs], output_db)
+    output_db.close()
+    print("All shards complete!")
+    print(total)
+    return total
+
+def test_shards(tmp_path):
+    lines = TEST_CRAWL_LOG.splitlines(keepends=True)
+    # http://b.com/x is a seed of both shards, but only crawled in the second
+    shard_files = [
+        ("".join(lines[:5]), "http://a.com/1\t10.123/a\nhttp://b.com/x\t10.123/b\n"),
+        ("".join(lines[5:]), "http://b.com/x\t10.123/b\nhttp://c.com/missing\t10.123/c\n"),
+    ]
+    paths = []
+    for i, (log, seeds) in enumerate(shard_files):
+        log_path, seed_path = tmp_path / 'crawl{}.log'.format(i), tmp_path / 'seed{}.tsv'.format(i)
+        log_path.write_text(log)
+        seed_path.write_text(seeds)
+        paths.append((str(log_path), str(seed_path)))
+    total = shards(paths, str(tmp_path / 'combined.sqlite'), processes=2)
+    assert total['shards'] == 2
+
+    (tmp_path / 'crawl.log').write_text(TEST_CRAWL_LOG)
+    single_out = sqlite3.connect(':memory:')
+    everything(str(tmp_path / 'crawl.log'), io.StringIO("http://a.com/1\t10.123/a\nhttp://b.com/x\t10.123/b\nhttp://c.com/missing\t10.123/c\n"),
+        sqlite3.connect(':memory:'), single_out)
+    query = 'SELECT * FROM crawl_result ORDER BY initial_url, final_url, hit'
+    combined = list(sqlite3.connect(str(tmp_path / 'combined.sqlite')).execute(query))
+    assert combined == list(single_out.execute(query))
+    assert [row[:2] for row in combined if row[0] == 'http://b.com/x'] == [('http://b.com/x', '10.123/b')]
+
+def postprocess(sha1_status_file, output_db, batch_size=50000):
+    """
+    Loads a (sha1, status) TSV into a temp table, validating as it goes, then
+    applies all the status updates with a single UPDATE joined on final_sha1
+    (making sure that column is indexed first).
+
+    Same results and counts as updating row-by-row: if a SHA-1 appears more
+    than once, the last status wins, and every line counts towards
+    'rows-updated' or 'sha1-not-found'.
+
+    For compact outputs, the join and update go straight to crawl_result_row
+    (on SHA-1 blobs) instead of through the view.
+    """
     print("Updating database with post-processing status")
     print("""If script fails (on old databases) you may need to manually:
         ALTER TABLE crawl_result ADD COLUMN postproc_status text;""")
     counts = collections.Counter({'lines-parsed': 0})
+    compact = is_compact_output(output_db)
+    if compact:
+        register_result_functions(output_db)
+    table = result_rows_table(output_db)
     c = output_db.cursor()
+    c.executescript("""
+        DROP TABLE IF EXISTS temp.postproc;
+        DROP TABLE IF EXISTS temp.postproc_last;
+        CREATE TEMP TABLE postproc
+            (seq INTEGER PRIMARY KEY,
+             sha1 text NOT NULL,
+             status text);
+    """)
 
+    METRICS.start_stage('postprocess', sha1_status_file)
+    insert_many = METRICS.timed('insert', c.executemany)
     i = 0
+    batch = []
     for raw_line in sha1_status_file:
         line = raw_line.strip().split('\t')
         if not line or len(line) == 1:
@@ -603,7 +4746,7 @@ def postprocess(sha1_status_file, output_db):
         if len(line) == 2:
             sha1, status = line[0:2]
         else:
-            print("WEIRD: {}".format(raw_line))
+            warn('weird-status-line', "WEIRD: {}".format(raw_line))
             assert len(line) <= 2
 
         # parse/validate SHA-1
@@ -613,58 +4756,424 @@ def postprocess(sha1_status_file, output_db):
             counts['skip-bad-sha1'] += 1
             continue
         status = status.strip()
-
-        res = c.execute('UPDATE crawl_result SET postproc_status=? WHERE final_sha1=?', [status, sha1])
-        if res.rowcount == 0:
-            counts['sha1-not-found'] += 1
-        else:
-            counts['rows-updated'] += res.rowcount
+        batch.append((sha1, status))
 
         i = i+1
-        if i % 2000 == 0:
-            print("... postprocess {}".format(i))
-            output_db.commit()
+        if len(batch) >= batch_size:
+            insert_many("INSERT INTO postproc (sha1, status) VALUES (?,?)", batch)
+            batch = []
+            METRICS.progress('postprocess', i)
+    if batch:
+        insert_many("INSERT INTO postproc (sha1, status) VALUES (?,?)", batch)
 
-    output_db.commit()
+    print("Building indices (this can be slow)...")
+    with METRICS.phase('index-build'):
+        create_result_indexes(output_db, ('final_sha1',))
+        c.executescript("""
+            -- last status for each SHA-1 (sqlite3 takes bare columns from the MAX() row)
+            CREATE TEMP TABLE postproc_last
+                (sha1 text PRIMARY KEY,
+                 status text);
+            INSERT INTO postproc_last
+                SELECT {}, status FROM (SELECT sha1, status, MAX(seq) FROM postproc GROUP BY sha1);
+        """.format('sha1_blob(sha1)' if compact else 'sha1'))
+
+    not_found, updated = list(c.execute("""
+        SELECT COALESCE(SUM(n = 0), 0), COALESCE(SUM(n), 0)
+        FROM (SELECT COUNT(r.final_sha1) AS n
+              FROM postproc p LEFT JOIN {} r ON r.final_sha1 = {}
+              GROUP BY p.seq)
+    """.format(table, 'sha1_blob(p.sha1)' if compact else 'p.sha1')))[0]
+    if not_found:
+        counts['sha1-not-found'] += not_found
+    if updated:
+        counts['rows-updated'] += updated
+
+    print("Applying updates...")
+    with METRICS.phase('update'):
+        if compact:
+            c.executescript("""
+                INSERT OR IGNORE INTO result_value (value) SELECT DISTINCT status FROM postproc_last;
+                UPDATE crawl_result_row
+                SET postproc_status = (SELECT v.id FROM postproc_last l JOIN result_value v ON v.value = l.status
+                                       WHERE l.sha1 = crawl_result_row.final_sha1)
+                WHERE final_sha1 IN (SELECT sha1 FROM postproc_last);
+            """)
+        else:
+            c.execute("""
+                UPDATE crawl_result
+                SET postproc_status = (SELECT l.status FROM postproc_last l WHERE l.sha1 = crawl_result.final_sha1)
+                WHERE final_sha1 IN (SELECT sha1 FROM postproc_last)
+            """)
+        output_db.commit()
+    c.executescript("""
+        DROP TABLE temp.postproc;
+        DROP TABLE temp.postproc_last;
+    """)
 
     c.close()
-    print("Forward map complete.")
+    METRICS.finish_stage('postprocess', rows=i, counts=counts)
+    print("Post-processing complete.")
     print(counts)
     return counts
 
-def dump_json(read_db, only_identifier_hits=False, max_per_identifier=None, only_direct_breadcrumbs=False):
+def test_postprocess():
+    output_db = sqlite3.connect(':memory:')
+    create_out_table(output_db)
+    for sha1 in ('A' * 32, 'A' * 32, 'B' * 32):
+        output_db.execute("INSERT INTO crawl_result (initial_url, final_sha1) VALUES (?,?)", ['http://a.com/', sha1])
+    statuses = io.StringIO("sha1:{a}\t200\n{b}\t500\nsha1:{a}\t404 \nsha1:{c}\t200\nsha1:short\t200\nblah\n".format(
+        a='A' * 32, b='B' * 32, c='C' * 32))
+    counts = postprocess(statuses, output_db)
+    assert counts['rows-updated'] == 5
+    assert counts['sha1-not-found'] == 1
+    assert counts['skip-bad-sha1'] == 1
+    assert counts['skip-raw-line'] == 1
+    assert list(output_db.execute("SELECT final_sha1, postproc_status FROM crawl_result ORDER BY rowid")) == [
+        ('A' * 32, '404'), ('A' * 32, '404'), ('B' * 32, '500')]
+
+# Pre-aggregated crawl_result stats, for examples/report_summary_template.md.
+# summary_cube is one GROUP BY scan over everything the report breaks down by;
+# the smaller tables are rolled up from it. Distinct counts can't be rolled
+# up, so they get a scan of their own (into the one row of summary_totals).
+# {cube} and {rows} are SUMMARY_CUBE and the table rows are stored in.
+SUMMARY_TABLES = """
+    DROP TABLE IF EXISTS summary_cube;
+    DROP TABLE IF EXISTS summary_totals;
+    DROP TABLE IF EXISTS summary_initial_domain;
+    DROP TABLE IF EXISTS summary_final_domain;
+    DROP TABLE IF EXISTS summary_status;
+    DROP TABLE IF EXISTS summary_mimetype;
+    DROP TABLE IF EXISTS summary_breadcrumbs;
+
+    CREATE TABLE summary_cube AS {cube};
+
+    CREATE TABLE summary_totals AS
+        SELECT COUNT(*) AS rows,
+               COALESCE(SUM(hit), 0) AS hits,
+               COUNT(DISTINCT identifier) AS identifiers,
+               COUNT(DISTINCT initial_url) AS uris,
+               COUNT(DISTINCT initial_domain) AS domains,
+               COUNT(DISTINCT CASE WHEN hit=1 THEN identifier END) AS hit_identifiers,
+               COUNT(DISTINCT CASE WHEN hit=1 THEN initial_url END) AS hit_uris,
+               COUNT(DISTINCT CASE WHEN hit=1 THEN final_sha1 END) AS hit_sha1s,
+               COALESCE(SUM(CASE WHEN hit=1 THEN final_was_dedupe END), 0) AS hit_dedupes,
+               COALESCE(SUM(initial_url LIKE 'ftp://%'), 0) AS ftp_urls,
+               datetime('now') AS updated
+        FROM {rows};
+
+    CREATE TABLE summary_initial_domain AS
+        SELECT initial_domain,
+               SUM(count) AS rows,
+               SUM(CASE WHEN hit=1 THEN count ELSE 0 END) AS hits,
+               SUM(CASE WHEN hit=0 AND final_status_code IS NULL THEN count ELSE 0 END) AS uncrawled
+        FROM summary_cube GROUP BY initial_domain;
+
+    CREATE TABLE summary_final_domain AS
+        SELECT final_domain,
+               SUM(CASE WHEN hit=1 THEN count ELSE 0 END) AS hits,
+               SUM(CASE WHEN hit=0 AND final_status_code IS NOT NULL THEN count ELSE 0 END) AS misses,
+               SUM(CASE WHEN hit=0 AND final_status_code IN ('-61', '-2') THEN count ELSE 0 END) AS blocked,
+               SUM(CASE WHEN hit=0 AND final_status_code = '429' THEN count ELSE 0 END) AS rate_limited
+        FROM summary_cube GROUP BY final_domain;
+
+    CREATE TABLE summary_status AS
+        SELECT hit, final_status_code, SUM(count) AS count FROM summary_cube GROUP BY hit, final_status_code;
+
+    CREATE TABLE summary_mimetype AS
+        SELECT hit, final_mimetype, SUM(count) AS count FROM summary_cube GROUP BY hit, final_mimetype;
+
+    CREATE TABLE summary_breadcrumbs AS
+        SELECT hit, breadcrumbs, SUM(count) AS count FROM summary_cube GROUP BY hit, breadcrumbs;
+"""
+
+SUMMARY_CUBE = """
+    SELECT initial_domain, final_domain, hit, final_status_code, final_mimetype, breadcrumbs, postproc_status,
+           COUNT(*) AS count, SUM(final_was_dedupe) AS dedupes
+    FROM {}
+    GROUP BY initial_domain, final_domain, hit, final_status_code, final_mimetype, breadcrumbs, postproc_status
+"""
+
+# compact outputs are grouped by ids, and only the groups decoded (distinct
+# counts in summary_totals work on ids and SHA-1 blobs as they are)
+COMPACT_SUMMARY_CUBE = """
+    SELECT di.domain AS initial_domain, df.domain AS final_domain, c.hit AS hit, s.value AS final_status_code,
+           m.value AS final_mimetype, b.value AS breadcrumbs, p.value AS postproc_status, c.count AS count,
+           c.dedupes AS dedupes
+    FROM ({}) c
+    LEFT JOIN result_domain di ON di.id = c.initial_domain
+    LEFT JOIN result_domain df ON df.id = c.final_domain
+    LEFT JOIN result_value s ON s.id = c.final_status_code
+    LEFT JOIN result_value m ON m.id = c.final_mimetype
+    LEFT JOIN result_value b ON b.id = c.breadcrumbs
+    LEFT JOIN result_value p ON p.id = c.postproc_status
+""".format(SUMMARY_CUBE.format('crawl_result_row'))
+
+def summarize(output_db):
+    """
+    (Re)builds the summary_* tables from crawl_result, so reports don't have
+    to scan it (see SUMMARY_TABLES). Run by the CLI after each command that
+    writes results, and by follow after each pass.
+    """
+    print("Updating summary tables...")
+    start = time.time()
+    METRICS.start_stage('summarize')
+    with METRICS.phase('summarize'):
+        if is_compact_output(output_db):
+            script = SUMMARY_TABLES.format(cube=COMPACT_SUMMARY_CUBE, rows='crawl_result_row')
+        else:
+            script = SUMMARY_TABLES.format(cube=SUMMARY_CUBE.format('crawl_result'), rows='crawl_result')
+        # one transaction, so readers never see some tables dropped or stale
+        try:
+            output_db.executescript("BEGIN;\n" + script + "\nCOMMIT;")
+        except sqlite3.Error:
+            output_db.rollback()
+            raise
+    rows = output_db.execute("SELECT rows FROM summary_totals").fetchone()[0]
+    METRICS.finish_stage('summarize', rows=rows)
+    print("Summarized {} rows in {:.1f}s".format(rows, time.time() - start))
+
+def test_summarize():
+    map_db, output_db = sqlite3.connect(':memory:'), sqlite3.connect(':memory:')
+    referrer(io.StringIO(TEST_CRAWL_LOG), map_db)
+    backward(io.StringIO(TEST_CRAWL_LOG), map_db, output_db)
+    forward(io.StringIO("http://a.com/1\t10.123/a\nhttp://c.com/missing\t10.123/c\n"), map_db, output_db)
+    summarize(output_db)
+    assert list(output_db.execute("SELECT rows, hits, identifiers, uris, hit_uris FROM summary_totals")) == \
+        list(output_db.execute("""SELECT COUNT(*), SUM(hit), COUNT(DISTINCT identifier), COUNT(DISTINCT initial_url),
+            COUNT(DISTINCT CASE WHEN hit=1 THEN initial_url END) FROM crawl_result"""))
+    assert list(output_db.execute("SELECT initial_domain, rows - hits FROM summary_initial_domain ORDER BY initial_domain")) == \
+        list(output_db.execute("SELECT initial_domain, SUM(hit=0) FROM crawl_result GROUP BY initial_domain ORDER BY initial_domain"))
+    # rebuilt from scratch each time
+    summarize(output_db)
+    assert output_db.execute("SELECT SUM(count) FROM summary_cube").fetchone()[0] == \
+        output_db.execute("SELECT COUNT(*) FROM crawl_result").fetchone()[0]
+    # a failed rebuild leaves the previous tables in place
+    output_db.executescript("DROP TABLE summary_breadcrumbs; CREATE VIEW summary_breadcrumbs AS SELECT 1;")
+    try:
+        summarize(output_db)
+        assert False
+    except sqlite3.Error:
+        pass
+    assert output_db.execute("SELECT SUM(count) FROM summary_cube").fetchone()[0] == \
+        output_db.execute("SELECT COUNT(*) FROM crawl_result").fetchone()[0]
+
+def open_output(path):
+    """
+    Opens an output file for writing text, compressing based on file
+    extension (.gz, .bz2, .xz, .zst); None or '-' is stdout.
+    """
+    if path in (None, '-'):
+        return sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wt', compresslevel=6)
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'wt')
+    if path.endswith('.xz'):
+        return lzma.open(path, 'wt')
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("writing .zst files requires the 'zstandard' package (or pipe through zstd)")
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(path, 'wb')))
+    return open(path, 'w', buffering=2**20)
+
+def split_output_path(path, i):
+    """
+    Name of the i-th part of a split output: 'out.json.gz' -> 'out-00002.json.gz'
+    """
+    directory, name = os.path.split(path)
+    base, dot, extensions = name.partition('.')
+    return os.path.join(directory, "{}-{:05d}{}{}".format(base, i, dot, extensions))
+
+def json_line_sql(columns):
+    """
+    SQL expression for a crawl_result row as a JSON object, formatted exactly
+    like json.dumps() of the row as a dict, except for non-ASCII characters
+    and DEL, which json.dumps() escapes (see dump_rows).
+    """
+    return "'{' || " + " || ', ' || ".join(
+        "'{}: ' || json_quote({})".format(json.encoder.encode_basestring_ascii(column), column)
+        for column in columns) + " || '}'"
+
+def dump_query(columns, output_format='json', only_identifier_hits=False, max_per_identifier=None, only_direct_breadcrumbs=False, identifier_range=None, source='crawl_result'):
+    """
+    Returns (sql, params) selecting the crawl_result rows to dump (as JSON
+    lines, or columns for TSV), ordered by identifier (then rowid), with all
+    filtering done by sqlite3:
+
+    - only_direct_breadcrumbs: very conservative, must be a direct hit, or an
+      embed, ignoring redirects; no link hops allowed
+    - max_per_identifier: the first rows of each (non-empty) identifier, after
+      the other filters; rows without one are never limited
+    - identifier_range: (low, high) identifiers, either None for unbounded;
+      the first range (low None) also gets rows without identifiers
+    - source: table or subquery the rows come from (it needs a rowid)
+    """
+    where, params = [], []
+    if only_identifier_hits:
+        where.append("hit = 1 AND identifier IS NOT NULL")
+    if only_direct_breadcrumbs:
+        where.append("replace(breadcrumbs, 'R', '') IN ('', '-', 'E')")
+    if identifier_range:
+        low, high = identifier_range
+        if low is not None:
+            where.append("identifier >= ?")
+            params.append(low)
+        if high is not None:
+            where.append("(identifier < ? OR identifier IS NULL)" if low is None else "identifier < ?")
+            params.append(high)
+    where = " WHERE " + " AND ".join(where) if where else ""
+    select = json_line_sql(columns) if output_format == 'json' else ", ".join(columns)
+    if not max_per_identifier:
+        return "SELECT {} FROM {}{} ORDER BY identifier, rowid".format(select, source, where), params
+    sql = """
+        SELECT {select} FROM (
+            SELECT *, rowid AS dump_rowid,
+                   ROW_NUMBER() OVER (PARTITION BY identifier ORDER BY rowid) AS dump_n
+            FROM {source}{where})
+        WHERE dump_n <= ? OR identifier IS NULL OR identifier = ''
+        ORDER BY identifier, dump_rowid
+    """.format(select=select, source=source, where=where)
+    return sql, params + [max_per_identifier]
+
+# backslash escapes for dump_rows() TSV fields (as in postgres' text format)
+TSV_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def dump_rows(cur, out, columns, output_format='json', batch_size=10000):
+    """
+    Writes the rows of a dump_query() cursor as NDJSON or TSV (with a header
+    line; NULL as an empty field; backslash, tab and newlines escaped as \\\\,
+    \\t, \\n and \\r), in fetchmany() batches. Returns the number of rows
+    written.
+
+    JSON lines come out of sqlite3 ready to write; the rare ones that need
+    more escaping are re-encoded by json.dumps().
+    """
+    if output_format == 'tsv':
+        out.write("\t".join(columns) + "\n")
+    count = 0
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        if output_format == 'tsv':
+            out.write("".join("\t".join('' if v is None else str(v).translate(TSV_ESCAPES) for v in row) + "\n" for row in rows))
+        else:
+            out.write("".join(
+                (line if line.isascii() and '\x7f' not in line else json.dumps(json.loads(line))) + "\n"
+                for (line,) in rows))
+        count += len(rows)
+    return count
+
+def identifier_ranges(read_db, parts):
+    """
+    Splits identifiers into (up to) parts ranges with about the same number of
+    rows each, never splitting the rows of one identifier.
+    """
+    total = read_db.execute("SELECT COUNT(*) FROM crawl_result WHERE identifier IS NOT NULL").fetchone()[0]
+    bounds = []
+    for i in range(1, parts):
+        row = read_db.execute("SELECT identifier FROM crawl_result WHERE identifier IS NOT NULL ORDER BY identifier LIMIT 1 OFFSET ?",
+            [i * total // parts]).fetchone()
+        if row and (not bounds or row[0] > bounds[-1]):
+            bounds.append(row[0])
+    return list(zip([None] + bounds, bounds + [None]))
+
+def run_dump_part(job):
+    """
+    Process pool worker for dump_json(): writes one identifier range to its
+    own file. Returns the number of rows written.
+    """
+    db_file, out_path, columns, sql, params, output_format, batch_size = job
+    read_db = sqlite3.connect('file:{}?mode=ro'.format(urllib.parse.quote(os.path.abspath(db_file))), uri=True)
+    register_result_functions(read_db)
+    out = open_output(out_path)
+    count = dump_rows(read_db.execute(sql, params), out, columns, output_format, batch_size)
+    out.close()
+    read_db.close()
+    return count
+
+def dump_json(read_db, only_identifier_hits=False, max_per_identifier=None, only_direct_breadcrumbs=False, output_path=None, output_format='json', split=1, batch_size=10000):
+    """
+    Dumps crawl_result rows ordered by identifier, as NDJSON (or TSV), to
+    output_path (stdout by default; compressed by extension, see open_output).
+    Filtering happens in SQL (see dump_query).
 
-    read_db.row_factory = sqlite3.Row
+    With split > 1, rows go to that many files (see split_output_path), one
+    per identifier range, written in parallel; concatenated in order they are
+    the same as a single dump.
+    """
     if only_identifier_hits:
         sys.stderr.write("Only dumping hits with identifiers\n\r")
-        cur = read_db.execute("SELECT * FROM crawl_result WHERE hit = 1 AND identifier IS NOT NULL ORDER BY identifier;")
     else:
         sys.stderr.write("Dumping all rows\n\r")
-        cur = read_db.execute("SELECT * FROM crawl_result ORDER BY identifier;")
-
-    last_ident = None
-    ident_count = 0
-    for row in cur:
-        if only_direct_breadcrumbs:
-            # very conservative: must be a direct hit, or an embed. no link
-            # hops allowed. the redirect ignoring logic is easier to express in
-            # python than SQL
-            # TODO: do the work and express in SQL so we can have sane reporting
-            bc = row[3]
-            bc = bc.replace('R', '')
-            if len(bc) > 1:
-                continue
-            if bc not in ('-', 'E', ''):
-                continue
-        if last_ident and row[1] == last_ident:
-            ident_count += 1
-            if max_per_identifier and ident_count > max_per_identifier:
-                sys.stderr.write("SKIPPING identifier maxed out: {}\n\r".format(last_ident))
-                continue
-        else:
-            ident_count = 1
-        last_ident = row[1]
-        print(json.dumps(dict(row)))
+    columns = [row[1] for row in read_db.execute("PRAGMA table_info(crawl_result)")]
+    filters = dict(only_identifier_hits=only_identifier_hits, max_per_identifier=max_per_identifier,
+        only_direct_breadcrumbs=only_direct_breadcrumbs)
+    if is_compact_output(read_db):
+        # the view's rows have no rowid to keep ties in insert order (and
+        # its SHA-1 decoding is slower than sha1_text)
+        register_result_functions(read_db)
+        filters['source'] = "(SELECT r.rowid AS rowid, " + COMPACT_RESULT_ROWS.strip()[len("SELECT "):] + ")"
+    start = time.time()
+    if split <= 1:
+        sql, params = dump_query(columns, output_format, **filters)
+        out = open_output(output_path)
+        count = dump_rows(read_db.execute(sql, params), out, columns, output_format, batch_size)
+        if out is not sys.stdout:
+            out.close()
+    else:
+        if output_path in (None, '-') or not db_path(read_db):
+            raise ValueError("split dumps need an output path, and a database file the workers can open")
+        jobs = []
+        for i, identifier_range in enumerate(identifier_ranges(read_db, split)):
+            sql, params = dump_query(columns, output_format, identifier_range=identifier_range, **filters)
+            jobs.append((db_path(read_db), split_output_path(output_path, i), columns, sql, params, output_format, batch_size))
+        with multiprocessing.Pool(min(split, len(jobs))) as pool:
+            count = sum(pool.map(run_dump_part, jobs))
+    sys.stderr.write("Dumped {} rows in {:.1f}s\n".format(count, time.time() - start))
+    return count
+
+def test_dump_json(tmp_path):
+    db_file = str(tmp_path / 'out.sqlite')
+    output_db = sqlite3.connect(db_file)
+    create_out_table(output_db)
+    rows = [(ident, bc, hit) for ident in ('10.1/a', '10.1/b', None, '10.1/c') for bc in ('-', 'RRL', 'RE', 'LL') for hit in (1, 0)]
+    for i, (ident, bc, hit) in enumerate(rows):
+        output_db.execute("INSERT INTO crawl_result (initial_url, identifier, breadcrumbs, hit) VALUES (?,?,?,?)",
+            ['http://a.com/{}'.format(i), ident, bc, hit])
+    output_db.execute("INSERT INTO crawl_result (initial_url, final_url, hit) VALUES (?,?,?)",
+        ['http://a.com/\u00e9\x7f', 'http://a.com/\n"\\', 0])
+    output_db.commit()
+    output_db.close()
+    output_db = sqlite3.connect(db_file)
+
+    sql, params = dump_query(['initial_url', 'identifier', 'breadcrumbs'], 'tsv', max_per_identifier=3, only_direct_breadcrumbs=True)
+    dumped = list(output_db.execute(sql, params))
+    # direct and embed hits only; three per identifier, except without one
+    assert [r[1] for r in dumped] == [None] * 4 + ['10.1/a'] * 3 + ['10.1/b'] * 3 + ['10.1/c'] * 3
+    assert all(r[2] in ('-', 'RE') for r in dumped)
+
+    whole = str(tmp_path / 'all.json')
+    assert dump_json(output_db, output_path=whole) == len(rows) + 1
+    columns = [row[1] for row in output_db.execute("PRAGMA table_info(crawl_result)")]
+    assert open(whole).read() == "".join(json.dumps(dict(zip(columns, row))) + "\n"
+        for row in output_db.execute("SELECT * FROM crawl_result ORDER BY identifier, rowid"))
+    parts = str(tmp_path / 'part.json.gz')
+    assert dump_json(output_db, output_path=parts, split=3) == len(rows) + 1
+    assert "".join(gzip.open(split_output_path(parts, i), 'rt').read() for i in range(3)) == open(whole).read()
+    tsv = str(tmp_path / 'all.tsv')
+    dump_json(output_db, output_path=tsv, output_format='tsv', only_identifier_hits=True)
+    assert open(tsv).readline().startswith("initial_url\tidentifier\t")
+    dump_json(output_db, output_path=tsv, output_format='tsv')
+    with open(tsv, newline='') as f:
+        lines = f.read().split('\n')
+    unescape = lambda v: re.sub(r'\\(.)', lambda m: {'t': '\t', 'n': '\n', 'r': '\r'}.get(m.group(1), m.group(1)), v)
+    tsv_rows = [[unescape(v) for v in line.split('\t')] for line in lines[1:-1]]
+    assert len(tsv_rows) == len(rows) + 1
+    assert ['http://a.com/\u00e9\x7f', 'http://a.com/\n"\\'] in [[row[0], row[4]] for row in tsv_rows]
 
 def main():
     parser = argparse.ArgumentParser()
@@ -673,55 +5182,207 @@ def main():
     sub_referrer = subparsers.add_parser('referrer')
     sub_referrer.set_defaults(func=referrer)
     sub_referrer.add_argument("log_file",
-        default=sys.stdin, type=argparse.FileType('rt'))
+        nargs='+', type=str,
+        help="input file(s) or globs; may be compressed (.gz, .bz2, .xz, .zst); '-' for stdin")
     sub_referrer.add_argument("map_db_file",
         type=str)
+    sub_referrer.add_argument("--bulk",
+        action="store_true",
+        help="insert in large batches in a single transaction (faster; nothing is committed until the end)")
+    sub_referrer.add_argument("--batch-size",
+        default=50000, type=int,
+        help="rows per executemany() batch in --bulk mode")
+    sub_referrer.add_argument("--staging-tsv",
+        default=None, type=str,
+        help="write map rows to this TSV (for sqlite3 .import) instead of inserting them")
+    sub_referrer.add_argument("--incremental",
+        action="store_true",
+        help="only append log lines not already in the map (resuming if interrupted); keeps indexes if the new input is small")
+    sub_referrer.add_argument("--compact-map",
+        action="store_true",
+        help="write a compact map: URLs interned to integer ids, attribute values dictionary-encoded")
 
     sub_backward_cdx = subparsers.add_parser('backward_cdx')
     sub_backward_cdx.set_defaults(func=backward_cdx)
     sub_backward_cdx.add_argument("cdx_file",
-        default=sys.stdin, type=argparse.FileType('rt'))
+        nargs='+', type=str,
+        help="input file(s) or globs; may be compressed (.gz, .bz2, .xz, .zst); '-' for stdin")
     sub_backward_cdx.add_argument("map_db_file",
         type=str)
     sub_backward_cdx.add_argument("output_db_file",
         type=str)
+    sub_backward_cdx.add_argument("--shard",
+        default=None, type=str,
+        help="only CDX lines whose WARC filename contains this (eg, 'wbgrp-svc282')")
+    sub_backward_cdx.add_argument("--workers",
+        default=1, type=int,
+        help="split uncompressed CDX files by byte range across this many processes")
 
     sub_backward = subparsers.add_parser('backward')
     sub_backward.set_defaults(func=backward)
     sub_backward.add_argument("log_file",
-        default=sys.stdin, type=argparse.FileType('rt'))
+        nargs='+', type=str,
+        help="input file(s) or globs; may be compressed (.gz, .bz2, .xz, .zst); '-' for stdin")
     sub_backward.add_argument("map_db_file",
         type=str)
     sub_backward.add_argument("output_db_file",
         type=str)
+    sub_backward.add_argument("--incremental",
+        action="store_true",
+        help="only resolve log lines not read before, and re-resolve chains extended by new map rows")
+    sub_backward.add_argument("--workers",
+        default=1, type=int,
+        help="resolve chains in this many processes, sharing the map read-only")
+    sub_backward.add_argument("--cte",
+        action="store_true",
+        help="resolve all chains inside sqlite3 with a recursive query, instead of walking them one by one")
 
     sub_forward = subparsers.add_parser('forward')
     sub_forward.set_defaults(func=forward)
     sub_forward.add_argument("seed_id_file",
-        default=sys.stdin, type=argparse.FileType('rt'))
+        nargs='+', type=str,
+        help="input file(s) or globs; may be compressed (.gz, .bz2, .xz, .zst); '-' for stdin")
     sub_forward.add_argument("map_db_file",
         type=str)
     sub_forward.add_argument("output_db_file",
         type=str)
+    sub_forward.add_argument("--set-based",
+        action="store_true",
+        help="stage seeds in a temp table and update existing rows with one join, instead of per-seed queries")
+    sub_forward.add_argument("--incremental",
+        action="store_true",
+        help="only process new seed lines, plus seeds whose results may have changed since the last --incremental run")
+    sub_forward.add_argument("--workers",
+        default=1, type=int,
+        help="resolve seeds in this many processes, sharing the map read-only")
+    sub_forward.add_argument("--cte",
+        action="store_true",
+        help="resolve new seeds inside sqlite3 with a recursive query (implies --set-based)")
 
     sub_everything = subparsers.add_parser('everything')
     sub_everything.set_defaults(func=everything)
     sub_everything.add_argument("log_file",
-        type=str)
+        type=str,
+        help="crawl log file or glob; may be compressed (.gz, .bz2, .xz, .zst)")
     sub_everything.add_argument("seed_id_file",
-        default=sys.stdin, type=argparse.FileType('rt'))
+        type=str,
+        help="seed/identifier TSV file or glob; may be compressed; '-' for stdin")
     sub_everything.add_argument("output_db_file",
         type=str)
     sub_everything.add_argument("--map_db_file",
         default=":memory:", type=str)
+    sub_everything.add_argument("--single-pass",
+        action="store_true",
+        help="read and parse the crawl log only once (allows '-' for stdin)")
+    sub_everything.add_argument("--set-based-forward",
+        action="store_true",
+        help="run the forward stage in --set-based mode")
+    sub_everything.add_argument("--incremental",
+        action="store_true",
+        help="run referrer, backward and forward in --incremental mode (needs --map_db_file)")
+    sub_everything.add_argument("--compact-map",
+        action="store_true",
+        help="build the referrer map in the compact format")
+    sub_everything.add_argument("--workers",
+        default=1, type=int,
+        help="run backward and forward resolution in this many processes (needs --map_db_file)")
+    sub_everything.add_argument("--cte",
+        action="store_true",
+        help="run backward and forward resolution in --cte mode")
+    sub_everything.add_argument("--memory-budget",
+        type=parse_size,
+        help="total memory to stay within (eg, 4G): picks an in-memory, hybrid or on-disk map from its estimated size, and stops if it goes over")
+
+    sub_follow = subparsers.add_parser('follow',
+        help="tail a running crawl's log, updating the map and results as it grows")
+    sub_follow.set_defaults(func=follow)
+    sub_follow.add_argument("log_file",
+        nargs='+', type=str,
+        help="crawl log file(s) or globs; rotated logs are followed by inode")
+    sub_follow.add_argument("map_db_file",
+        type=str)
+    sub_follow.add_argument("output_db_file",
+        type=str)
+    sub_follow.add_argument("--seed-id-file",
+        nargs='+', type=str,
+        help="seed/identifier TSV file(s) to resolve forward as the map grows")
+    sub_follow.add_argument("--interval",
+        default=60.0, type=float,
+        help="seconds between passes over new log lines")
+    sub_follow.add_argument("--passes",
+        type=int,
+        help="stop after this many passes (default: run until interrupted)")
+
+    sub_shards = subparsers.add_parser('shards',
+        help="run everything for several shards in parallel, then merge outputs")
+    sub_shards.set_defaults(func=shards)
+    sub_shards.add_argument("output_db_file",
+        type=str)
+    sub_shards.add_argument("--shard",
+        nargs=2, action='append', required=True, metavar=("LOG_FILE", "SEED_ID_FILE"),
+        help="crawl log and matching seed_id file for one shard (repeat for each shard)")
+    sub_shards.add_argument("--work-dir",
+        default=None, type=str,
+        help="where to put per-shard map and output DBs (default: next to output)")
+    sub_shards.add_argument("--processes",
+        default=None, type=int,
+        help="size of process pool (default: number of shards or cores, whichever is smaller)")
+
+    sub_merge = subparsers.add_parser('merge',
+        help="merge several output DBs into a new one: hits beat misses, identifiers beat nulls, latest timestamp wins")
+    sub_merge.set_defaults(func=merge)
+    sub_merge.add_argument("output_db_file",
+        type=str)
+    sub_merge.add_argument("input_db_file",
+        nargs='+', type=str,
+        help="output DB(s) to merge, or globs")
 
     sub_postprocess = subparsers.add_parser('postprocess')
     sub_postprocess.set_defaults(func=postprocess)
     sub_postprocess.add_argument("sha1_status_file",
-        default=sys.stdin, type=argparse.FileType('rt'))
+        nargs='+', type=str,
+        help="input file(s) or globs; may be compressed (.gz, .bz2, .xz, .zst); '-' for stdin")
     sub_postprocess.add_argument("db_file",
         type=str)
 
+    sub_bench_normalize = subparsers.add_parser('bench_normalize',
+        help="micro-benchmark URL normalization (URLs/sec, before and after)")
+    sub_bench_normalize.set_defaults(func=bench_normalize)
+    sub_bench_normalize.add_argument("url_file",
+        nargs='+', type=str,
+        help="seedlist (or other file with URLs in the first column); may be compressed")
+    sub_bench_normalize.add_argument("--limit",
+        default=None, type=int,
+        help="only use this many URLs")
+
+    sub_bench_parse = subparsers.add_parser('bench_parse',
+        help="micro-benchmark crawl log parsing for backward (lines/sec, before and after)")
+    sub_bench_parse.set_defaults(func=bench_parse)
+    sub_bench_parse.add_argument("log_file",
+        nargs='+', type=str,
+        help="crawl log(s); may be compressed")
+    sub_bench_parse.add_argument("--limit",
+        default=None, type=int,
+        help="only use this many lines")
+
+    sub_bench_map = subparsers.add_parser('bench_map',
+        help="compare map DBs (eg, plain and --compact-map): size and lookup/walk latency")
+    sub_bench_map.set_defaults(func=bench_map)
+    sub_bench_map.add_argument("map_db_file",
+        nargs='+', type=str)
+    sub_bench_map.add_argument("--sample",
+        default=1000, type=int,
+        help="number of map URLs to look up")
+    sub_bench_map.add_argument("--engines",
+        default="sqlite", type=str,
+        help="comma-separated map engines to compare (of: {})".format(', '.join(MAP_ENGINES)))
+
+    sub_summarize = subparsers.add_parser('summarize',
+        help="rebuild the summary tables used by examples/report_summary_template.md")
+    sub_summarize.set_defaults(func=summarize)
+    sub_summarize.add_argument("db_file",
+        type=str)
+
     sub_dump_json = subparsers.add_parser('dump_json')
     sub_dump_json.set_defaults(func=dump_json)
     sub_dump_json.add_argument("db_file",
@@ -735,16 +5396,65 @@ def main():
     sub_dump_json.add_argument("--max-per-identifier",
         default=False, type=int,
         help="don't dump more than this many rows per unique identifier")
+    sub_dump_json.add_argument("--format",
+        default="json", choices=("json", "tsv"),
+        help="newline-delimited JSON objects, or TSV with a header line")
+    sub_dump_json.add_argument("--output",
+        default=None, type=str,
+        help="file to write to instead of stdout; compressed if it ends in .gz, .bz2, .xz or .zst")
+    sub_dump_json.add_argument("--split",
+        default=1, type=int,
+        help="write this many files (eg, out-00000.json.gz), one per identifier range, in parallel (needs --output)")
 
     parser.add_argument("--html-hit",
         action="store_true",
         help="run in mode that considers only terminal HTML success")
+    parser.add_argument("--pipeline",
+        action="store_true",
+        help="parse, resolve and write in separate threads connected by bounded queues, reporting where each stage stalls")
+    parser.add_argument("--compact-output",
+        action="store_true",
+        help="create new output DBs in the compact format (dictionary-encoded values behind a crawl_result view)")
+    parser.add_argument("--no-summary",
+        action="store_true",
+        help="don't rebuild the summary tables after writing results (see the summarize command)")
+    parser.add_argument("--chain-cache-size",
+        default=1000000, type=int,
+        help="number of URLs to memoize backward chain resolution for (0 to disable)")
+    parser.add_argument("--map-engine",
+        default="sqlite", choices=MAP_ENGINES,
+        help="how to resolve redirect chains: a sqlite3 query per hop, or an in-memory graph (falls back to sqlite if it won't fit)")
+    parser.add_argument("--metrics-file",
+        help="write per-stage and per-phase timings, counts and peak RSS to this file as JSON (turns on per-call timing)")
+    parser.add_argument("--profile",
+        help="run a sampling profiler, writing collapsed stacks (for flamegraph.pl or speedscope) to this file")
+    parser.add_argument("--profile-interval",
+        default=0.005, type=float,
+        help="seconds between profiler samples")
+    parser.add_argument("--warnings-file",
+        help="write per-line warnings (bad log lines, missing urls, ...) to this file instead of stderr")
+    parser.add_argument("--warnings-per-minute",
+        default=100, type=int,
+        help="maximum warnings of each kind to write per minute (0 for no limit)")
 
     args = parser.parse_args()
     if not args.__dict__.get("func"):
         print("tell me what to do! (try --help)")
         sys.exit(-1)
 
+    # atexit handlers run last-registered first
+    if args.warnings_file:
+        WARNINGS.out = open(args.warnings_file, 'w')
+    WARNINGS.per_minute = args.warnings_per_minute
+    atexit.register(WARNINGS.summary)
+    if args.metrics_file:
+        METRICS.enabled = True
+        atexit.register(METRICS.write, args.metrics_file)
+    if args.profile:
+        profiler = SamplingProfiler(args.profile, interval=args.profile_interval)
+        profiler.start()
+        atexit.register(profiler.stop)
+
     if args.html_hit:
         hit_mimetypes = (
             "text/html",
@@ -752,40 +5462,179 @@ def main():
     else:
         hit_mimetypes = FULLTEXT_MIMETYPES
 
-    if args.func is referrer:
-        referrer(args.log_file,
+    if args.__dict__.get('incremental') and args.__dict__.get('compact_map'):
+        raise ValueError("--incremental only works with plain (not --compact-map) maps")
+    if args.__dict__.get('incremental') and args.__dict__.get('workers', 1) > 1:
+        raise ValueError("--incremental can't be combined with --workers (it would be ignored)")
+    if args.pipeline and (args.__dict__.get('incremental') or args.__dict__.get('cte') or args.__dict__.get('workers', 1) > 1):
+        raise ValueError("--pipeline can't be combined with --incremental, --cte or --workers (one would be ignored)")
+
+    # commands writing results share one connection with summarize()
+    output_db = None
+    if args.func in (backward_cdx, backward, forward, everything, follow, merge):
+        output_db = sqlite3.connect(args.output_db_file, isolation_level='EXCLUSIVE')
+    elif args.func is postprocess:
+        output_db = sqlite3.connect(args.db_file, isolation_level='EXCLUSIVE')
+    if args.compact_output:
+        if args.__dict__.get('incremental') or args.func is follow:
+            raise ValueError("--compact-output can't be combined with --incremental or follow (which update rows by rowid)")
+        if output_db:
+            create_out_table(output_db, compact=True)
+        elif args.func is shards:
+            shards_db = sqlite3.connect(args.output_db_file)
+            create_out_table(shards_db, compact=True)
+            shards_db.close()
+
+    if args.func is referrer and args.incremental:
+        referrer_incremental(args.log_file,
                  sqlite3.connect(args.map_db_file, isolation_level='EXCLUSIVE'))
+    elif args.func is referrer:
+        referrer(InputReader(args.log_file),
+                 sqlite3.connect(args.map_db_file, isolation_level='EXCLUSIVE'),
+                 bulk=args.bulk,
+                 batch_size=args.batch_size,
+                 staging_tsv=args.staging_tsv,
+                 compact=args.compact_map,
+                 pipeline=args.pipeline)
     elif args.func is backward_cdx:
         backward_cdx(args.cdx_file,
                  sqlite3.connect(args.map_db_file, isolation_level='EXCLUSIVE'),
-                 sqlite3.connect(args.output_db_file, isolation_level='EXCLUSIVE'),
+                 output_db,
+                 hit_mimetypes=hit_mimetypes,
+                 shard=args.shard,
+                 workers=args.workers,
+                 map_engine=args.map_engine,
+                 chain_cache_size=args.chain_cache_size)
+    elif args.func is backward and args.incremental:
+        backward_incremental(args.log_file,
+                 sqlite3.connect(args.map_db_file, isolation_level='EXCLUSIVE'),
+                 output_db,
+                 hit_mimetypes=hit_mimetypes,
+                 map_engine=args.map_engine,
+                 chain_cache_size=args.chain_cache_size)
+    elif args.func is backward and args.cte:
+        backward_cte(InputReader(args.log_file),
+                 sqlite3.connect(args.map_db_file, isolation_level='EXCLUSIVE'),
+                 output_db,
                  hit_mimetypes=hit_mimetypes)
     elif args.func is backward:
-        backward(args.log_file,
+        backward(InputReader(args.log_file),
                  sqlite3.connect(args.map_db_file, isolation_level='EXCLUSIVE'),
-                 sqlite3.connect(args.output_db_file, isolation_level='EXCLUSIVE'),
-                 hit_mimetypes=hit_mimetypes)
+                 output_db,
+                 hit_mimetypes=hit_mimetypes,
+                 map_engine=args.map_engine,
+                 chain_cache_size=args.chain_cache_size,
+                 workers=args.workers,
+                 pipeline=args.pipeline)
+    elif args.func is forward and args.incremental:
+        forward_incremental(args.seed_id_file,
+                sqlite3.connect(args.map_db_file, isolation_level='EXCLUSIVE'),
+                output_db,
+                map_engine=args.map_engine)
     elif args.func is forward:
-        forward(args.seed_id_file,
+        forward(InputReader(args.seed_id_file),
                 sqlite3.connect(args.map_db_file, isolation_level='EXCLUSIVE'),
-                sqlite3.connect(args.output_db_file, isolation_level='EXCLUSIVE'))
+                output_db,
+                map_engine=args.map_engine,
+                set_based=args.set_based,
+                workers=args.workers,
+                cte=args.cte,
+                pipeline=args.pipeline)
     elif args.func is everything:
+        if args.incremental and args.map_db_file == ':memory:':
+            raise ValueError("--incremental needs a --map_db_file to keep between runs")
+        if args.workers > 1 and args.map_db_file == ':memory:' and not args.memory_budget:
+            raise ValueError("--workers needs a --map_db_file the workers can open")
+        if args.cte and (args.incremental or args.single_pass or args.workers > 1):
+            raise ValueError("--cte can't be combined with --incremental, --single-pass or --workers")
+        if args.single_pass and (args.workers > 1 or args.pipeline):
+            raise ValueError("--single-pass can't be combined with --workers or --pipeline (they would be ignored)")
+        if args.pipeline and args.map_db_file == ':memory:' and not args.memory_budget:
+            raise ValueError("--pipeline needs a --map_db_file the resolve threads can open")
+        map_cache_size, memory_limit = 20000, None
+        created_map_file = None
+        if args.memory_budget:
+            map_db, map_cache_size, memory_limit = plan_map_db(args.log_file, args.memory_budget,
+                map_db_file=args.map_db_file,
+                output_db_file=args.output_db_file,
+                compact=args.compact_map,
+                chain_cache_size=args.chain_cache_size,
+                needs_path=args.workers > 1 or args.pipeline)
+            if args.map_db_file == ':memory:':
+                # an on-disk map plan_map_db made up a name for; removed when done
+                created_map_file = map_db.execute("PRAGMA database_list").fetchone()[2] or None
+        else:
+            map_db = sqlite3.connect(args.map_db_file)
         everything(args.log_file,
-                 args.seed_id_file,
-                 sqlite3.connect(args.map_db_file),
-                 sqlite3.connect(args.output_db_file, isolation_level='EXCLUSIVE'),
-                 hit_mimetypes=hit_mimetypes)
+                 args.seed_id_file if args.incremental else InputReader(args.seed_id_file),
+                 map_db,
+                 output_db,
+                 hit_mimetypes=hit_mimetypes,
+                 map_engine=args.map_engine,
+                 single_pass=args.single_pass,
+                 chain_cache_size=args.chain_cache_size,
+                 set_based_forward=args.set_based_forward,
+                 incremental=args.incremental,
+                 compact_map=args.compact_map,
+                 workers=args.workers,
+                 cte=args.cte,
+                 pipeline=args.pipeline,
+                 map_cache_size=map_cache_size,
+                 memory_limit=memory_limit)
+        if created_map_file:
+            map_db.close()
+            for path in (created_map_file, created_map_file + '.mmap'):
+                if os.path.exists(path):
+                    os.remove(path)
+            print("Removed referrer map {}".format(created_map_file))
+    elif args.func is follow:
+        follow(args.log_file,
+               sqlite3.connect(args.map_db_file, isolation_level='EXCLUSIVE'),
+               output_db,
+               seed_paths=args.seed_id_file,
+               hit_mimetypes=hit_mimetypes,
+               map_engine=args.map_engine,
+               chain_cache_size=args.chain_cache_size,
+               interval=args.interval,
+               passes=args.passes,
+               summary=not args.no_summary)
+    elif args.func is shards:
+        shards(args.shard,
+               args.output_db_file,
+               work_dir=args.work_dir,
+               processes=args.processes,
+               hit_mimetypes=hit_mimetypes,
+               map_engine=args.map_engine)
+    elif args.func is merge:
+        merge(args.input_db_file, output_db)
     elif args.func is postprocess:
-        postprocess(args.sha1_status_file,
-                 sqlite3.connect(args.db_file, isolation_level='EXCLUSIVE'))
+        postprocess(InputReader(args.sha1_status_file), output_db)
+    elif args.func is bench_normalize:
+        bench_normalize(InputReader(args.url_file), limit=args.limit)
+    elif args.func is bench_parse:
+        bench_parse(InputReader(args.log_file), hit_mimetypes=hit_mimetypes, limit=args.limit)
+    elif args.func is bench_map:
+        bench_map(args.map_db_file, sample=args.sample, map_engines=args.engines.split(','))
+    elif args.func is summarize:
+        summarize(sqlite3.connect(args.db_file))
     elif args.func is dump_json:
         dump_json(sqlite3.connect(args.db_file, isolation_level='EXCLUSIVE'),
             only_identifier_hits=args.only_identifier_hits,
             only_direct_breadcrumbs=args.only_direct_breadcrumbs,
-            max_per_identifier=args.max_per_identifier)
+            max_per_identifier=args.max_per_identifier,
+            output_path=args.output,
+            output_format=args.format,
+            split=args.split)
     else:
         raise NotImplementedError
 
+    if args.no_summary or args.func is follow:
+        pass
+    elif output_db:
+        summarize(output_db)
+    elif args.func is shards:
+        summarize(sqlite3.connect(args.output_db_file, isolation_level='EXCLUSIVE'))
+
 if __name__ == '__main__':
     main()
 
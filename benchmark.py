@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+
+"""
+Synthetic input generator and end-to-end benchmark runner for arabesque.py.
+
+Commands:
+- generate <data_dir> [--seeds N] [--max-redirects N] [--fanout N] [--loop-rate F]
+      [--dedupe-rate F] [--mix pdf=40,html=35,...] [--random-seed N]
+- run <data_dir> [--results results.json] [--reference reference.tsv]
+      [--save-reference] [--stages referrer,backward,...] [-- arabesque args]
+
+`generate` writes a Heritrix-style crawl log (crawl.log), a seed/identifier
+TSV (seed_id.tsv), a full CDX file (crawl.cdx) and a sha1/status TSV
+(sha1_status.tsv), all deterministic for a given --random-seed.
+
+`run` runs each arabesque.py stage as a subprocess against those files,
+recording wall/user/sys time, input lines/sec, peak RSS and database size per
+stage, and writes all of it as JSON. The crawl_result table from the
+referrer/backward/forward/postprocess pipeline (and from `everything`, after
+the same postprocess) is compared against a stored reference dump, so the
+same run works as a correctness check. Arguments after `--` are passed to
+arabesque.py before the subcommand (eg, `-- --map-engine graph`).
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import hashlib
+import sqlite3
+import argparse
+import datetime
+import subprocess
+
+ARABESQUE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'arabesque.py')
+
+# terminal outcome for each seed, after any redirects
+DEFAULT_MIX = "pdf=40,html=35,ps=3,octet=2,error=20"
+MIX_KINDS = ('pdf', 'html', 'ps', 'octet', 'error')
+
+EMBED_MIMETYPES = ('image/png', 'image/jpeg', 'text/css', 'application/javascript')
+ERROR_STATUSES = (404, 403, 500, 503, -61, -404, -2)
+
+def parse_mix(raw):
+    """
+    Parses a mimetype/outcome mix like 'pdf=40,html=35,error=25' into a list
+    of (kind, weight).
+    """
+    mix = []
+    for part in raw.split(','):
+        kind, weight = part.split('=')
+        kind = kind.strip()
+        if kind not in MIX_KINDS:
+            raise ValueError("unknown mix kind: {} (expected one of {})".format(kind, ", ".join(MIX_KINDS)))
+        mix.append((kind, float(weight)))
+    return mix
+
+def fake_sha1(s):
+    return base64.b32encode(hashlib.sha1(s.encode('utf-8')).digest()).decode('ascii')
+
+def surt(url):
+    scheme, rest = url.split('://', 1)
+    host, _, path = rest.partition('/')
+    return "{})/{}".format(','.join(reversed(host.lower().split('.'))), path.lower())
+
+class CrawlGenerator:
+    """
+    Writes one crawl's worth of synthetic inputs. Each seed gets a redirect
+    chain (sometimes looping back on itself), then a terminal response picked
+    from the mix; HTML landing pages fan out to embeds and linked PDFs, some
+    of which are duplicates of earlier content.
+    """
+
+    def __init__(self, data_dir, seeds=10000, max_redirects=4, fanout=3, loop_rate=0.02,
+            dedupe_rate=0.1, mix=DEFAULT_MIX, missing_rate=0.05, noise_rate=0.05, random_seed=1):
+        self.data_dir = data_dir
+        self.seeds = seeds
+        self.max_redirects = max_redirects
+        self.fanout = fanout
+        self.loop_rate = loop_rate
+        self.dedupe_rate = dedupe_rate
+        self.mix = parse_mix(mix)
+        self.missing_rate = missing_rate
+        self.noise_rate = noise_rate
+        self.random = random.Random(random_seed)
+        self.params = dict(seeds=seeds, max_redirects=max_redirects, fanout=fanout,
+            loop_rate=loop_rate, dedupe_rate=dedupe_rate, mix=mix,
+            missing_rate=missing_rate, noise_rate=noise_rate, random_seed=random_seed)
+        self.now = datetime.datetime(2018, 7, 27, 12, 0, 0)
+        self.counts = dict(log_lines=0, cdx_lines=0, seed_lines=0, sha1_lines=0)
+        self.seen_content = []
+
+    def log(self, status, size, url, breadcrumbs, referrer, mimetype, sha1=None, annotations='-'):
+        self.now += datetime.timedelta(milliseconds=self.random.randint(1, 400))
+        fetch_time = self.now - datetime.timedelta(milliseconds=self.random.randint(10, 3000))
+        sha1 = sha1 or fake_sha1(url)
+        self.log_file.write("{}Z {:>5} {:>10} {} {} {} {} #{:03d} {}+{} sha1:{} - {} {{}}\n".format(
+            self.now.isoformat(timespec='milliseconds'), status, size, url, breadcrumbs or '-',
+            referrer or '-', mimetype, self.random.randint(0, 499),
+            fetch_time.strftime('%Y%m%d%H%M%S%f')[:17], self.random.randint(1, 3000),
+            sha1, annotations))
+        self.counts['log_lines'] += 1
+        if status > 0 and not url.startswith('dns:'):
+            is_dedupe = 'duplicate:digest' in annotations
+            self.cdx_file.write("{} {} {} {} {} {} - - {} {} BENCH-CRAWL-{}-00{:03d}.warc.gz\n".format(
+                surt(url), fetch_time.strftime('%Y%m%d%H%M%S'), url,
+                'warc/revisit' if is_dedupe else mimetype, '-' if is_dedupe else status, sha1,
+                self.random.randint(300, 90000), self.random.randint(0, 10**9),
+                fetch_time.strftime('%Y%m%d%H%M%S'), self.random.randint(0, 999)))
+            self.counts['cdx_lines'] += 1
+        return sha1
+
+    def content(self, url, breadcrumbs, referrer, mimetype, size):
+        """
+        A successful fetch, which may be a duplicate (by digest) of earlier
+        content. Returns the SHA-1.
+        """
+        if self.seen_content and self.random.random() < self.dedupe_rate:
+            sha1 = self.random.choice(self.seen_content)
+            self.log(200, size, url, breadcrumbs, referrer, mimetype, sha1=sha1, annotations='duplicate:digest')
+            return sha1
+        sha1 = self.log(200, size, url, breadcrumbs, referrer, mimetype)
+        self.seen_content.append(sha1)
+        if mimetype in ('application/pdf', 'application/postscript', 'application/octet-stream'):
+            self.sha1_file.write("sha1:{}\t{}\n".format(sha1, self.random.choice((200, 200, 200, 500, 400))))
+            self.counts['sha1_lines'] += 1
+        return sha1
+
+    def seed(self, i):
+        rnd = self.random
+        domain = "d{}.example.com".format(rnd.randint(0, max(1, self.seeds // 50)))
+        seed_url = "http://{}/article/{}".format(domain, i)
+        listed_url = seed_url
+        if rnd.random() < self.noise_rate:
+            # needs normalization to match the crawl log
+            listed_url = "http://{}:80/article/{}".format(domain.upper(), i)
+        self.seed_file.write("{}\t10.5555/bench.{}\n".format(listed_url, i))
+        self.counts['seed_lines'] += 1
+        if rnd.random() < self.noise_rate:
+            self.seed_file.write("{}\n".format(listed_url))
+            self.counts['seed_lines'] += 1
+        if rnd.random() < self.missing_rate:
+            return
+
+        if rnd.random() < 0.02:
+            self.log(1, 60, "dns:" + domain, 'P', seed_url, 'text/dns')
+        url, breadcrumbs, referrer = seed_url, '', None
+        hops = rnd.randint(0, self.max_redirects)
+        for hop in range(hops):
+            next_url = "https://{}/article/{}/r{}".format(domain, i, hop)
+            self.log(rnd.choice((301, 302, 302, 307)), 0, url, breadcrumbs, referrer, 'text/html')
+            referrer, url, breadcrumbs = url, next_url, breadcrumbs + 'R'
+        if rnd.random() < self.loop_rate:
+            self.log(302, 0, url, breadcrumbs, referrer, 'text/html')
+            self.log(302, 0, seed_url, breadcrumbs + 'R', url, 'text/html')
+            return
+
+        kind = rnd.choices([k for k, w in self.mix], weights=[w for k, w in self.mix])[0]
+        if kind == 'pdf':
+            self.content(url, breadcrumbs, referrer, 'application/pdf', rnd.randint(20000, 3000000))
+        elif kind == 'ps':
+            self.content(url, breadcrumbs, referrer, 'application/postscript', rnd.randint(20000, 3000000))
+        elif kind == 'octet':
+            self.content(url, breadcrumbs, referrer, 'application/octet-stream', rnd.choice((500, 200000)))
+        elif kind == 'error':
+            self.log(rnd.choice(ERROR_STATUSES), 0, url, breadcrumbs, referrer, 'text/html')
+        else:
+            self.content(url, breadcrumbs, referrer, 'text/html;charset=utf-8', rnd.randint(2000, 90000))
+            for k in range(rnd.randint(0, self.fanout)):
+                self.content("{}/static/{}".format(url, k), breadcrumbs + 'E', url,
+                    rnd.choice(EMBED_MIMETYPES), rnd.randint(100, 20000))
+            for k in range(rnd.randint(0, self.fanout)):
+                link = "{}/fulltext{}.pdf".format(url, k)
+                if rnd.random() < 0.15:
+                    self.log(404, 0, link, breadcrumbs + 'L', url, 'text/html')
+                else:
+                    self.content(link, breadcrumbs + 'L', url, 'application/PDF', rnd.randint(20000, 3000000))
+
+    def generate(self):
+        os.makedirs(self.data_dir, exist_ok=True)
+        with open(os.path.join(self.data_dir, 'crawl.log'), 'w') as self.log_file, \
+                open(os.path.join(self.data_dir, 'crawl.cdx'), 'w') as self.cdx_file, \
+                open(os.path.join(self.data_dir, 'seed_id.tsv'), 'w') as self.seed_file, \
+                open(os.path.join(self.data_dir, 'sha1_status.tsv'), 'w') as self.sha1_file:
+            self.cdx_file.write(" CDX N b a m s k r M S V g\n")
+            for i in range(self.seeds):
+                self.seed(i)
+        with open(os.path.join(self.data_dir, 'params.json'), 'w') as f:
+            json.dump(dict(params=self.params, counts=self.counts), f, indent=2, sort_keys=True)
+        return self.counts
+
+def test_generate(tmp_path):
+    sys.path.insert(0, os.path.dirname(ARABESQUE))
+    import arabesque
+    counts = CrawlGenerator(str(tmp_path / 'a'), seeds=300, random_seed=7).generate()
+    CrawlGenerator(str(tmp_path / 'b'), seeds=300, random_seed=7).generate()
+    for name in ('crawl.log', 'crawl.cdx', 'seed_id.tsv', 'sha1_status.tsv'):
+        with open(str(tmp_path / 'a' / name)) as a, open(str(tmp_path / 'b' / name)) as b:
+            assert a.read() == b.read()
+    with open(str(tmp_path / 'a' / 'crawl.log')) as f:
+        lines = f.readlines()
+    assert len(lines) == counts['log_lines']
+    assert all(arabesque.parse_crawl_line(line) for line in lines)
+    with open(str(tmp_path / 'a' / 'crawl.cdx')) as f:
+        assert all(arabesque.parse_full_cdx_line(line) for line in list(f)[1:])
+
+def count_input(path):
+    """
+    Lines in an input file, or crawl_result rows for a database input.
+    """
+    if path.endswith('.sqlite'):
+        if not os.path.exists(path):
+            return 0
+        db = sqlite3.connect(path)
+        count = db.execute("SELECT COUNT(*) FROM crawl_result").fetchone()[0]
+        db.close()
+        return count
+    with open(path, 'rb') as f:
+        return sum(1 for _ in f)
+
+def dump_rows(db_path):
+    """
+    crawl_result rows as sorted, tab-separated lines (NULL as '\\N'), for
+    comparing against a reference independent of insertion order.
+    """
+    db = sqlite3.connect(db_path)
+    rows = db.execute("SELECT * FROM crawl_result")
+    lines = ['\t'.join('\\N' if v is None else str(v) for v in row) for row in rows]
+    db.close()
+    return sorted(lines)
+
+def compare_rows(rows, reference):
+    missing = sorted(set(reference) - set(rows))
+    extra = sorted(set(rows) - set(reference))
+    return dict(match=(rows == reference), rows=len(rows), reference_rows=len(reference),
+        missing=len(missing), extra=len(extra), examples=(missing[:3] + extra[:3]))
+
+STAGES = ('referrer', 'backward', 'forward', 'postprocess', 'backward_cdx', 'everything', 'dump_json')
+DEFAULT_STAGES = STAGES
+
+def stage_commands(data_dir, work_dir):
+    d = lambda name: os.path.join(data_dir, name)
+    w = lambda name: os.path.join(work_dir, name)
+    return {
+        'referrer': (['referrer', d('crawl.log'), w('map.sqlite')], d('crawl.log'), w('map.sqlite')),
+        'backward': (['backward', d('crawl.log'), w('map.sqlite'), w('out.sqlite')], d('crawl.log'), w('out.sqlite')),
+        'forward': (['forward', d('seed_id.tsv'), w('map.sqlite'), w('out.sqlite')], d('seed_id.tsv'), w('out.sqlite')),
+        'postprocess': (['postprocess', d('sha1_status.tsv'), w('out.sqlite')], d('sha1_status.tsv'), w('out.sqlite')),
+        'backward_cdx': (['backward_cdx', d('crawl.cdx'), w('map.sqlite'), w('cdx_out.sqlite')], d('crawl.cdx'), w('cdx_out.sqlite')),
+        'everything': (['everything', '--map_db_file', w('everything_map.sqlite'), d('crawl.log'), d('seed_id.tsv'), w('everything.sqlite')],
+            d('crawl.log'), w('everything.sqlite')),
+        'dump_json': (['dump_json', w('out.sqlite')], w('out.sqlite'), None),
+    }
+
+def run_stage(name, args, extra_args, input_path, output_path, work_dir, arabesque=ARABESQUE):
+    """
+    Runs one arabesque.py subcommand, returning a dict of metrics. Peak RSS
+    and CPU time come from wait4() on the child process.
+    """
+    cmd = [sys.executable, arabesque] + extra_args + args
+    print("... {}: {}".format(name, ' '.join(cmd[1:])))
+    input_lines = count_input(input_path)
+    with open(os.path.join(work_dir, name + '.stdout'), 'w') as out:
+        start = time.time()
+        proc = subprocess.Popen(cmd, stdout=out, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(proc.pid, 0)
+        elapsed = time.time() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    metrics = dict(
+        stage=name,
+        returncode=proc.returncode,
+        seconds=round(elapsed, 3),
+        user_seconds=round(usage.ru_utime, 3),
+        system_seconds=round(usage.ru_stime, 3),
+        input_lines=input_lines,
+        lines_per_sec=round(input_lines / max(elapsed, 0.000001), 1),
+        # ru_maxrss is KB on Linux
+        peak_rss_bytes=usage.ru_maxrss * 1024,
+    )
+    if output_path and os.path.exists(output_path):
+        metrics['db_size_bytes'] = os.path.getsize(output_path)
+        db = sqlite3.connect(output_path)
+        tables = [r[0] for r in db.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        for table in ('referrer', 'crawl_result'):
+            if table in tables:
+                metrics[table + '_rows'] = db.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+        db.close()
+    if proc.returncode != 0:
+        print("    FAILED (exit {}); see {}.stdout".format(proc.returncode, name))
+    else:
+        print("    {seconds}s, {lines_per_sec} lines/sec, peak RSS {peak_rss_bytes} bytes".format(**metrics))
+    return metrics
+
+def run(data_dir, work_dir=None, extra_args=(), stages=DEFAULT_STAGES, reference_path=None,
+        save_reference=False, results_path=None, arabesque=ARABESQUE):
+    work_dir = work_dir or os.path.join(data_dir, 'work')
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    commands = stage_commands(data_dir, work_dir)
+    results = dict(
+        started=datetime.datetime.utcnow().isoformat() + 'Z',
+        python=sys.version.split()[0],
+        sqlite=sqlite3.sqlite_version,
+        arabesque=arabesque,
+        arabesque_args=list(extra_args),
+        stages=[],
+    )
+    params_path = os.path.join(data_dir, 'params.json')
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            results['data'] = json.load(f)
+
+    for name in stages:
+        args, input_path, output_path = commands[name]
+        results['stages'].append(run_stage(name, args, list(extra_args), input_path, output_path, work_dir, arabesque))
+    failed = [s['stage'] for s in results['stages'] if s['returncode'] != 0]
+
+    outputs = []
+    if 'postprocess' in stages and os.path.exists(os.path.join(work_dir, 'out.sqlite')):
+        outputs.append(('pipeline', dump_rows(os.path.join(work_dir, 'out.sqlite'))))
+    if 'everything' in stages and os.path.exists(os.path.join(work_dir, 'everything.sqlite')):
+        # everything doesn't postprocess, so do that outside of the timed stages
+        subprocess.check_call([sys.executable, arabesque, 'postprocess',
+                os.path.join(data_dir, 'sha1_status.tsv'), os.path.join(work_dir, 'everything.sqlite')],
+            stdout=subprocess.DEVNULL)
+        outputs.append(('everything', dump_rows(os.path.join(work_dir, 'everything.sqlite'))))
+
+    if save_reference and outputs:
+        reference_path = reference_path or os.path.join(data_dir, 'reference.tsv')
+        with open(reference_path, 'w') as f:
+            f.writelines(line + '\n' for line in outputs[0][1])
+        print("Saved reference ({} rows) to {}".format(len(outputs[0][1]), reference_path))
+    elif reference_path:
+        with open(reference_path) as f:
+            reference = [line.rstrip('\n') for line in f]
+        results['reference'] = reference_path
+        results['comparison'] = dict()
+        for name, rows in outputs:
+            comparison = compare_rows(rows, reference)
+            results['comparison'][name] = comparison
+            print("{} vs reference: {}".format(name, "OK" if comparison['match'] else
+                "MISMATCH ({missing} missing, {extra} extra rows)".format(**comparison)))
+            if not comparison['match']:
+                failed.append(name)
+
+    results['failed'] = failed
+    if results_path:
+        with open(results_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Wrote results to {}".format(results_path))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    sub_generate = subparsers.add_parser('generate',
+        help="write synthetic crawl log, CDX, seed and sha1 status files")
+    sub_generate.set_defaults(func=CrawlGenerator)
+    sub_generate.add_argument("data_dir",
+        help="directory to write input files to")
+    sub_generate.add_argument("--seeds",
+        default=10000, type=int,
+        help="number of seed URLs (scale)")
+    sub_generate.add_argument("--max-redirects",
+        default=4, type=int,
+        help="maximum redirect chain length")
+    sub_generate.add_argument("--fanout",
+        default=3, type=int,
+        help="maximum embeds and maximum PDF links per HTML landing page")
+    sub_generate.add_argument("--loop-rate",
+        default=0.02, type=float,
+        help="fraction of seeds which end in a redirect loop")
+    sub_generate.add_argument("--dedupe-rate",
+        default=0.1, type=float,
+        help="fraction of successful fetches which are duplicates (by digest)")
+    sub_generate.add_argument("--mix",
+        default=DEFAULT_MIX,
+        help="relative weights of terminal outcomes ({})".format(", ".join(MIX_KINDS)))
+    sub_generate.add_argument("--missing-rate",
+        default=0.05, type=float,
+        help="fraction of seeds never crawled")
+    sub_generate.add_argument("--noise-rate",
+        default=0.05, type=float,
+        help="fraction of seed lines needing normalization, or without identifier")
+    sub_generate.add_argument("--random-seed",
+        default=1, type=int)
+
+    sub_run = subparsers.add_parser('run',
+        help="time each arabesque.py stage against generated inputs")
+    sub_run.set_defaults(func=run)
+    sub_run.add_argument("data_dir",
+        help="directory with generated input files")
+    sub_run.add_argument("--work-dir",
+        help="where to put map/output databases (default: <data_dir>/work; wiped first)")
+    sub_run.add_argument("--stages",
+        default=','.join(DEFAULT_STAGES),
+        help="comma-separated stages to run, in order ({})".format(", ".join(STAGES)))
+    sub_run.add_argument("--results",
+        help="JSON file to write metrics to")
+    sub_run.add_argument("--reference",
+        help="sorted crawl_result dump to compare output against")
+    sub_run.add_argument("--arabesque",
+        default=ARABESQUE,
+        help="arabesque.py to benchmark (eg, from another checkout)")
+    sub_run.add_argument("--save-reference",
+        action='store_true',
+        help="write this run's output as the reference (default: <data_dir>/reference.tsv)")
+
+    # anything after '--' is for arabesque.py
+    argv = sys.argv[1:]
+    arabesque_args = []
+    if '--' in argv:
+        arabesque_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    if not getattr(args, 'func', None):
+        print("tell me what to do! (try --help)")
+        sys.exit(-1)
+
+    if args.func is CrawlGenerator:
+        counts = CrawlGenerator(args.data_dir, seeds=args.seeds, max_redirects=args.max_redirects,
+            fanout=args.fanout, loop_rate=args.loop_rate, dedupe_rate=args.dedupe_rate,
+            mix=args.mix, missing_rate=args.missing_rate, noise_rate=args.noise_rate,
+            random_seed=args.random_seed).generate()
+        print(counts)
+    elif args.func is run:
+        stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+        for stage in stages:
+            if stage not in STAGES:
+                raise ValueError("unknown stage: {} (expected one of {})".format(stage, ", ".join(STAGES)))
+        results = run(args.data_dir, work_dir=args.work_dir, extra_args=arabesque_args, stages=stages,
+            reference_path=args.reference, save_reference=args.save_reference,
+            results_path=args.results, arabesque=args.arabesque)
+        if results['failed']:
+            print("FAILED: {}".format(", ".join(results['failed'])))
+            sys.exit(1)
+    else:
+        raise NotImplementedError()
+
+if __name__ == '__main__':
+    main()